@@ -8,103 +8,2411 @@
 
 
 import os
+import re
+import json
+import time
+import queue
+import zlib
+import random
+import socket
+import sqlite3
+import hashlib
+import importlib
+import itertools
+import threading
+import http.client
+import urllib.parse
 from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from concurrent.futures import Future, ThreadPoolExecutor
 
-try:
-    import openai
-    from openai import OpenAI
-except ModuleNotFoundError:
-    openai = None
-    OpenAI = None
+from tracing import tracer
 
 
+MODEL_CACHE_PATH = os.path.expanduser("~/Library/Application Support/Murmur/model_cache.json")
+MODEL_CACHE_TTL = 6 * 60 * 60  # seconds
+MODEL_RETRY_AFTER = 5 * 60     # seconds before asking again after a failed fetch
+RESPONSE_CACHE_DIR = os.path.expanduser("~/Library/Application Support/Murmur/response_cache")
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # seconds
+SEMANTIC_CACHE_DIR = os.path.expanduser("~/Library/Application Support/Murmur/semantic_cache")
+SEMANTIC_THRESHOLD = 0.9        # cosine similarity needed to reuse an answer
+SEMANTIC_DIMENSIONS = 128       # of the built-in hashed embedding
+SEMANTIC_MAX_ENTRIES = 100000
+
+# Context window per model family, matched by prefix (first match wins).
+# The builder uses the smaller of this and its own budget.
+MODEL_CONTEXT_WINDOWS = [
+    ("gpt-3.5", 16000),
+    ("gpt-4o", 128000),
+    ("gpt-4.1", 1000000),
+    ("gpt-4", 8000),
+    ("claude-", 200000),
+    ("gemini-", 1000000),
+]
+CONTEXT_BUDGET = 8000      # tokens of earlier conversation sent with a prompt
+CONTEXT_REPLY_RESERVE = 1024
+
+CLAUDE_BASE_URL = "https://api.anthropic.com"
+CLAUDE_API_VERSION = "2023-06-01"
+CLAUDE_MAX_TOKENS = 4096   # the Messages API requires a limit
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
+REQUEST_TIMEOUT = 60       # seconds to connect, and between reads of a reply
+
+# Adaptive deadlines: once a (provider, model) has LATENCY_MIN_SAMPLES
+# requests behind it, its timeout is TIMEOUT_MARGIN times its p99, clamped
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+TIMEOUT_MARGIN = 3.0
+MIN_TIMEOUT = 5.0
+MAX_TIMEOUT = 600.0
+HEDGE_RATIO = 0.05         # at most this share of requests get a hedged duplicate
+
+
+_sdk_modules = {}
+_sdk_lock = threading.Lock()
+
+def load_sdk(name):
+    # Provider SDKs are slow to import (openai alone takes most of a second),
+    # so each is imported the first time something needs it. None if missing.
+    module = _sdk_modules.get(name, False)
+    if module is False:
+        with _sdk_lock:
+            module = _sdk_modules.get(name, False)
+            if module is False:
+                try:
+                    module = importlib.import_module(name)
+                except ModuleNotFoundError:
+                    module = None
+                _sdk_modules[name] = module
+    return module
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one call of fn: the first
+    # caller runs it, the rest wait for its result (or its exception)
+    def __init__(self):
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fn, *args):
+        with self._lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self._finish(key)
+            future.set_exception(e)
+            raise
+        self._finish(key)
+        future.set_result(result)
+        return result
+
+    def _finish(self, key):
+        with self._lock:
+            self.calls.pop(key, None)
+
+
+model_lookups = SingleFlight()
+
 def get_openai_models(api_key):
+    return model_lookups.run(("openai", key_fingerprint(api_key)), _fetch_openai_models, api_key)
+
+def get_claude_models(api_key, base_url=None):
+    return model_lookups.run(("claude", key_fingerprint(api_key), base_url), _fetch_claude_models, api_key, base_url)
+
+def get_gemini_models(api_key, base_url=None):
+    return model_lookups.run(("gemini", key_fingerprint(api_key), base_url), _fetch_gemini_models, api_key, base_url)
+
+def _fetch_openai_models(api_key):
+    openai = load_sdk("openai")
     if not openai:
         print("OpenAI module not loaded.")
         return []
 
-    print(f"Fetching models using API key: {api_key[:8]}...")
-
-    openai.api_key = api_key
     try:
-        client = openai.OpenAI(api_key=api_key)
-        response = client.models.list()
-        models = [m.id for m in response.data]
-        print(f"Found models: {models}")
-        return models
+        with tracer.span("list_models", "openai"):
+            client = openai.OpenAI(api_key=api_key)
+            response = client.models.list()
+            return [m.id for m in response.data]
     except Exception as e:
         print(f"Error fetching OpenAI models: {e}")
         return []
 
-def get_claude_models(api_key):
-    # Your API call logic here
-    return ["claude-3-opus", "claude-3-sonnet"]
+def _fetch_claude_models(api_key, base_url=None):
+    transport = HTTPTransport(base_url or CLAUDE_BASE_URL, claude_headers(api_key))
+    models = []
+    query = {"limit": 1000}
+    try:
+        with tracer.span("list_models", "claude"):
+            while True:
+                page = transport.request_json("GET", "/v1/models?" + urllib.parse.urlencode(query), provider="claude")
+                models += [m["id"] for m in page.get("data", [])]
+                if not page.get("has_more") or not page.get("last_id"):
+                    return models
+                query["after_id"] = page["last_id"]
+    except Exception as e:
+        print(f"Error fetching Claude models: {e}")
+        return []
+    finally:
+        transport.close()
+
+def _fetch_gemini_models(api_key, base_url=None):
+    transport = HTTPTransport(base_url or GEMINI_BASE_URL, {"x-goog-api-key": api_key})
+    models = []
+    query = {"pageSize": 1000}
+    try:
+        with tracer.span("list_models", "gemini"):
+            while True:
+                page = transport.request_json("GET", "/models?" + urllib.parse.urlencode(query), provider="gemini")
+                # Embedding and other models can't chat
+                models += [m["name"].removeprefix("models/") for m in page.get("models", [])
+                           if "generateContent" in m.get("supportedGenerationMethods", [])]
+                if not page.get("nextPageToken"):
+                    return models
+                query["pageToken"] = page["nextPageToken"]
+    except Exception as e:
+        print(f"Error fetching Gemini models: {e}")
+        return []
+    finally:
+        transport.close()
+
+
+def key_fingerprint(api_key: str) -> str:
+    # Stable, non-reversible id for an API key, safe to write to disk
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+class ModelCatalog:
+    # Model lists cached per (provider, key fingerprint) and persisted to disk.
+    # get() answers from the cache straight away and refreshes stale entries in
+    # the background; concurrent refreshes of the same key share one request.
+    # After a failed fetch the old list is kept and get() waits retry_after
+    # before trying again, so a provider that is down isn't asked on every call.
+    def __init__(self, path=MODEL_CACHE_PATH, ttl=MODEL_CACHE_TTL, dispatch=None, fetchers=None,
+                 retry_after=MODEL_RETRY_AFTER):
+        self.path = path
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self.dispatch = dispatch or (lambda fn, *args: fn(*args))
+        self.fetchers = fetchers or {name: provider.list_models for name, provider in PROVIDERS.items()}
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="murmur-models")
+        self.entries = self._load()
+        self._refreshing = {}
+        self._failed_at = {}  # key: time of the last failed fetch, not persisted
+        self._lock = threading.Lock()
+
+    def get(self, provider, api_key, on_update=None) -> list:
+        key = f"{provider}:{key_fingerprint(api_key)}"
+        entry = self.entries.get(key)
+        cached = entry["models"] if entry else []
+        now = time.time()
+        stale = entry is None or now - entry["fetched_at"] > self.ttl
+        if stale and now - self._failed_at.get(key, 0) > self.retry_after:
+            future = self.refresh(provider, api_key)
+            if on_update:
+                def updated(future):
+                    if not future.cancelled() and not future.exception() and future.result() != cached:
+                        self.dispatch(on_update, future.result())
+                future.add_done_callback(updated)
+        return cached
+
+    def refresh(self, provider, api_key):
+        key = f"{provider}:{key_fingerprint(api_key)}"
+        with self._lock:
+            future = self._refreshing.get(key)
+            if future is None:
+                future = self.executor.submit(self._fetch, provider, api_key, key)
+                self._refreshing[key] = future
+        return future
+
+    def _fetch(self, provider, api_key, key):
+        try:
+            try:
+                models = self.fetchers[provider](api_key)
+            except Exception:
+                with self._lock:
+                    self._failed_at[key] = time.time()
+                raise
+            if not models:
+                # Keep serving the old list if the provider could not be reached
+                with self._lock:
+                    self._failed_at[key] = time.time()
+                entry = self.entries.get(key)
+                return entry["models"] if entry else []
+            with self._lock:
+                self._failed_at.pop(key, None)
+                self.entries[key] = {"models": models, "fetched_at": time.time()}
+                self._save(self.entries)
+            return models
+        finally:
+            with self._lock:
+                self._refreshing.pop(key, None)
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+
+class ChatError(Exception):
+    # Base for failures talking to a provider. retryable errors are worth
+    # another attempt; retry_after is the provider's requested wait in seconds.
+    retryable = False
+
+    def __init__(self, message, provider="", status_code=None, retry_after=None, headers=None):
+        super().__init__(message)
+        self.provider = provider
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.headers = headers or {}
+
+
+class ChatConnectionError(ChatError):
+    retryable = True
+
+
+class ChatTimeoutError(ChatConnectionError):
+    pass
+
+
+class RateLimitError(ChatError):
+    retryable = True
+
+
+class ProviderError(ChatError):
+    @property
+    def retryable(self):
+        return self.status_code is not None and self.status_code >= 500
+
+
+def parse_duration(value) -> float:
+    # Rate limit headers use either plain seconds or forms like "6m0s", "20ms"
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * scale[unit] for amount, unit in parts)
+
+
+def retry_after(headers) -> float:
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    return parse_duration(headers.get("retry-after"))
+
+
+def openai_error(e) -> ChatError:
+    openai = load_sdk("openai")
+    if isinstance(e, openai.APITimeoutError):
+        return ChatTimeoutError(f"OpenAI API timed out: {e}", provider="openai")
+    if isinstance(e, openai.APIConnectionError):
+        return ChatConnectionError(f"Error connecting to OpenAI API: {e}", provider="openai")
+    if isinstance(e, openai.APIStatusError):
+        headers = dict(e.response.headers)
+        message = f"Error from OpenAI API (Status {e.status_code}): {e.response.text}"
+        # An exhausted quota also comes back as a 429, but waiting won't help
+        if e.status_code == 429 and "insufficient_quota" not in e.response.text:
+            return RateLimitError(message, "openai", e.status_code, retry_after(headers), headers)
+        return ProviderError(message, "openai", e.status_code, retry_after(headers), headers)
+    return ChatError(f"Error from OpenAI: {e}", provider="openai")
+
+
+class RateLimiter:
+    # Token bucket for one provider. It doesn't limit anything until the
+    # provider's x-ratelimit-*-requests headers give it a capacity and refill
+    # rate; a 429 pauses it for as long as the provider asks.
+    def __init__(self, capacity=None, per_seconds=60.0):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds if capacity else None
+        self.tokens = float(capacity or 0)
+        self.paused_until = 0.0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, cancel_event=None) -> bool:
+        # Blocks until a request may go out; False if cancelled while waiting
+        while True:
+            wait = self._take()
+            if not wait:
+                return True
+            if cancel_event is not None:
+                if cancel_event.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+    def try_acquire(self) -> bool:
+        # For optional requests (hedges): go now or not at all
+        return not self._take()
+
+    def _take(self) -> float:
+        # Takes a token and returns 0, or returns how long until one is free
+        with self._lock:
+            now = time.monotonic()
+            if self.rate:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now >= self.paused_until and (not self.rate or self.tokens >= 1):
+                self.tokens -= 1
+                return 0
+            wait = self.paused_until - now
+            if self.rate:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            return max(wait, 0.001)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update(self, headers):
+        limit = headers.get("x-ratelimit-limit-requests")
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        reset = parse_duration(headers.get("x-ratelimit-reset-requests"))
+        if not limit or remaining is None:
+            return
+        with self._lock:
+            self.capacity = max(int(limit), 1)
+            self.tokens = min(float(remaining), self.capacity)
+            # The used part of the bucket refills over the reset period
+            used = self.capacity - float(remaining)
+            if reset and used > 0:
+                self.rate = max(used / reset, self.capacity / 3600)
+            elif not self.rate:
+                self.rate = self.capacity / 60  # limits are usually per minute
+            if reset and float(remaining) < 1:
+                self.paused_until = max(self.paused_until, time.monotonic() + reset)
+
+
+class LatencyTracker:
+    # Rolling latency samples per (provider, model): time to the first token,
+    # which is what a timeout has to allow for when streaming, and the whole
+    # reply. A request that timed out counts as taking its full deadline, so a
+    # model that has slowed down pushes its own deadline back up.
+    def __init__(self, window=LATENCY_WINDOW, min_samples=LATENCY_MIN_SAMPLES, margin=TIMEOUT_MARGIN,
+                 min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT, default_timeout=REQUEST_TIMEOUT):
+        self.window = window
+        self.min_samples = min_samples
+        self.margin = margin
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.default_timeout = default_timeout
+        self.samples = {}  # (provider, model, "first_token" or "total") -> deque of seconds
+        self._lock = threading.Lock()
+
+    def observe(self, provider, model, first_token=None, total=None):
+        with self._lock:
+            for kind, seconds in (("first_token", first_token), ("total", total)):
+                if seconds is not None:
+                    key = (provider, model, kind)
+                    samples = self.samples.get(key)
+                    if samples is None:
+                        samples = self.samples[key] = deque(maxlen=self.window)
+                    samples.append(seconds)
+
+    def percentile(self, provider, model, q, kind="first_token"):
+        # None until there are enough samples to trust
+        with self._lock:
+            samples = self.samples.get((provider, model, kind))
+            if not samples or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+    def deadline(self, provider, model, kind="first_token") -> float:
+        p99 = self.percentile(provider, model, 0.99, kind)
+        if p99 is None:
+            return self.default_timeout
+        return min(max(p99 * self.margin, self.min_timeout), self.max_timeout)
+
+
+class HedgeBudget:
+    # Each request earns `ratio` of a hedge and each hedge spends one, so
+    # over time at most that share of requests are sent twice; burst lets a
+    # few through before any have been earned
+    def __init__(self, ratio=HEDGE_RATIO, burst=2.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.balance = burst
+        self._lock = threading.Lock()
+
+    def earn(self):
+        with self._lock:
+            self.balance = min(self.balance + self.ratio, self.burst)
+
+    def spend(self) -> bool:
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
 
-def get_gemini_models(api_key):
-    # Your API call logic here
-    return ["gemini-1.5-pro", "gemini-1.5-flash"]
+    def refund(self):
+        # A hedge that was paid for but never sent
+        with self._lock:
+            self.balance = min(self.balance + 1, self.burst)
+
+
+INTERACTIVE = 0  # request priorities; lower runs first
+BACKGROUND = 10
+
+
+class RequestScheduler:
+    # Worker threads fed from a priority queue, so interactive prompts jump
+    # ahead of background work. submit() returns a concurrent.futures.Future.
+    def __init__(self, max_workers=4, name="murmur-chat"):
+        self.queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._shutdown = False
+        self.workers = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(max_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, fn, *args, priority=INTERACTIVE) -> Future:
+        if self._shutdown:
+            raise RuntimeError("scheduler has been shut down")
+        future = Future()
+        self.queue.put((priority, next(self._sequence), future, fn, args))
+        return future
+
+    def shutdown(self):
+        self._shutdown = True
+        for _ in self.workers:
+            self.queue.put((float("inf"), next(self._sequence), None, None, None))
+
+    def _work(self):
+        while True:
+            _, _, future, fn, args = self.queue.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0) -> float:
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def build_messages(prompt, context=None) -> list:
+    return list(context or []) + [{"role": "user", "content": prompt}]
+
+
+def provider_title(provider) -> str:
+    return PROVIDERS[provider].title if provider in PROVIDERS else provider
+
+
+def http_error(provider, status, body, headers) -> ChatError:
+    # Providers wrap errors as {"error": {"message": ...}}; fall back to the raw body
+    try:
+        detail = json.loads(body)["error"]
+        message = detail.get("message") or json.dumps(detail)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        message = body.decode("utf-8", errors="replace")[:500] if isinstance(body, bytes) else str(body)
+    message = f"Error from {provider_title(provider)} API (Status {status}): {message}"
+    if status == 429:
+        return RateLimitError(message, provider, status, retry_after(headers), headers)
+    return ProviderError(message, provider, status, retry_after(headers), headers)
+
+
+class SSEParser:
+    # Incremental text/event-stream parser. feed() takes bytes as they come
+    # off the socket and returns the events completed so far as (event, data).
+    def __init__(self):
+        self.buffer = b""
+        self.event = ""
+        self.data = []
+
+    def feed(self, chunk) -> list:
+        *lines, self.buffer = (self.buffer + chunk).split(b"\n")
+        events = []
+        for line in lines:
+            line = line.rstrip(b"\r").decode("utf-8", errors="replace")
+            if not line:
+                if self.data:
+                    events.append((self.event or "message", "\n".join(self.data)))
+                self.event = ""
+                self.data = []
+                continue
+            if line.startswith(":"):
+                continue  # comment, used as a keep-alive
+            name, _, value = line.partition(":")
+            if value.startswith(" "):
+                value = value[1:]
+            if name == "data":
+                self.data.append(value)
+            elif name == "event":
+                self.event = value
+        return events
+
+
+class HTTPTransport:
+    # Small keep-alive HTTP/1.1 client for one API host, on the standard
+    # library, for providers without an SDK here. Idle connections are reused
+    # most recent first; one that the server closed while idle is retried once
+    # on a fresh connection.
+    def __init__(self, base_url, headers=None, timeout=REQUEST_TIMEOUT, max_idle=4):
+        url = urllib.parse.urlsplit(base_url)
+        self.https = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip("/")
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = []
+        self.connections_opened = 0
+        self.requests_sent = 0
+        self._lock = threading.Lock()
+
+    def request_json(self, method, path, body=None, provider="", on_headers=None, timeout=None):
+        connection, response = self._send(method, path, body, provider, timeout=timeout)
+        try:
+            data = response.read()
+        except TimeoutError as e:
+            connection.close()
+            raise ChatTimeoutError(f"{provider_title(provider)} API timed out", provider=provider) from e
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            raise ChatConnectionError(f"Error reading from {provider_title(provider)} API: {e}", provider=provider) from e
+        self._release(connection, response)
+        headers = {name.lower(): value for name, value in response.getheaders()}
+        if on_headers:
+            on_headers(headers)
+        if response.status >= 400:
+            raise http_error(provider, response.status, data, headers)
+        return json.loads(data)
+
+    def stream_events(self, method, path, body=None, provider="", on_headers=None, timeout=None, stream=None):
+        # Yields (event, data) as each server-sent event completes. timeout
+        # bounds the wait for each read, not the whole reply. stream, the
+        # ChatStream being read, holds the socket meanwhile so it can be aborted.
+        connection, response = self._send(method, path, body, provider, {"Accept": "text/event-stream"}, timeout,
+                                          stream)
+        headers = {name.lower(): value for name, value in response.getheaders()}
+        if on_headers:
+            on_headers(headers)
+        if response.status >= 400:
+            data = response.read()
+            if stream:
+                stream.attach_socket(None)
+            self._release(connection, response)
+            raise http_error(provider, response.status, data, headers)
+        parser = SSEParser()
+        finished = False
+        try:
+            while True:
+                chunk = response.read1(65536)
+                if not chunk:
+                    finished = True
+                    break
+                yield from parser.feed(chunk)
+        except TimeoutError as e:
+            raise ChatTimeoutError(f"{provider_title(provider)} API timed out", provider=provider) from e
+        except (OSError, http.client.HTTPException) as e:
+            raise ChatConnectionError(f"Error reading from {provider_title(provider)} API: {e}", provider=provider) from e
+        finally:
+            # A stream abandoned part way still has data in flight; don't reuse it
+            if stream:
+                stream.attach_socket(None)
+                finished = finished and not stream.aborted
+            if finished:
+                self._release(connection, response)
+            else:
+                connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+    def _send(self, method, path, body, provider, headers=None, timeout=None, stream=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = dict(self.headers, **(headers or {}))
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+        for attempt in range(2):
+            connection, reused = self._acquire()
+            # Pooled connections keep the timeout of whoever used them last
+            connection.timeout = timeout or self.timeout
+            if connection.sock:
+                connection.sock.settimeout(connection.timeout)
+            try:
+                connection.request(method, self.base_path + path, body=data, headers=headers)
+                self.requests_sent += 1
+                tracer.count("requests_sent", 1, provider)
+                if not reused:
+                    tracer.count("connections_opened", 1, provider)
+                if stream:
+                    # Before the wait for headers, which is where a stalled request sits
+                    stream.attach_socket(connection.sock)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                connection.close()
+                if stream:
+                    stream.attach_socket(None)
+                if reused and attempt == 0 and not (stream and stream.aborted):
+                    continue  # the server closed it while it sat idle
+                raise ChatConnectionError(f"Error connecting to {provider_title(provider)} API: {e}", provider=provider) from e
+            except TimeoutError as e:
+                connection.close()
+                if stream:
+                    stream.attach_socket(None)
+                raise ChatTimeoutError(f"{provider_title(provider)} API timed out", provider=provider) from e
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                if stream:
+                    stream.attach_socket(None)
+                raise ChatConnectionError(f"Error connecting to {provider_title(provider)} API: {e}", provider=provider) from e
+
+    def _acquire(self):
+        with self._lock:
+            if self.idle:
+                return self.idle.pop(), True
+            self.connections_opened += 1
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=_ssl_context()), False
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def _release(self, connection, response):
+        if response.will_close:
+            connection.close()
+            return
+        with self._lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+
+_ssl = None
+
+def _ssl_context():
+    # certifi's bundle when it is installed; python.org builds on macOS ship
+    # without system certificates
+    global _ssl
+    if _ssl is None:
+        import ssl
+        certifi = load_sdk("certifi")
+        _ssl = ssl.create_default_context(cafile=certifi.where() if certifi else None)
+    return _ssl
+
+
+class ChatStream:
+    # Iterable of text deltas from a streaming reply. Timing is recorded as the
+    # deltas are consumed, so time_to_first_token is what the user actually saw.
+    def __init__(self, deltas, started=None):
+        self._deltas = deltas
+        self.started = started if started is not None else time.monotonic()
+        self.time_to_first_token = None
+        self.total_time = None
+        self.parts = []
+        self.usage = None     # {"prompt_tokens", "completion_tokens"} once the provider reports them
+        self.cached = False   # answered from a cache, not the provider
+        self.hedges = []      # other billed streams raced for this reply, which lost
+        self.aborted = False
+        self.source = None    # the stream this one wraps, aborted along with it
+        self._socket = None
+        self._abort_lock = threading.Lock()
+
+    def __iter__(self):
+        for delta in self._deltas:
+            if not delta:
+                continue
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.monotonic() - self.started
+            self.parts.append(delta)
+            yield delta
+        self.total_time = time.monotonic() - self.started
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def close(self):
+        close = getattr(self._deltas, "close", None)
+        if close:
+            close()
+
+    def abort(self):
+        # Unlike close, safe from another thread: shuts the socket the reply
+        # is read from, so a reader blocked on it wakes at once instead of at
+        # its read deadline, and the provider stops generating
+        with self._abort_lock:
+            self.aborted = True
+            sock = self._socket
+        if sock:
+            _shutdown(sock)
+        if self.source:
+            self.source.abort()
+
+    def attach_socket(self, sock):
+        # Clients hand over the socket while the reply is read, then None
+        with self._abort_lock:
+            self._socket = sock
+            aborted = self.aborted
+        if sock and aborted:
+            _shutdown(sock)
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
 
 
 class ChatClient(ABC):
+    connections_opened = 0
+    requests_sent = 0
+    header_observer = None  # called with the HTTP headers of each response
+
+    # context is the earlier conversation as chat messages, oldest first.
+    # timeout is in seconds, None for the client's default.
     @abstractmethod
-    def send_message(self, prompt: str) -> str:
+    def send_message(self, prompt: str, model: str, context=None, timeout=None) -> str:
+        pass
+
+    def close(self):
         pass
 
+    def stream_message(self, prompt: str, model: str, context=None, timeout=None) -> ChatStream:
+        # Providers without streaming support deliver the whole reply as one delta
+        def deltas():
+            yield self.send_message(prompt=prompt, model=model, context=context, timeout=timeout)
+        return ChatStream(deltas())
+
 class OpenAIClient(ChatClient):
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, base_url=None):
         self.api_key = api_key
+        self.base_url = base_url
+        self.connections_opened = 0
+        self.requests_sent = 0
+        self.openai = openai = load_sdk("openai")
         if openai:
-            self.client = openai.OpenAI(api_key=self.api_key)
+            # One long-lived httpx pool per client; the trace hook counts how
+            # many requests went out over an already open connection
+            http_client = openai.DefaultHttpxClient(event_hooks={"request": [self._add_trace]})
+            # Retries are left to ChatService, which knows about rate limits
+            self.client = openai.OpenAI(api_key=self.api_key, base_url=base_url, http_client=http_client, max_retries=0)
         else:
             self.client = None
 
-    def send_message(self, prompt: str, model: str) -> str:
-        print(f"[OpenAIClient.send_message] Prompt: {prompt}")
-        print(f"[OpenAIClient.send_message] Model from dropdown: {model}")
-        print(f"[OpenAIClient.send_message] API Key (masked): {self.api_key[:8]}...")
-    
+    def _add_trace(self, request):
+        request.extensions["trace"] = self._trace
+
+    def _trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            self.connections_opened += 1
+            tracer.count("connections_opened", 1, "openai")
+        elif event_name.endswith(".send_request_headers.complete"):
+            self.requests_sent += 1
+            tracer.count("requests_sent", 1, "openai")
+        elif event_name.endswith(".receive_response_headers.complete"):
+            span = tracer.current()
+            if span:
+                span.mark("time_to_first_byte")
+        elif event_name.endswith(".send_request_body.complete"):
+            span = tracer.current()
+            if span:
+                span.mark("request_sent")
+
+    def close(self):
+        if self.client:
+            self.client.close()
+
+    def send_message(self, prompt: str, model: str, context=None, timeout=None) -> str:
         if not self.client:
-            print("[OpenAIClient.send_message] Error: OpenAI client not available.")
-            return "Error: OpenAI client not available."
+            raise ChatError("OpenAI client not available.", provider="openai")
+        with tracer.span("request", "openai", model):
+            try:
+                raw = self.client.chat.completions.with_raw_response.create(
+                    model=model,
+                    messages=build_messages(prompt, context),
+                    timeout=timeout or REQUEST_TIMEOUT,
+                )
+            except self.openai.APIError as e:
+                raise openai_error(e) from e
+            self._observe_headers(raw.headers)
+            response = raw.parse()
+        tracer.usage("openai", model, response.usage)
+        return response.choices[0].message.content.strip()
+
+    def stream_message(self, prompt: str, model: str, context=None, timeout=None) -> ChatStream:
+        started = time.monotonic()
+
+        def deltas():
+            if not self.client:
+                raise ChatError("OpenAI client not available.", provider="openai")
+            with tracer.span("stream", "openai", model) as span:
+                try:
+                    raw = self.client.chat.completions.with_raw_response.create(
+                        model=model,
+                        messages=build_messages(prompt, context),
+                        stream=True,
+                        stream_options={"include_usage": True},
+                        timeout=timeout or REQUEST_TIMEOUT,
+                    )
+                    self._observe_headers(raw.headers)
+                    first = True
+                    with raw.parse() as chunks:
+                        # Only once the headers are in; the SDK doesn't expose the socket before
+                        network = chunks.response.extensions.get("network_stream")
+                        stream.attach_socket(network.get_extra_info("socket") if network else None)
+                        try:
+                            for chunk in chunks:
+                                if chunk.usage:
+                                    tracer.usage("openai", model, chunk.usage)
+                                    stream.usage = {"prompt_tokens": chunk.usage.prompt_tokens,
+                                                    "completion_tokens": chunk.usage.completion_tokens}
+                                if chunk.choices and chunk.choices[0].delta.content:
+                                    if first:
+                                        span.mark("time_to_first_token")
+                                        first = False
+                                    yield chunk.choices[0].delta.content
+                        finally:
+                            stream.attach_socket(None)
+                except self.openai.APIError as e:
+                    raise openai_error(e) from e
+
+        stream = ChatStream(deltas(), started)
+        return stream
+
+    def _observe_headers(self, headers):
+        if self.header_observer:
+            self.header_observer(headers)
+
+class OpenAIBatchClient:
+    # Bulk, non-interactive work through the OpenAI Batch API, billed at the
+    # batch discount. Prompts are streamed into JSONL input files no larger
+    # than the API allows, each file is submitted as a batch, and the results
+    # are streamed back line by line, so neither side is held in memory.
+    #
+    # Each request's custom_id is "<id>@<byte offset of its input line>", which
+    # lets a result find its prompt with one seek instead of a lookup table.
+    MAX_REQUESTS = 50000
+    MAX_BYTES = 190 * 1024 * 1024
+    TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+    def __init__(self, api_key: str, base_url=None, poll_interval=10.0, max_poll_interval=300.0):
+        openai = load_sdk("openai")
+        if not openai:
+            raise ChatError("OpenAI client not available.", provider="openai")
+        self.client = openai.OpenAI(api_key=api_key, base_url=base_url)
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+
+    def write_input_files(self, items, model, directory) -> list:
+        # items yields (id, prompt); returns the paths of the files written
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        f = None
+        count = size = 0
+        for item_id, prompt in items:
+            body = {"model": model, "messages": build_messages(prompt)}
+            # custom_id carries this line's offset, so pick the file first
+            estimate = len(json.dumps(body).encode("utf-8")) + 128
+            if f is None or count >= self.MAX_REQUESTS or size + estimate > self.MAX_BYTES:
+                if f:
+                    f.close()
+                paths.append(os.path.join(directory, f"batch_input_{len(paths):04d}.jsonl"))
+                f = open(paths[-1], "w", encoding="utf-8")
+                count = size = 0
+            line = json.dumps({
+                "custom_id": f"{item_id}@{size}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body,
+            })
+            f.write(line + "\n")
+            count += 1
+            size += len(line.encode("utf-8")) + 1
+        if f:
+            f.close()
+        return paths
+
+    def submit(self, path) -> str:
+        with open(path, "rb") as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata={"source": "murmur"},
+        )
+        print(f"[OpenAIBatchClient] Submitted {path} as batch {batch.id}")
+        return batch.id
+
+    def wait(self, batch_id, cancel_event=None):
+        # Polls until the batch finishes, backing off while it is running
+        interval = self.poll_interval
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in self.TERMINAL_STATUSES:
+                return batch
+            counts = batch.request_counts
+            if counts:
+                print(f"[OpenAIBatchClient] Batch {batch_id} {batch.status}: {counts.completed}/{counts.total}")
+            if cancel_event is not None:
+                if cancel_event.wait(interval):
+                    return batch
+            else:
+                time.sleep(interval)
+            interval = min(interval * 1.5, self.max_poll_interval)
+
+    def iter_results(self, batch, input_path):
+        # Yields history entries for a finished batch, successes and failures
+        with open(input_path, "rb") as inputs:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if not file_id:
+                    continue
+                with self.client.files.with_streaming_response.content(file_id) as response:
+                    for line in response.iter_lines():
+                        if line.strip():
+                            yield self._history_entry(json.loads(line), inputs, batch)
+
+    def run(self, items, model, directory, cancel_event=None):
+        # Write, submit, wait for and read back every chunk of items
+        for path in self.write_input_files(items, model, directory):
+            batch = self.wait(self.submit(path), cancel_event)
+            if batch.status != "completed":
+                print(f"[OpenAIBatchClient] Batch {batch.id} ended as {batch.status}")
+            yield from self.iter_results(batch, path)
+
+    def _history_entry(self, result, inputs, batch) -> dict:
+        item_id, offset = result["custom_id"].rsplit("@", 1)
+        inputs.seek(int(offset))
+        request = json.loads(inputs.readline())
+        entry = {
+            "prompt": request["body"]["messages"][-1]["content"],
+            "timestamp": datetime.now().isoformat(),
+            "provider": "openai",
+            "model": request["body"]["model"],
+            "batch_id": batch.id,
+            "batch_item": item_id,
+        }
+        response = result.get("response") or {}
+        body = response.get("body") or {}
+        if response.get("status_code") == 200 and body.get("choices"):
+            entry["response"] = body["choices"][0]["message"]["content"].strip()
+            entry["usage"] = body.get("usage")
+        else:
+            error = result.get("error") or body.get("error") or {}
+            entry["response"] = ""
+            entry["error"] = error.get("message", f"status {response.get('status_code')}")
+        return entry
+
+def claude_headers(api_key) -> dict:
+    return {"x-api-key": api_key, "anthropic-version": CLAUDE_API_VERSION}
+
+
+def claude_rate_limit_headers(headers) -> dict:
+    # Anthropic reports its request limit as anthropic-ratelimit-requests-*,
+    # with the reset as a timestamp; RateLimiter reads the OpenAI names
+    headers = dict(headers)
+    for part in ("limit", "remaining"):
+        value = headers.get(f"anthropic-ratelimit-requests-{part}")
+        if value is not None:
+            headers[f"x-ratelimit-{part}-requests"] = value
+    reset = headers.get("anthropic-ratelimit-requests-reset")
+    if reset:
         try:
-            print(f"[OpenAIClient.send_message] Preparing to call client.chat.completions.create with model '{model}'")
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": prompt}],
-                timeout=10,
-            )
-            print("[OpenAIClient.send_message] Successfully received response from OpenAI.")
-            return response.choices[0].message.content.strip()
-        except openai.APIConnectionError as e:
-            print(f"[OpenAIClient.send_message] OpenAI API Connection Error: {e}")
-            return f"[Error connecting to OpenAI API: {e}]"
-        except openai.APIStatusError as e:
-            # Use .response.json() for more detail if available, or .text
-            print(f"[OpenAIClient.send_message] OpenAI API Status Error: {e.status_code} - {e.response.text}")
-            return f"[Error from OpenAI API (Status {e.status_code}): {e.response.text}]"
-        except Exception as e:
-            print(f"[OpenAIClient.send_message] Generic Error during OpenAI chat: {e}")
-            return f"[Error from OpenAI: {e}]"
+            reset_at = datetime.fromisoformat(reset.replace("Z", "+00:00"))
+            seconds = (reset_at - datetime.now(timezone.utc)).total_seconds()
+            headers["x-ratelimit-reset-requests"] = str(max(seconds, 0.0))
+        except ValueError:
+            pass
+    return headers
+
 
 class ClaudeClient(ChatClient):
-    def send_message(self, prompt: str) -> str:
-        return "Claude response simulation (not implemented)"
+    # Anthropic Messages API over the shared transport
+    def __init__(self, api_key: str, base_url=None):
+        self.api_key = api_key
+        self.base_url = base_url or CLAUDE_BASE_URL
+        self.transport = HTTPTransport(self.base_url, claude_headers(api_key))
+
+    @property
+    def connections_opened(self):
+        return self.transport.connections_opened
+
+    @property
+    def requests_sent(self):
+        return self.transport.requests_sent
+
+    def close(self):
+        self.transport.close()
+
+    def _body(self, prompt, model, context, stream=False) -> dict:
+        # System messages go in their own field, not in the conversation
+        messages = build_messages(prompt, context)
+        system = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+        body = {
+            "model": model,
+            "max_tokens": CLAUDE_MAX_TOKENS,
+            "messages": [m for m in messages if m["role"] != "system"],
+        }
+        if system:
+            body["system"] = system
+        if stream:
+            body["stream"] = True
+        return body
+
+    def send_message(self, prompt: str, model: str, context=None, timeout=None) -> str:
+        with tracer.span("request", "claude", model):
+            response = self.transport.request_json(
+                "POST", "/v1/messages", self._body(prompt, model, context), "claude", self._observe_headers, timeout,
+            )
+        tracer.usage("claude", model, claude_usage(response.get("usage")))
+        return "".join(block.get("text", "") for block in response.get("content", []) if block.get("type") == "text").strip()
+
+    def stream_message(self, prompt: str, model: str, context=None, timeout=None) -> ChatStream:
+        started = time.monotonic()
+
+        def deltas():
+            usage = {}
+            with tracer.span("stream", "claude", model) as span:
+                first = True
+                events = self.transport.stream_events(
+                    "POST", "/v1/messages", self._body(prompt, model, context, stream=True), "claude",
+                    self._observe_headers, timeout, stream,
+                )
+                for event, data in events:
+                    if event == "ping":
+                        continue
+                    chunk = json.loads(data)
+                    kind = chunk.get("type", event)
+                    if kind == "content_block_delta" and chunk["delta"].get("type") == "text_delta":
+                        if first:
+                            span.mark("time_to_first_token")
+                            first = False
+                        yield chunk["delta"]["text"]
+                    elif kind == "message_start":
+                        usage.update(chunk["message"].get("usage") or {})
+                    elif kind == "message_delta":
+                        usage.update(chunk.get("usage") or {})
+                    elif kind == "error":
+                        # Errors after the 200, like overloaded_error mid-stream
+                        error = chunk.get("error") or {}
+                        status = 529 if error.get("type") == "overloaded_error" else 500
+                        raise ProviderError(f"Error from Claude API: {error.get('message', data)}", "claude", status)
+            stream.usage = claude_usage(usage)
+            tracer.usage("claude", model, stream.usage)
+
+        stream = ChatStream(deltas(), started)
+        return stream
+
+    def _observe_headers(self, headers):
+        if self.header_observer:
+            self.header_observer(claude_rate_limit_headers(headers))
+
+
+def claude_usage(usage):
+    if not usage:
+        return None
+    return {"prompt_tokens": usage.get("input_tokens"), "completion_tokens": usage.get("output_tokens")}
+
 
 class GeminiClient(ChatClient):
-    def send_message(self, prompt: str) -> str:
-        return "Gemini response simulation (not implemented)"
+    # Gemini generateContent API over the shared transport
+    def __init__(self, api_key: str, base_url=None):
+        self.api_key = api_key
+        self.base_url = base_url or GEMINI_BASE_URL
+        self.transport = HTTPTransport(self.base_url, {"x-goog-api-key": api_key})
+
+    @property
+    def connections_opened(self):
+        return self.transport.connections_opened
+
+    @property
+    def requests_sent(self):
+        return self.transport.requests_sent
+
+    def close(self):
+        self.transport.close()
+
+    def _body(self, prompt, model, context) -> dict:
+        # Gemini calls the assistant "model" and takes system text separately
+        messages = build_messages(prompt, context)
+        body = {"contents": [
+            {"role": "model" if m["role"] == "assistant" else "user", "parts": [{"text": m["content"]}]}
+            for m in messages if m["role"] != "system"
+        ]}
+        system = [{"text": m["content"]} for m in messages if m["role"] == "system"]
+        if system:
+            body["systemInstruction"] = {"parts": system}
+        return body
+
+    def send_message(self, prompt: str, model: str, context=None, timeout=None) -> str:
+        path = f"/models/{urllib.parse.quote(model)}:generateContent"
+        with tracer.span("request", "gemini", model):
+            response = self.transport.request_json(
+                "POST", path, self._body(prompt, model, context), "gemini", self._observe_headers, timeout,
+            )
+        tracer.usage("gemini", model, gemini_usage(response.get("usageMetadata")))
+        return gemini_text(response).strip()
+
+    def stream_message(self, prompt: str, model: str, context=None, timeout=None) -> ChatStream:
+        started = time.monotonic()
+        path = f"/models/{urllib.parse.quote(model)}:streamGenerateContent?alt=sse"
+
+        def deltas():
+            usage = None
+            with tracer.span("stream", "gemini", model) as span:
+                first = True
+                events = self.transport.stream_events(
+                    "POST", path, self._body(prompt, model, context), "gemini", self._observe_headers, timeout, stream,
+                )
+                for event, data in events:
+                    chunk = json.loads(data)
+                    # Each chunk carries the running totals; the last one counts
+                    usage = chunk.get("usageMetadata") or usage
+                    text = gemini_text(chunk)
+                    if text:
+                        if first:
+                            span.mark("time_to_first_token")
+                            first = False
+                        yield text
+            stream.usage = gemini_usage(usage)
+            tracer.usage("gemini", model, stream.usage)
+
+        stream = ChatStream(deltas(), started)
+        return stream
+
+    def _observe_headers(self, headers):
+        if self.header_observer:
+            self.header_observer(headers)
+
+
+def gemini_text(response) -> str:
+    blocked = (response.get("promptFeedback") or {}).get("blockReason")
+    if blocked:
+        raise ProviderError(f"Error from Gemini API: prompt blocked ({blocked})", "gemini", 400)
+    candidates = response.get("candidates") or []
+    if not candidates:
+        return ""
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts if not part.get("thought"))
+
+
+def gemini_usage(usage):
+    if not usage:
+        return None
+    return {"prompt_tokens": usage.get("promptTokenCount"), "completion_tokens": usage.get("candidatesTokenCount")}
+
+
+class Provider:
+    # Everything Murmur needs to know about one provider. Creating the client
+    # is what imports its SDK (if it has one), so unused providers cost nothing.
+    def __init__(self, name, title, create_client, list_models, model_filter, default_model, sdk=None):
+        self.name = name
+        self.title = title                  # as shown in the UI
+        self.create_client = create_client  # (api_key, base_url) -> ChatClient
+        self.list_models = list_models      # api_key -> [model id]
+        self.model_filter = model_filter    # model id -> whether it belongs in the dropdown
+        self.default_model = default_model  # shown when no listed model passes the filter
+        self.sdk = sdk                      # module name for load_sdk(), to warm it up early
+
+    def warm_up(self):
+        if self.sdk:
+            load_sdk(self.sdk)
+
+
+PROVIDERS = {}  # name -> Provider, in the order the UI lists them
+
+def register_provider(provider: Provider):
+    PROVIDERS[provider.name] = provider
+
+
+register_provider(Provider(
+    "openai", "OpenAI",
+    lambda api_key, base_url: OpenAIClient(api_key=api_key, base_url=base_url),
+    get_openai_models,
+    lambda m: "gpt" in m and not any(x in m for x in ["tts", "image", "embedding", "dall-e", "whisper"]),
+    "gpt-3.5-turbo",
+    sdk="openai",
+))
+register_provider(Provider(
+    "claude", "Claude",
+    lambda api_key, base_url: ClaudeClient(api_key=api_key, base_url=base_url),
+    get_claude_models,
+    lambda m: m.startswith("claude-"),
+    "claude-sonnet-4",
+))
+register_provider(Provider(
+    "gemini", "Gemini",
+    lambda api_key, base_url: GeminiClient(api_key=api_key, base_url=base_url),
+    get_gemini_models,
+    lambda m: m.startswith("gemini-"),
+    "gemini-2.5-flash",
+))
+
+def cache_key(provider, model, messages, params=None) -> str:
+    # Hash of the request with formatting noise removed, so the same question
+    # hits the cache however it was typed or ordered
+    normalized = {
+        "provider": provider.lower(),
+        "model": model,
+        "messages": [
+            {"role": m["role"], "content": " ".join(m["content"].split())}
+            for m in messages
+        ],
+        "params": params or {},
+    }
+    blob = json.dumps(normalized, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    # Exact-match response cache: an in-memory LRU in front of a size-bounded
+    # directory of one JSON file per entry. Every entry carries its own expiry.
+    def __init__(self, path=RESPONSE_CACHE_DIR, ttl=RESPONSE_CACHE_TTL, max_entries=256, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()  # key -> (expires_at, response)
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        # Disk entries in least-recently-used order, with their sizes
+        files = []
+        for entry in os.scandir(path):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-5], stat.st_size))
+        self.disk = OrderedDict((key, size) for _, key, size in sorted(files))
+        self.disk_bytes = sum(self.disk.values())
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            cached = self.memory.get(key)
+            if cached and cached[0] > now:
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return cached[1]
+            if key in self.disk:
+                try:
+                    with open(self._file(key), "r", encoding="utf-8") as f:
+                        cached = json.load(f)
+                except (OSError, ValueError):
+                    cached = None
+                if cached and cached["expires_at"] > now:
+                    self.disk.move_to_end(key)
+                    os.utime(self._file(key))
+                    self._remember(key, cached["expires_at"], cached["response"])
+                    self.stats["disk_hits"] += 1
+                    return cached["response"]
+                self._drop(key)
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, response, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        blob = json.dumps({"expires_at": expires_at, "response": response})
+        with self._lock:
+            self._remember(key, expires_at, response)
+            tmp_path = f"{self._file(key)}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(blob)
+            os.replace(tmp_path, self._file(key))
+            self.disk_bytes += len(blob) - self.disk.pop(key, 0)
+            self.disk[key] = len(blob)
+            self.stats["stores"] += 1
+            while self.disk_bytes > self.max_bytes and len(self.disk) > 1:
+                self._drop(next(iter(self.disk)))
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            for key in list(self.disk):
+                self._drop(key)
+            self.memory.clear()
+
+    def _remember(self, key, expires_at, response):
+        self.memory[key] = (expires_at, response)
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _drop(self, key):
+        self.memory.pop(key, None)
+        self.disk_bytes -= self.disk.pop(key, 0)
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.json")
+
+
+def hashed_embedding(texts, dimensions=SEMANTIC_DIMENSIONS):
+    # Offline stand-in for an embedding model: words and word pairs hashed
+    # into a signed bag of features. It catches rewordings that share most of
+    # their words, not paraphrases; pass a real model's embed function to
+    # SemanticCache for those.
+    numpy = load_sdk("numpy")
+    rows, columns, signs = [], [], []
+    for row, text in enumerate(texts):
+        words = re.findall(r"\w+", text.lower())
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            h = zlib.crc32(feature.encode("utf-8"))
+            rows.append(row)
+            columns.append(h % dimensions)
+            signs.append(1.0 if h & 0x80000000 else -1.0)
+    vectors = numpy.zeros((len(texts), dimensions), dtype=numpy.float32)
+    numpy.add.at(vectors, (rows, columns), signs)
+    return vectors
+
+
+class SemanticCache:
+    # Near-duplicate prompt cache. Prompt embeddings live in one float32
+    # matrix, memory-mapped from vectors.f32 and grown by doubling; metadata
+    # and responses live in SQLite. A lookup is one matrix-vector product over
+    # every row, masked to live entries in the same scope (provider and model,
+    # plus the earlier conversation, so a follow-up in another chat doesn't
+    # match), then the best score against threshold. Freed rows are reused;
+    # past max_entries the least recently used entry is evicted.
+    #
+    # scope is "model" (default), "provider" (answers shared across a
+    # provider's models) or "any". embed(list of str) -> (n, d) array.
+    # Needs numpy; without it every lookup misses.
+    def __init__(self, path=SEMANTIC_CACHE_DIR, threshold=SEMANTIC_THRESHOLD, ttl=RESPONSE_CACHE_TTL,
+                 max_entries=SEMANTIC_MAX_ENTRIES, scope="model", embed=None):
+        self.path = path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.scope = scope
+        self.embed = embed or hashed_embedding
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self.numpy = numpy = load_sdk("numpy")
+        self._lock = threading.Lock()
+        if not numpy:
+            print("Semantic cache disabled: numpy not installed.")
+            return
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, "entries.sqlite"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries (row INTEGER PRIMARY KEY, scope TEXT, prompt TEXT, "
+            "response TEXT, expires_at REAL, last_used REAL)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        # The matrix file is only valid with the dimensions it was written at
+        dimensions = len(self.embed(["dimensions"])[0])
+        stored = self.db.execute("SELECT value FROM meta WHERE key = 'dimensions'").fetchone()
+        if stored and stored[0] != dimensions:
+            print("Semantic cache: embedding size changed, starting over")
+            with self.db:
+                self.db.execute("DELETE FROM entries")
+            if os.path.exists(self._vectors_path()):
+                os.remove(self._vectors_path())
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('dimensions', ?)", (dimensions,))
+        self.dimensions = dimensions
+        self.vectors = None
+        self.capacity = 0
+        self.scopes = None
+        self._open_vectors()
+
+        # Each distinct scope gets a small id for the scopes array; the id is
+        # taken back with the scope's last row, so the per-conversation scopes
+        # go away with their entries instead of piling up
+        self.scope_ids = {}   # scope -> id
+        self.scope_keys = {}  # id -> scope
+        self.scope_rows = {}  # id -> live rows
+        self.free_scope_ids = []
+        rows = self.db.execute("SELECT row, scope, expires_at, last_used FROM entries").fetchall()
+        self.count = max((row for row, *_ in rows), default=-1) + 1  # rows in use or freed
+        self._ensure_capacity(self.count)
+        self.scopes = numpy.full(self.capacity, -1, dtype=numpy.int32)  # -1 marks a free row
+        self.expires = numpy.zeros(self.capacity, dtype=numpy.float64)
+        self.last_used = numpy.zeros(self.capacity, dtype=numpy.float64)
+        for row, scope, expires_at, last_used in rows:
+            self.scopes[row] = self._claim_scope(scope)
+            self.expires[row] = expires_at
+            self.last_used[row] = last_used
+        self.free = [row for row in range(self.count) if self.scopes[row] < 0]
+
+    def get(self, provider, model, prompt, context=None):
+        if not self.numpy:
+            return None
+        query = self._normalized(self.embed([prompt])[0])
+        with self._lock:
+            scope_id = self.scope_ids.get(self._scope(provider, model, context))
+            if scope_id is None or not self.count:
+                self.stats["misses"] += 1
+                return None
+            n = self.count
+            scores = self.vectors[:n] @ query
+            live = (self.scopes[:n] == scope_id) & (self.expires[:n] > time.time())
+            scores[~live] = -1.0
+            row = int(scores.argmax())
+            if scores[row] < self.threshold:
+                self.stats["misses"] += 1
+                return None
+            self.last_used[row] = time.time()
+            self.stats["hits"] += 1
+            with self.db:
+                self.db.execute("UPDATE entries SET last_used = ? WHERE row = ?", (self.last_used[row], row))
+                cached = self.db.execute("SELECT response FROM entries WHERE row = ?", (row,)).fetchone()
+        return cached[0] if cached else None
+
+    def put(self, provider, model, prompt, response, context=None, ttl=None):
+        if not self.numpy:
+            return
+        vector = self._normalized(self.embed([prompt])[0])
+        scope = self._scope(provider, model, context)
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            row = self._allocate(now)
+            self.vectors[row] = vector
+            self.scopes[row] = self._claim_scope(scope)
+            self.expires[row] = expires_at
+            self.last_used[row] = now
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                    (row, scope, prompt, response, expires_at, now),
+                )
+            self.stats["stores"] += 1
+
+    def __len__(self):
+        if not self.numpy:
+            return 0
+        return int((self.scopes[:self.count] >= 0).sum())
+
+    def clear(self):
+        if not self.numpy:
+            return
+        with self._lock:
+            with self.db:
+                self.db.execute("DELETE FROM entries")
+            self.scopes[:] = -1
+            self.count = 0
+            self.free = []
+            self.scope_ids, self.scope_keys, self.scope_rows = {}, {}, {}
+            self.free_scope_ids = []
+
+    def close(self):
+        if not self.numpy:
+            return
+        with self._lock:
+            self.vectors.flush()
+            self.db.close()
+
+    def _allocate(self, now) -> int:
+        # Expired rows are freed on the way; the LRU entry goes when full
+        live = self.scopes[:self.count] >= 0
+        expired = self.numpy.flatnonzero(live & (self.expires[:self.count] <= now))
+        if len(expired):
+            self._release(expired)
+        if len(self) >= self.max_entries:
+            used = self.numpy.where(self.scopes[:self.count] >= 0, self.last_used[:self.count], self.numpy.inf)
+            self._release([int(used.argmin())])
+            self.stats["evictions"] += 1
+        if self.free:
+            return self.free.pop()
+        self._ensure_capacity(self.count + 1)
+        self.count += 1
+        return self.count - 1
+
+    def _release(self, rows):
+        rows = [int(row) for row in rows]
+        for scope_id in self.scopes[rows].tolist():
+            self.scope_rows[scope_id] -= 1
+            if not self.scope_rows[scope_id]:
+                del self.scope_rows[scope_id]
+                del self.scope_ids[self.scope_keys.pop(scope_id)]
+                self.free_scope_ids.append(scope_id)
+        self.scopes[rows] = -1
+        self.free.extend(rows)
+        with self.db:
+            self.db.executemany("DELETE FROM entries WHERE row = ?", [(row,) for row in rows])
+
+    def _ensure_capacity(self, needed):
+        if needed <= self.capacity:
+            return
+        capacity = max(1024, self.capacity)
+        while capacity < needed:
+            capacity *= 2
+        self.vectors.flush()
+        self.vectors = None
+        with open(self._vectors_path(), "r+b") as f:
+            f.truncate(capacity * self.dimensions * 4)
+        self._open_vectors()
+        if self.scopes is not None:
+            grow = capacity - len(self.scopes)
+            self.scopes = self.numpy.concatenate([self.scopes, self.numpy.full(grow, -1, dtype=self.numpy.int32)])
+            self.expires = self.numpy.concatenate([self.expires, self.numpy.zeros(grow)])
+            self.last_used = self.numpy.concatenate([self.last_used, self.numpy.zeros(grow)])
+
+    def _open_vectors(self):
+        path = self._vectors_path()
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as f:
+                f.truncate(1024 * self.dimensions * 4)
+        self.capacity = os.path.getsize(path) // (self.dimensions * 4)
+        self.vectors = self.numpy.memmap(path, dtype=self.numpy.float32, mode="r+", shape=(self.capacity, self.dimensions))
+
+    def _vectors_path(self):
+        return os.path.join(self.path, "vectors.f32")
+
+    def _normalized(self, vector):
+        vector = self.numpy.asarray(vector, dtype=self.numpy.float32)
+        norm = float(self.numpy.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def _scope(self, provider, model, context) -> str:
+        if self.scope != "model":
+            model = ""
+        if self.scope == "any":
+            provider = ""
+        return cache_key(provider, model, list(context or []))
+
+    def _claim_scope(self, scope) -> int:
+        # The id for one more row in scope
+        scope_id = self.scope_ids.get(scope)
+        if scope_id is None:
+            scope_id = self.free_scope_ids.pop() if self.free_scope_ids else len(self.scope_ids)
+            self.scope_ids[scope] = scope_id
+            self.scope_keys[scope_id] = scope
+            self.scope_rows[scope_id] = 0
+        self.scope_rows[scope_id] += 1
+        return scope_id
+
+
+class CachedChatClient(ChatClient):
+    # Wraps a provider client so identical requests are answered from a
+    # ResponseCache, and near-identical ones from an optional SemanticCache.
+    # Pass bypass_cache=True to force a fresh answer (which still refreshes
+    # the caches). Failed requests raise, so are never cached.
+    def __init__(self, client, provider, cache, semantic=None):
+        self.client = client
+        self.provider = provider
+        self.cache = cache
+        self.semantic = semantic
+
+    @property
+    def connections_opened(self):
+        return self.client.connections_opened
+
+    @property
+    def requests_sent(self):
+        return self.client.requests_sent
+
+    def close(self):
+        self.client.close()
+
+    def _key(self, prompt, model, context):
+        return cache_key(self.provider, model, build_messages(prompt, context))
+
+    def _lookup(self, key, bypass_cache, prompt, model, context):
+        if bypass_cache:
+            if self.cache:
+                with self.cache._lock:
+                    self.cache.stats["bypassed"] += 1
+            return None
+        cached = self.cache.get(key) if self.cache else None
+        if self.cache:
+            tracer.count("response_cache_hits" if cached is not None else "response_cache_misses", 1, self.provider, model)
+        if cached is None and self.semantic is not None:
+            with tracer.span("semantic_lookup", self.provider, model):
+                cached = self.semantic.get(self.provider, model, prompt, context)
+            tracer.count("semantic_cache_hits" if cached is not None else "semantic_cache_misses", 1, self.provider, model)
+        return cached
+
+    def _store(self, key, response, prompt, model, context):
+        if self.cache:
+            self.cache.put(key, response)
+        if self.semantic is not None:
+            self.semantic.put(self.provider, model, prompt, response, context)
+
+    def send_message(self, prompt: str, model: str, context=None, timeout=None, bypass_cache=False) -> str:
+        key = self._key(prompt, model, context)
+        cached = self._lookup(key, bypass_cache, prompt, model, context)
+        if cached is not None:
+            return cached
+        response = self.client.send_message(prompt=prompt, model=model, context=context, timeout=timeout)
+        self._store(key, response, prompt, model, context)
+        return response
+
+    def stream_message(self, prompt: str, model: str, context=None, timeout=None, bypass_cache=False) -> ChatStream:
+        key = self._key(prompt, model, context)
+        cached = self._lookup(key, bypass_cache, prompt, model, context)
+        if cached is not None:
+            hit = ChatStream(iter([cached]))
+            hit.cached = True
+            return hit
+        stream = self.client.stream_message(prompt=prompt, model=model, context=context, timeout=timeout)
+
+        def deltas():
+            try:
+                yield from stream
+            finally:
+                stream.close()
+            # Only reached when the stream ran to the end, not when cancelled
+            wrapped.usage = stream.usage
+            self._store(key, stream.text.strip(), prompt, model, context)
+
+        wrapped = ChatStream(deltas(), stream.started)
+        wrapped.source = stream
+        return wrapped
+
+
+def count_tokens(text: str) -> int:
+    encoding = _token_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1  # close enough for English without tiktoken
+
+
+_encoding = None
+
+def _token_encoding():
+    global _encoding
+    if _encoding is None:
+        tiktoken = load_sdk("tiktoken")
+        _encoding = tiktoken.get_encoding("o200k_base") if tiktoken else False
+    return _encoding
+
+
+def context_window(model: str) -> int:
+    for prefix, window in MODEL_CONTEXT_WINDOWS:
+        if model.startswith(prefix):
+            return window
+    return 4000
+
+
+class ContextBuilder:
+    # The running conversation as a window of recent turns that fits a token
+    # budget. Each message is counted once when it is added, and turns only
+    # ever leave from the front, so a send costs O(new messages).
+    #
+    # Turns that fall out of the window wait in `evicted`; if a summarizer is
+    # set, summarize_evicted() folds them into a cached summary that is sent
+    # ahead of the window as a system message.
+    MESSAGE_OVERHEAD = 4  # tokens of role/formatting per message
+
+    def __init__(self, budget=CONTEXT_BUDGET, summarizer=None, reply_reserve=CONTEXT_REPLY_RESERVE):
+        self.budget = budget
+        self.summarizer = summarizer  # summarizer(previous_summary, messages) -> str
+        self.reply_reserve = reply_reserve
+        self.turns = deque()  # (message, tokens)
+        self.tokens = 0
+        self.evicted = []
+        self.summary = ""
+        self.summary_tokens = 0
+        self._lock = threading.Lock()
+        self._summary_lock = threading.Lock()
+
+    def add(self, role, content):
+        message = {"role": role, "content": content}
+        tokens = count_tokens(content) + self.MESSAGE_OVERHEAD
+        with self._lock:
+            self.turns.append((message, tokens))
+            self.tokens += tokens
+
+    def add_turn(self, prompt, response):
+        self.add("user", prompt)
+        self.add("assistant", response)
+
+    def build(self, model, prompt) -> list:
+        # Messages to send ahead of the prompt for this model
+        prompt_tokens = count_tokens(prompt) + self.MESSAGE_OVERHEAD
+        with self._lock:
+            budget = min(self.budget, context_window(model) - self.reply_reserve) - prompt_tokens
+            budget -= self.summary_tokens
+            if self.tokens > budget:
+                # Trim to three quarters of the budget so evictions, and summary
+                # refreshes, happen in batches rather than on every send
+                target = max(budget * 3 // 4, 0)
+                while self.turns and self.tokens > target:
+                    message, tokens = self.turns.popleft()
+                    self.tokens -= tokens
+                    self.evicted.append(message)
+                # Never start the window on an assistant reply
+                while self.turns and self.turns[0][0]["role"] == "assistant":
+                    message, tokens = self.turns.popleft()
+                    self.tokens -= tokens
+                    self.evicted.append(message)
+            if not self.summarizer:
+                self.evicted.clear()
+            messages = [message for message, _ in self.turns]
+            if self.summary:
+                messages.insert(0, {"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"})
+        return messages
+
+    def summarize_evicted(self):
+        with self._summary_lock:
+            with self._lock:
+                if not self.summarizer or not self.evicted:
+                    return
+                evicted, self.evicted = self.evicted, []
+                previous = self.summary
+            try:
+                summary = self.summarizer(previous, evicted)
+            except ChatError as e:
+                print(f"[ContextBuilder] Summary failed: {e}")
+                with self._lock:
+                    self.evicted[:0] = evicted  # try again with the next batch
+                return
+            if not summary:
+                return
+            with self._lock:
+                self.summary = summary
+                self.summary_tokens = count_tokens(summary) + self.MESSAGE_OVERHEAD
+
+    def clear(self):
+        with self._lock:
+            self.turns.clear()
+            self.tokens = 0
+            self.evicted = []
+            self.summary = ""
+            self.summary_tokens = 0
+
+
+class ChatRequest:
+    # A prompt submitted to ChatService. The future resolves to the response
+    # text; cancel() drops a queued request or stops a running one between deltas.
+    def __init__(self, request_id, provider, model, prompt, bypass_cache=False, context=None):
+        self.id = request_id
+        self.provider = provider
+        self.model = model
+        self.prompt = prompt
+        self.bypass_cache = bypass_cache
+        self.context = context
+        self.future = None
+        self.stream = None
+        self.error = None
+        self.started_at = None
+        self.attempts = 0
+        self.latency = None  # seconds from starting to finishing, once done
+        self.fan_out = None
+        self.flight = None
+        self.on_delta = None
+        self.coalesced = False  # attached to an identical request already in flight
+        self.cancel_event = threading.Event()
+        self._text = None  # what had arrived when it was cancelled
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    @property
+    def succeeded(self) -> bool:
+        return bool(self.done() and not self.error and not self.cancelled and self.response)
+
+    @property
+    def response(self) -> str:
+        if self._text is not None:
+            return self._text.strip()
+        return self.stream.text.strip() if self.stream else ""
+
+    def cancel(self):
+        # Others sharing the flight may keep streaming; this one stops here
+        if self.stream and self._text is None:
+            self._text = self.stream.text
+        self.cancel_event.set()
+        if self.future:
+            self.future.cancel()
+        if self.flight:
+            self.flight.detach(self)
+
+    def done(self) -> bool:
+        return bool(self.future and self.future.done())
+
+
+class Flight:
+    # One provider call shared by every identical ChatRequest submitted while
+    # it runs. Each request keeps its own future and callbacks; the call is
+    # only cancelled once all of them have been.
+    def __init__(self, key):
+        self.key = key
+        self.requests = []
+        self.stream = None
+        self.delivered = 0  # deltas of stream sent to subscribers; parts may already hold the next one
+        self.attempts = 0
+        self.started_at = None
+        self.future = None
+        self.cancel_event = threading.Event()
+        self._lock = threading.RLock()  # held while deltas go out, so joiners replay in order
+
+    def join(self, request, dispatch) -> bool:
+        # False once the call has been cancelled; the request needs its own
+        with self._lock:
+            if self.cancel_event.is_set():
+                return False
+            self.requests.append(request)
+            request.flight = self
+            request.stream = self.stream
+            request.attempts = self.attempts
+            request.started_at = time.monotonic() if self.started_at is not None else None
+            if self.stream and request.on_delta:
+                for delta in self.stream.parts[:self.delivered]:
+                    dispatch(request.on_delta, request, delta)
+            return True
+
+    def start(self):
+        with self._lock:
+            self.started_at = time.monotonic()
+            for request in self.requests:
+                request.started_at = self.started_at
+
+    def detach(self, request):
+        with self._lock:
+            if not all(other.cancelled for other in self.requests):
+                return
+            self.cancel_event.set()
+        if self.future:
+            self.future.cancel()
+
+    def deliver(self, delta, dispatch):
+        with self._lock:
+            self.delivered += 1
+            for request in self.requests:
+                if request.on_delta and not request.cancelled:
+                    dispatch(request.on_delta, request, delta)
+
+    def restart(self, stream):
+        with self._lock:
+            self.stream = stream
+            self.delivered = 0
+            self.attempts += 1
+            for request in self.requests:
+                if not request.cancelled:
+                    request.stream = stream
+                    request.attempts = self.attempts
+
+
+class FanOut:
+    # One prompt sent to several (provider, model) targets at once. requests
+    # are in target order, results in the order they finished. With
+    # first_wins, the first good answer cancels the rest.
+    def __init__(self, prompt, first_wins=False):
+        self.prompt = prompt
+        self.first_wins = first_wins
+        self.requests = []
+        self.results = []
+        self.winner = None
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        for request in self.requests:
+            request.cancel()
+
+    def done(self) -> bool:
+        return all(request.done() for request in self.requests)
+
+    @property
+    def best(self):
+        # The winner, else the first good answer, else whatever finished first
+        if self.winner:
+            return self.winner
+        good = [request for request in self.results if request.succeeded]
+        return (good or self.results or [None])[0]
+
 
 class ChatService:
-    def __init__(self, provider, api_key=""):
+    def __init__(self, provider, api_key="", max_workers=4, dispatch=None, api_keys=None, base_urls=None,
+                 response_cache=None, context=None, max_retries=4, semantic_cache=None, hedge=False,
+                 hedge_ratio=HEDGE_RATIO, usage_ledger=None):
         self.provider = provider
         self.api_key = api_key
+        self.api_keys = dict(api_keys or {})
+        self.base_urls = dict(base_urls or {})
+        self.response_cache = response_cache  # opt-in ResponseCache
+        self.semantic_cache = semantic_cache  # opt-in SemanticCache, checked after the exact one
+        self.context = context  # ContextBuilder for multi-turn conversations, or None
+        self.usage_ledger = usage_ledger  # UsageLedger that each provider call is recorded in, or None
+        self.last_target = (provider, "")
+        # Clients are pooled by (provider, api_key, base_url) so sends reuse
+        # keep-alive connections. Clients replaced while a request is still
+        # using them are retired and closed once that request finishes.
+        self.clients = {}
+        self.pool_stats = {"clients_created": 0, "clients_reused": 0, "clients_closed": 0}
+        self._leases = {}
+        self._retired = set()
+        self._closed_connections = 0
+        self._closed_requests = 0
+        self._constructions = SingleFlight()
+        self._generation = 0  # bumped by close_clients, so a client built across it isn't pooled
+        # Requests run on the scheduler's worker threads, interactive ones
+        # first, and wait on a per-provider rate limiter before each attempt.
+        # Callbacks go through dispatch so the UI can hop back onto its main
+        # thread (calls inline by default).
+        self.scheduler = RequestScheduler(max_workers)
+        self.rate_limiters = {}
+        self.max_retries = max_retries
+        # Timeouts follow each model's own latency. With hedge on, a stream
+        # with no first token by the model's p95 gets a duplicate request,
+        # and whichever answers first is used; the other is aborted.
+        self.latency = LatencyTracker()
+        self.hedge = hedge
+        self.hedge_budget = HedgeBudget(hedge_ratio)
+        self.hedge_stats = {"hedged": 0, "hedge_won": 0, "timeouts": 0}
+        self.dispatch = dispatch or (lambda fn, *args: fn(*args))
+        self.in_flight = {}
+        self.flights = {}  # request key -> Flight, while the call runs
+        self._request_ids = itertools.count(1)
+        self._lock = threading.Lock()
 
-    def get_client(self, provider: str) -> ChatClient:
-        if provider.lower() == "openai":
-            return OpenAIClient(api_key=self.api_key)
-        elif provider.lower() == "claude":
-            return ClaudeClient()
-        elif provider.lower() == "gemini":
-            return GeminiClient()
+    def submit(self, provider, model, prompt, on_delta=None, on_done=None, bypass_cache=False,
+               priority=INTERACTIVE) -> ChatRequest:
+        # A request identical to one already in flight (a double-clicked Send,
+        # a duplicate batch row) attaches to it instead of calling again
+        context = self.context.build(model, prompt) if self.context else None
+        self.last_target = (provider, model)
+        request = ChatRequest(next(self._request_ids), provider, model, prompt, bypass_cache, context)
+        request.on_delta = on_delta
+        request.future = Future()
+        key = cache_key(provider, model, build_messages(prompt, context), {"bypass_cache": True} if bypass_cache else None)
+        with self._lock:
+            self.in_flight[request.id] = request
+            flight = self.flights.get(key)
+            request.coalesced = flight is not None and flight.join(request, self.dispatch)
+            if not request.coalesced:
+                flight = self.flights[key] = Flight(key)
+                flight.join(request, self.dispatch)
+        request.future.add_done_callback(lambda future: self._finished(request, on_done))
+        if not request.coalesced:
+            flight.future = self.scheduler.submit(self._run, flight, priority=priority)
+            flight.future.add_done_callback(lambda future: self._flight_done(flight))
         else:
-            raise ValueError("Unsupported provider")
\ No newline at end of file
+            tracer.count("coalesced_requests", 1, provider, model)
+        return request
+
+    def fan_out(self, prompt, targets, on_delta=None, on_result=None, on_done=None, first_wins=False,
+                priority=INTERACTIVE) -> FanOut:
+        # Sends prompt to every (provider, model) in targets concurrently.
+        # on_result(fan_out, request) fires as each one finishes, on_done(fan_out)
+        # once all have.
+        fan_out = FanOut(prompt, first_wins)
+
+        def finished(request):
+            with fan_out._lock:
+                fan_out.results.append(request)
+                won = first_wins and fan_out.winner is None and request.succeeded
+                if won:
+                    fan_out.winner = request
+                all_done = len(fan_out.results) == len(targets)
+            if won:
+                for other in fan_out.requests:
+                    if other is not request:
+                        other.cancel()
+            if on_result:
+                on_result(fan_out, request)
+            if all_done and on_done:
+                on_done(fan_out)
+
+        for provider, model in targets:
+            request = self.submit(provider, model, prompt, on_delta=on_delta, on_done=finished, priority=priority)
+            request.fan_out = fan_out
+            with fan_out._lock:
+                fan_out.requests.append(request)
+                if fan_out.winner:
+                    request.cancel()
+        return fan_out
+
+    def cancel_all(self):
+        with self._lock:
+            requests = list(self.in_flight.values())
+        for request in requests:
+            request.cancel()
+
+    def shutdown(self):
+        self.cancel_all()
+        self.scheduler.shutdown()
+        self.close_clients()
+
+    def record_turn(self, prompt, response):
+        # Adds a finished exchange to the conversation; call in the order sent
+        if not self.context:
+            return
+        self.context.add_turn(prompt, response)
+        if self.context.summarizer and self.context.evicted:
+            self.scheduler.submit(self.context.summarize_evicted, priority=BACKGROUND)
+
+    def summarizer(self):
+        # A ContextBuilder summarizer that asks the most recently used model
+        def summarize(previous, messages):
+            provider, model = self.last_target
+            transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+            prompt = (
+                "Summarize this conversation in a few sentences, keeping names, facts and decisions.\n\n"
+                f"Earlier summary: {previous or '(none)'}\n\n{transcript}"
+            )
+            client = self.get_client(provider, lease=True)
+            try:
+                return client.send_message(prompt=prompt, model=model)
+            finally:
+                self.release_client(client)
+        return summarize
+
+    def update_api_keys(self, api_keys):
+        # Called when settings are saved; clients for changed keys are dropped
+        self.api_keys = dict(api_keys)
+        if self.provider in self.api_keys:
+            self.api_key = self.api_keys[self.provider]
+        with self._lock:
+            stale = [key for key in self.clients if self.api_keys.get(key[0], key[1]) != key[1]]
+        self.close_clients(stale)
+
+    def settings_changed(self, changes):
+        # Subscribed to the Settings store, so saved keys and limits apply
+        # without rebuilding the service
+        keys = {name: changes[f"api_key_{name}"] for name in PROVIDERS if f"api_key_{name}" in changes}
+        if keys:
+            self.update_api_keys(dict(self.api_keys, **keys))
+        if "context_budget" in changes and self.context:
+            self.context.budget = changes["context_budget"]
+        if "max_retries" in changes:
+            self.max_retries = changes["max_retries"]
+        if "hedge_requests" in changes:
+            self.hedge = bool(changes["hedge_requests"])
+
+    def set_semantic_cache(self, cache):
+        # Pooled clients were wrapped without it; they are rebuilt on next use
+        self.semantic_cache = cache
+        self.close_clients()
+
+    def close_clients(self, keys=None):
+        with self._lock:
+            self._generation += 1
+            keys = list(self.clients) if keys is None else keys
+            clients = [self.clients.pop(key) for key in keys if key in self.clients]
+            self._retired.update(clients)
+            idle = [client for client in clients if not self._leases.get(client)]
+        for client in idle:
+            self._close_client(client)
+
+    def connection_stats(self) -> dict:
+        with self._lock:
+            clients = set(self.clients.values()) | self._retired
+            opened = self._closed_connections + sum(c.connections_opened for c in clients)
+            sent = self._closed_requests + sum(c.requests_sent for c in clients)
+        return dict(self.pool_stats, connections_opened=opened, requests_sent=sent,
+                    connections_reused=max(sent - opened, 0))
+
+    def _close_client(self, client):
+        with self._lock:
+            if client not in self._retired:
+                return
+            self._retired.discard(client)
+            self._leases.pop(client, None)
+            self._closed_connections += client.connections_opened
+            self._closed_requests += client.requests_sent
+            self.pool_stats["clients_closed"] += 1
+        client.close()
+
+    def rate_limiter(self, provider) -> RateLimiter:
+        limiter = self.rate_limiters.get(provider)
+        if limiter is None:
+            limiter = self.rate_limiters.setdefault(provider, RateLimiter())
+        return limiter
+
+    def _run(self, flight):
+        if flight.cancel_event.is_set():
+            return ""
+        flight.start()
+        request = flight.requests[0]
+        client = self.get_client(request.provider, lease=True)
+        limiter = self.rate_limiter(request.provider.lower())
+        try:
+            options = {"bypass_cache": True} if request.bypass_cache and isinstance(client, CachedChatClient) else {}
+            for attempt in itertools.count():
+                if not limiter.acquire(flight.cancel_event):
+                    break
+                timeout = self.latency.deadline(request.provider, request.model)
+                stream = self._open_stream(client, limiter, request, timeout, options)
+                flight.restart(stream)
+                try:
+                    for delta in stream:
+                        if flight.cancel_event.is_set():
+                            break
+                        flight.deliver(delta, self.dispatch)
+                    else:
+                        self.latency.observe(request.provider, request.model,
+                                             stream.time_to_first_token, stream.total_time)
+                    break
+                except ChatError as e:
+                    if isinstance(e, ChatTimeoutError) and not stream.parts:
+                        self.latency.observe(request.provider, request.model, first_token=timeout)
+                        with self._lock:
+                            self.hedge_stats["timeouts"] += 1
+                    limiter.update(e.headers)
+                    if isinstance(e, RateLimitError) and e.retry_after:
+                        limiter.pause(e.retry_after)
+                    # Once part of the answer has been shown a retry would repeat it
+                    if not e.retryable or stream.parts or attempt >= self.max_retries:
+                        raise
+                    delay = max(backoff_delay(attempt), e.retry_after or 0)
+                    print(f"[ChatService] Request {request.id} attempt {attempt + 1} failed ({e}), retrying in {delay:.1f} s")
+                    if flight.cancel_event.wait(delay):
+                        break
+                finally:
+                    stream.close()
+        finally:
+            self.release_client(client)
+        return flight.stream.text.strip() if flight.stream else ""
+
+    def _open_stream(self, client, limiter, request, timeout, options) -> ChatStream:
+        def open_one():
+            return client.stream_message(
+                prompt=request.prompt, model=request.model, context=request.context, timeout=timeout, **options
+            )
+
+        hedge_after = self.latency.percentile(request.provider, request.model, 0.95) if self.hedge else None
+        if hedge_after is None:
+            return open_one()
+        self.hedge_budget.earn()
+        started = time.monotonic()
+
+        def deltas():
+            # Each stream is read on its own thread into one queue; the first
+            # to produce text wins and the other is aborted on the spot
+            results = queue.Queue()
+            stopped = [threading.Event(), threading.Event()]
+            opened = [None, None]
+            sent = [False, False]
+
+            def pump(index):
+                stream = None
+                try:
+                    stream = opened[index] = open_one()
+                    # Streams are lazy; one that lost before this point never calls out
+                    if stopped[index].is_set():
+                        return
+                    sent[index] = True
+                    for delta in stream:
+                        if stopped[index].is_set():
+                            return
+                        if delta:
+                            results.put((index, delta))
+                    results.put((index, None))
+                except Exception as e:
+                    results.put((index, e))
+                finally:
+                    if stream:
+                        stream.close()
+
+            def start(index):
+                threading.Thread(target=pump, args=(index,), name="murmur-hedge", daemon=True).start()
+
+            start(0)
+            streams = 1
+            ended = 0           # streams that finished or failed before any text
+            hedge_decided = False
+            winner = None
+            error = None
+            try:
+                while True:
+                    wait = None
+                    if not hedge_decided and winner is None:
+                        wait = max(hedge_after - (time.monotonic() - started), 0)
+                    try:
+                        index, item = results.get(timeout=wait)
+                    except queue.Empty:
+                        hedge_decided = True
+                        if self.hedge_budget.spend():
+                            if limiter.try_acquire():
+                                start(1)
+                                streams = 2
+                                with self._lock:
+                                    self.hedge_stats["hedged"] += 1
+                                tracer.count("hedged_requests", 1, request.provider, request.model)
+                            else:
+                                self.hedge_budget.refund()
+                        continue
+                    if winner is None:
+                        if item is None or isinstance(item, Exception):
+                            # One stream failing only matters if the other does too
+                            ended += 1
+                            error = item if isinstance(item, Exception) else error
+                            if ended < streams:
+                                continue
+                            if error:
+                                raise error
+                            return
+                        winner = index
+                        stopped[1 - index].set()
+                        if opened[1 - index]:
+                            opened[1 - index].abort()
+                        if index == 1:
+                            with self._lock:
+                                self.hedge_stats["hedge_won"] += 1
+                    if index != winner:
+                        continue
+                    if item is None:
+                        hedged.usage = opened[index].usage
+                        hedged.cached = opened[index].cached
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                for index, stream in enumerate(opened):
+                    stopped[index].set()
+                    if stream:
+                        stream.abort()
+                # Both copies were billed; the usage ledger records the loser too
+                primary = winner if winner is not None else 0
+                hedged.hedges = [opened[i] for i in range(streams) if i != primary and sent[i]]
+
+        hedged = ChatStream(deltas(), started)
+        return hedged
+
+    def _flight_done(self, flight):
+        # Later identical requests start a new call from here on
+        with self._lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+        if self.usage_ledger and not flight.future.cancelled() and not flight.cancel_event.is_set():
+            self._record_usage(flight)
+        with flight._lock:
+            requests = list(flight.requests)
+        for request in requests:
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            if flight.future.cancelled():
+                request.future.set_result("")
+            elif flight.future.exception():
+                request.future.set_exception(flight.future.exception())
+            else:
+                request.future.set_result(flight.future.result())
+
+    def _record_usage(self, flight):
+        # One ledger entry per provider call, however many requests shared it.
+        # Cache hits cost nothing and say nothing about the model, so are left out.
+        stream = flight.stream
+        if stream is None or stream.cached or flight.started_at is None:
+            return
+        request = flight.requests[0]
+        error = flight.future.exception()
+        usage = stream.usage or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+        if error is None:
+            # Without a usage report from the provider, count the text ourselves
+            if prompt_tokens is None:
+                prompt_tokens = sum(count_tokens(m["content"]) for m in build_messages(request.prompt, request.context))
+            if completion_tokens is None:
+                completion_tokens = count_tokens(stream.text)
+        latency = stream.total_time if stream.total_time is not None else time.monotonic() - stream.started
+        self.usage_ledger.record(
+            request.provider.lower(), request.model, prompt_tokens or 0, completion_tokens or 0,
+            latency, stream.time_to_first_token, type(error).__name__ if error else None,
+        )
+        # The losing copy of a hedged request was billed for the prompt and
+        # whatever it produced before it was aborted
+        for loser in stream.hedges:
+            usage = loser.usage or {}
+            prompt_tokens = usage.get("prompt_tokens")
+            if prompt_tokens is None:
+                prompt_tokens = sum(count_tokens(m["content"]) for m in build_messages(request.prompt, request.context))
+            completion_tokens = usage.get("completion_tokens")
+            if completion_tokens is None:
+                completion_tokens = count_tokens(loser.text) if loser.parts else 0
+            self.usage_ledger.record(
+                request.provider.lower(), request.model, prompt_tokens, completion_tokens,
+                time.monotonic() - loser.started, hedge=True,
+            )
+
+    def _finished(self, request, on_done):
+        with self._lock:
+            self.in_flight.pop(request.id, None)
+        if request.started_at is not None:
+            request.latency = time.monotonic() - request.started_at
+            tracer.record("service_request", request.latency, request.provider, request.model)
+        if not request.future.cancelled() and request.future.exception():
+            request.error = request.future.exception()
+            print(f"[ChatService] Request {request.id} failed: {request.error}")
+        if on_done:
+            self.dispatch(on_done, request)
+
+    def get_client(self, provider: str, lease=False) -> ChatClient:
+        # With lease, the client is held until release_client, so close_clients
+        # retires it instead of closing it under a request about to use it
+        provider = provider.lower()
+        if provider not in PROVIDERS:
+            raise ValueError("Unsupported provider")
+        while True:
+            api_key = self.api_keys.get(provider, self.api_key)
+            key = (provider, api_key, self.base_urls.get(provider))
+            with self._lock:
+                client = self.clients.get(key)
+                if client:
+                    self.pool_stats["clients_reused"] += 1
+                    if lease:
+                        self._leases[client] = self._leases.get(client, 0) + 1
+                    return client
+            # Building a client may import its SDK, most of a second for openai,
+            # so it happens outside the lock: submit and cancel_all on the main
+            # thread never wait for it. Threads that miss together share one build.
+            client = self._constructions.run(key, self._build_client, provider, key)
+            with self._lock:
+                # Not pooled if close_clients ran meanwhile; then build again
+                if client is not None and self.clients.get(key) is client:
+                    if lease:
+                        self._leases[client] = self._leases.get(client, 0) + 1
+                    return client
+
+    def _build_client(self, provider, key):
+        # Pools the new client and returns it, or closes it and returns None
+        # if close_clients ran during the build: it may have been built with
+        # what close_clients was replacing, and nobody has it yet
+        with self._lock:
+            generation = self._generation
+        with tracer.span("client_construct", provider):
+            client = PROVIDERS[provider].create_client(key[1], key[2])
+        client.header_observer = self.rate_limiter(provider).update
+        # `is not None`: an empty SemanticCache has len 0
+        if self.response_cache is not None or self.semantic_cache is not None:
+            client = CachedChatClient(client, provider, self.response_cache, self.semantic_cache)
+        with self._lock:
+            if generation == self._generation and key not in self.clients:
+                self.clients[key] = client
+                self.pool_stats["clients_created"] += 1
+                return client
+            self._retired.add(client)
+        self._close_client(client)
+        return None
+
+    def release_client(self, client):
+        with self._lock:
+            self._leases[client] -= 1
+            idle = not self._leases[client]
+        if idle:
+            self._close_client(client)
@@ -0,0 +1,305 @@
+# batch.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# Headless batch runner: pushes a JSONL file of prompts through ChatService
+#
+#   python batch.py prompts.jsonl results.jsonl --model gpt-4o-mini --concurrency 8
+#
+# Each input line is {"prompt": ...} with optional "id", "provider" and "model".
+# Results are appended to the output as they finish, one JSON object per line.
+# Running the same command again skips every id that already has a response,
+# so an interrupted run picks up where it left off.
+#
+# With --batch-api the prompts go through the OpenAI Batch API instead: cheaper
+# and slower (results within 24 hours). Submitted batch ids are kept in
+# <output>.batches.json, so running the command again waits on the same batches
+# rather than submitting new ones.
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from datetime import datetime
+
+from backend import ChatService, OpenAIBatchClient, PROVIDERS, BACKGROUND
+from settings import settings
+from usage import UsageLedger
+
+
+def load_api_keys(provider, api_key=None) -> dict:
+    # --api-key for the chosen provider, then $<PROVIDER>_API_KEY, then the
+    # keys saved in Murmur's preferences
+    keys = {name: os.environ.get(f"{name.upper()}_API_KEY", "") for name in PROVIDERS}
+    if api_key:
+        keys[provider] = api_key
+    if not all(keys.values()):
+        saved = settings.api_keys(PROVIDERS)
+        for name in PROVIDERS:
+            keys[name] = keys[name] or saved[name]
+    return keys
+
+
+def read_prompts(path, provider, model):
+    # A line that isn't a prompt comes back with "invalid" saying why, so it
+    # is reported as that item's error instead of ending the run
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                item = {"invalid": f"Not valid JSON - {e}"}
+            if isinstance(item, str):
+                item = {"prompt": item}
+            if not isinstance(item, dict):
+                item = {"invalid": "Expected a JSON object or string"}
+            elif "invalid" not in item and not isinstance(item.get("prompt"), str):
+                item["invalid"] = "No prompt"
+            item.setdefault("id", line_number)
+            item.setdefault("provider", provider)
+            item.setdefault("model", model)
+            yield item
+
+
+def completed_ids(path) -> set:
+    # The output file is the checkpoint: ids that already have a response
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # a torn last line from an interrupted run
+            if "response" in result:
+                done.add(str(result["id"]))
+    return done
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def load_state(path) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def run_batch_api(args, done) -> int:
+    client = OpenAIBatchClient(load_api_keys("openai", args.api_key)["openai"], base_url=args.base_url)
+    state_path = f"{args.output}.batches.json"
+    state = load_state(state_path)
+    invalid = []
+    if not state:
+        def items():
+            for item in read_prompts(args.input, "openai", args.model):
+                if str(item["id"]) in done:
+                    continue
+                if "invalid" in item:
+                    invalid.append(item)
+                    continue
+                yield item["id"], item["prompt"]
+
+        paths = client.write_input_files(items(), args.model, f"{args.output}.batches")
+        state = {path: None for path in paths}
+        save_state(state_path, state)
+    else:
+        print(f"Resuming {len(state)} batch input files from {state_path}", file=sys.stderr)
+
+    history = None
+    if args.to_history:
+        from history import HistoryStore
+        history = HistoryStore().open()
+
+    failed = len(invalid)
+    try:
+        with open(args.output, "a", encoding="utf-8") as output:
+            for item in invalid:
+                output.write(json.dumps({"id": item["id"], "error": item["invalid"]}) + "\n")
+            for path, batch_id in state.items():
+                if batch_id == "done":
+                    continue
+                if batch_id is None:
+                    batch_id = state[path] = client.submit(path)
+                    save_state(state_path, state)
+                batch = client.wait(batch_id)
+                print(f"Batch {batch_id} {batch.status}", file=sys.stderr)
+                for entry in client.iter_results(batch, path):
+                    result = {
+                        "id": entry["batch_item"],
+                        "prompt": entry["prompt"],
+                        "provider": "openai",
+                        "model": entry["model"],
+                        "batch_id": batch_id,
+                        "timestamp": entry["timestamp"],
+                    }
+                    if "error" in entry:
+                        result["error"] = entry["error"]
+                        failed += 1
+                    else:
+                        result["response"] = entry["response"]
+                        if history:
+                            history.append(entry)
+                    output.write(json.dumps(result) + "\n")
+                output.flush()
+                state[path] = "done"
+                save_state(state_path, state)
+    except KeyboardInterrupt:
+        print("Interrupted; submitted batches keep running, run again to collect them", file=sys.stderr)
+        return 1
+    finally:
+        if history:
+            history.close()
+    return 1 if failed else 0
+
+
+class BatchRun:
+    def __init__(self, service, output, concurrency):
+        self.service = service
+        self.output = output
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.completed = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    def submit(self, item):
+        # Blocks while `concurrency` requests are already in flight, so the
+        # input is read no faster than it can be sent
+        if "invalid" in item:
+            self.write(self.result(item, error=item["invalid"]))
+            return
+        self.slots.acquire()
+        try:
+            self.service.submit(
+                item["provider"], item["model"], item["prompt"],
+                on_done=lambda request: self.finished(item, request),
+                priority=BACKGROUND,
+            )
+        except Exception as e:
+            self.slots.release()
+            self.write(self.result(item, error=f"{type(e).__name__}: {e}"))
+
+    def finished(self, item, request):
+        result = self.result(item, latency=request.latency, attempts=request.attempts)
+        if request.error or request.cancelled:
+            result["error"] = str(request.error or "cancelled")
+        else:
+            result["response"] = request.response
+        self.write(result)
+        self.slots.release()
+
+    def result(self, item, **fields) -> dict:
+        result = {
+            "id": item["id"],
+            "prompt": item.get("prompt"),
+            "provider": item.get("provider"),
+            "model": item.get("model"),
+        }
+        result.update(fields)
+        result["timestamp"] = datetime.now().isoformat()
+        return result
+
+    def write(self, result):
+        with self.lock:
+            self.output.write(json.dumps(result) + "\n")
+            self.output.flush()
+            if "error" in result:
+                self.failed += 1
+            else:
+                self.completed += 1
+                self.latencies.append(result["latency"])
+            finished = self.completed + self.failed
+        if finished % 100 == 0:
+            self.report()
+
+    def wait(self, concurrency):
+        for _ in range(concurrency):
+            self.slots.acquire()
+
+    def report(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            done = self.completed + self.failed
+            p50 = percentile(self.latencies, 0.50)
+            p95 = percentile(self.latencies, 0.95)
+        print(
+            f"{done} done ({self.failed} failed) in {elapsed:.1f} s, "
+            f"{done / elapsed if elapsed else 0:.2f} items/s, "
+            f"latency p50 {p50 or 0:.2f} s p95 {p95 or 0:.2f} s",
+            file=sys.stderr,
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through Murmur's ChatService.")
+    parser.add_argument("input", help="JSONL file of prompts")
+    parser.add_argument("output", help="JSONL file to append results to")
+    parser.add_argument("--provider", default="openai")
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight at once")
+    parser.add_argument("--api-key", help="defaults to $<PROVIDER>_API_KEY, then Murmur's preferences")
+    parser.add_argument("--base-url", help="override the provider's API endpoint")
+    parser.add_argument("--batch-api", action="store_true", help="use the OpenAI Batch API (results within 24 h)")
+    parser.add_argument("--to-history", action="store_true", help="with --batch-api, also add results to Murmur's history")
+    args = parser.parse_args(argv)
+
+    done = completed_ids(args.output)
+    if done:
+        print(f"Resuming: {len(done)} prompts already have results", file=sys.stderr)
+    if args.batch_api:
+        if args.provider != "openai":
+            parser.error("--batch-api only works with --provider openai")
+        return run_batch_api(args, done)
+
+    # Batch calls go in the app's usage ledger too, so its report covers them
+    ledger = UsageLedger()
+    service = ChatService(
+        args.provider,
+        api_keys=load_api_keys(args.provider, args.api_key),
+        base_urls={args.provider: args.base_url} if args.base_url else None,
+        max_workers=args.concurrency,
+        usage_ledger=ledger,
+    )
+
+    with open(args.output, "a", encoding="utf-8") as output:
+        run = BatchRun(service, output, args.concurrency)
+        try:
+            for item in read_prompts(args.input, args.provider, args.model):
+                if str(item["id"]) not in done:
+                    run.submit(item)
+            run.wait(args.concurrency)
+        except KeyboardInterrupt:
+            print("Interrupted; run again to resume", file=sys.stderr)
+            service.cancel_all()
+        finally:
+            service.shutdown()
+            ledger.close()
+            run.report()
+    return 1 if run.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
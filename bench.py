@@ -0,0 +1,615 @@
+# bench.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# Benchmarks for Murmur's own overhead, run against mockserver.py so provider
+# latency stays out of the numbers
+#
+#   python bench.py --output bench.json
+#   python bench.py --output new.json --compare bench.json
+#
+# Every timing is reported in milliseconds as count/mean/p50/p95/p99/min/max,
+# under stable keys, so two result files can be diffed or fed to --compare.
+
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import threading
+import tracemalloc
+from datetime import datetime, timedelta
+
+import backend
+from backend import ChatService
+from export import export_history, import_history
+from history import HistoryStore, HistorySearchIndex
+from mockserver import MockServer
+from tracing import Tracer, tracer
+from transcript import TranscriptBuffer
+from usage import UsageLedger
+
+
+HISTORY_SIZES = (1000, 10000, 100000)
+ARCHIVE_SIZE = 100000
+ARCHIVE_MONTHS = 36  # how far back the synthetic archive history reaches
+SEMANTIC_SIZE = 100000
+USAGE_SIZE = 100000
+
+
+def stats(samples) -> dict:
+    # Seconds in, milliseconds out
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(fraction):
+        return round(ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] * 1000, 4)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 4),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "min": round(ordered[0] * 1000, 4),
+        "max": round(ordered[-1] * 1000, 4),
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_get_client(service, iterations) -> dict:
+    samples = [timed(service.get_client, "openai")[0] for _ in range(iterations)]
+    return stats(samples)
+
+
+def bench_send(service, iterations, stream=False) -> dict:
+    samples = []
+    first_token = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        client = service.get_client("openai")
+        if stream:
+            parts = client.stream_message(f"benchmark prompt {i}", "gpt-4o-mini")
+            for n, _ in enumerate(parts):
+                if n == 0:
+                    first_token.append(time.perf_counter() - start)
+        else:
+            client.send_message(f"benchmark prompt {i}", "gpt-4o-mini")
+        samples.append(time.perf_counter() - start)
+    result = {"latency": stats(samples)}
+    if stream:
+        result["time_to_first_token"] = stats(first_token)
+    return result
+
+
+def bench_throughput(service, iterations, concurrency) -> dict:
+    # Requests per second with `concurrency` threads sharing one pooled client
+    samples = []
+    lock = threading.Lock()
+    counter = iter(range(iterations))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            elapsed, _ = timed(service.get_client("openai").send_message, f"benchmark prompt {i}", "gpt-4o-mini")
+            with lock:
+                samples.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests_per_second": round(iterations / elapsed, 2),
+        "latency": stats(samples),
+    }
+
+
+def bench_service_retries(service, iterations) -> dict:
+    # End to end through the scheduler against a server that fails some requests
+    done = threading.Semaphore(0)
+    requests = [
+        service.submit("openai", "gpt-4o-mini", f"benchmark prompt {i}", on_done=lambda _: done.release())
+        for i in range(iterations)
+    ]
+    for _ in requests:
+        done.acquire()
+    return {
+        "latency": stats([r.latency for r in requests if r.latency is not None]),
+        "succeeded": sum(1 for r in requests if r.succeeded),
+        "attempts": sum(r.attempts for r in requests),
+    }
+
+
+def bench_coalescing(service, server, iterations) -> dict:
+    # Bursts of identical prompts, as from a double-clicked Send; each burst
+    # should cost one call to the server
+    done = threading.Semaphore(0)
+    before = server.counts["completions"]
+    requests = [
+        service.submit("openai", "gpt-4o-mini", f"duplicate prompt {i // 4}", on_done=lambda _: done.release())
+        for i in range(iterations * 4)
+    ]
+    for _ in requests:
+        done.acquire()
+    return {
+        "requests": len(requests),
+        "coalesced": sum(1 for r in requests if r.coalesced),
+        "server_calls": server.counts["completions"] - before,
+    }
+
+
+def bench_hedging(iterations, latency, hedge) -> dict:
+    # One request at a time against a server where 3% of requests stall for
+    # half a second; with hedging the stalls should leave the p99
+    server = MockServer(latency=latency, slow_rate=0.03, slow_latency=0.5).start()
+    service = ChatService("openai", api_keys={"openai": "sk-benchmark"}, base_urls={"openai": server.url},
+                          hedge=hedge, hedge_ratio=0.1)
+    try:
+        samples = []
+        for i in range(iterations):
+            request = service.submit("openai", "gpt-4o-mini", f"benchmark prompt {i}")
+            request.future.result()
+            samples.append(request.latency)
+        return dict(latency=stats(samples), server_calls=server.counts["completions"],
+                    stalls=server.counts["slow"], **service.hedge_stats)
+    finally:
+        service.shutdown()
+        server.stop()
+
+
+def bench_models(url, iterations) -> dict:
+    # get_openai_models builds its own client, so point it at the mock by env
+    previous = os.environ.get("OPENAI_BASE_URL")
+    os.environ["OPENAI_BASE_URL"] = url
+    try:
+        samples = [timed(backend.get_openai_models, "sk-benchmark")[0] for _ in range(iterations)]
+    finally:
+        if previous is None:
+            os.environ.pop("OPENAI_BASE_URL", None)
+        else:
+            os.environ["OPENAI_BASE_URL"] = previous
+    return stats(samples)
+
+
+def bench_import(module, iterations=5) -> dict:
+    # Fresh interpreter each time, so nothing is already imported
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    samples = []
+    for _ in range(iterations):
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        samples.append(float(result.stdout.strip().splitlines()[-1]))
+    return stats(samples)
+
+
+def bench_transcript(messages=2000, deltas=50) -> dict:
+    # A session of streamed replies through TranscriptBuffer, with the view
+    # update (take_edits) after every few deltas, against rebuilding the
+    # whole transcript string per message the way setString_ used to
+    buffer = TranscriptBuffer(max_length=200000)
+    samples = []
+    edits = 0
+    start = time.perf_counter()
+    for i in range(messages):
+        begin = time.perf_counter()
+        buffer.append(f"\nYou: benchmark prompt {i}\nMurmur: ")
+        segment = buffer.open_segment()
+        buffer.append("\n")
+        for d in range(deltas):
+            buffer.insert(segment, "token ")
+            if d % 5 == 4:
+                edits += len(buffer.take_edits())
+        buffer.close(segment)
+        edits += len(buffer.take_edits())
+        samples.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+
+    naive = ""
+    start = time.perf_counter()
+    for i in range(messages):
+        naive = f"{naive}\nYou: benchmark prompt {i}\nMurmur: {'token ' * deltas}\n"
+    naive_elapsed = time.perf_counter() - start
+    return {
+        "messages": messages,
+        "per_message": stats(samples),
+        "total_ms": round(elapsed * 1000, 2),
+        "edits": edits,
+        "rebuild_total_ms": round(naive_elapsed * 1000, 2),
+        "final_length": buffer.length,
+    }
+
+
+def bench_tracing(iterations=100000) -> dict:
+    # Cost of one span, off and on, in nanoseconds
+    result = {}
+    for name, enabled in (("off", False), ("on", True)):
+        local = Tracer(enabled=enabled)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            with local.span("bench", "openai", "gpt-4o-mini") as span:
+                span.mark("mark")
+        result[f"span_{name}_ns"] = round((time.perf_counter() - start) / iterations * 1e9, 1)
+    return result
+
+
+def vocabulary(size=5000) -> list:
+    # Made-up words with a skewed frequency, so search terms aren't all common
+    letters = "etaoinshrdlcumwfgypbvk"
+    return ["".join(random.choice(letters) for _ in range(random.randint(3, 9))) for _ in range(size)]
+
+
+def history_entry(i, words) -> dict:
+    def text(length):
+        return " ".join(words[int(random.paretovariate(1.2)) % len(words)] for _ in range(length))
+
+    return {
+        "prompt": f"{text(12)} {i}",
+        "response": text(80),
+        "timestamp": datetime.now().isoformat(),
+        "provider": "openai",
+        "model": "gpt-4o-mini",
+    }
+
+
+def bench_history(size, directory) -> dict:
+    path = os.path.join(directory, f"history_{size}.jsonl")
+    store = HistoryStore(path, os.path.join(directory, "none.json")).open()
+    words = vocabulary()
+    save = []
+    for i in range(size):
+        entry = history_entry(i, words)
+        save.append(timed(store.append, entry)[0])
+    store.close()
+
+    warm_open, store = timed(HistoryStore(path, "").open)
+    store.close()
+    os.remove(f"{path}.idx")
+    cold_open, store = timed(HistoryStore(path, "").open)
+
+    rows = random.sample(range(size), min(size, 1000))
+    summaries = [timed(store.summary, row)[0] for row in rows]
+    reads = [timed(store.__getitem__, row)[0] for row in rows]
+    store.close()
+
+    index = HistorySearchIndex(os.path.join(directory, f"search_{size}.sqlite"))
+    index_time, _ = timed(index.catch_up, store.open())
+    searches = [timed(index.search, query)[0] for query in (words[0], words[1] + " " + words[2][:3], words[3][:2], " ".join(words[100:103]))]
+    index.close()
+    store.close()
+
+    return {
+        "entries": size,
+        "file_bytes": os.path.getsize(path),
+        "append": stats(save),
+        "open_with_index_ms": round(warm_open * 1000, 4),
+        "open_rebuilding_index_ms": round(cold_open * 1000, 4),
+        "summary": stats(summaries),
+        "read_entry": stats(reads),
+        "search_catch_up_ms": round(index_time * 1000, 4),
+        "search": stats(searches),
+    }
+
+
+def bench_semantic_cache(size, directory) -> dict:
+    # Lookup cost with size entries in one scope (the worst case: every row
+    # is compared), using the built-in offline embedding
+    if not backend.load_sdk("numpy"):
+        return {"skipped": "numpy not installed"}
+    words = vocabulary()
+    cache = backend.SemanticCache(os.path.join(directory, "semantic"))
+
+    def prompt():
+        return " ".join(random.choice(words) for _ in range(12))
+
+    stored = [prompt() for _ in range(size)]
+    fill_time = 0.0
+    for text in stored:
+        fill_time += timed(cache.put, "openai", "gpt-4o-mini", text, "cached answer")[0]
+    misses = [timed(cache.get, "openai", "gpt-4o-mini", prompt())[0] for _ in range(200)]
+    hits = [timed(cache.get, "openai", "gpt-4o-mini", text.upper())[0] for text in random.sample(stored, 200)]
+    results = {
+        "entries": len(cache),
+        "put": {"mean": round(fill_time / size * 1000, 4)},
+        "lookup_miss": stats(misses),
+        "lookup_hit": stats(hits),
+        "stats": dict(cache.stats),
+    }
+    cache.close()
+    return results
+
+
+def bench_usage_ledger(size, directory) -> dict:
+    # Recording cost, and what reopening, ranking and the daily report cost
+    # with size requests spread over 20 models and 90 days
+    path = os.path.join(directory, "usage.jsonl")
+    stats_path = os.path.join(directory, "usage_stats.json")
+    models = [f"model-{i}" for i in range(20)]
+    now = time.time()
+    ledger = UsageLedger(path, stats_path)
+    record_time = 0.0
+    for i in range(size):
+        record_time += timed(
+            ledger.record, "openai", random.choice(models), random.randint(10, 2000), random.randint(10, 1000),
+            random.uniform(0.5, 10), random.uniform(0.1, 1), None, now - (size - i) * 90 * 86400 / size,
+        )[0]
+    ledger.close()
+    reopened = UsageLedger(path, stats_path)
+    reopen_time = timed(lambda: reopened.stats)[0]
+    rank = [timed(reopened.rank, "openai", models)[0] for _ in range(200)]
+    os.remove(stats_path)
+    replayed = UsageLedger(path, stats_path)
+    replay_time = timed(lambda: replayed.stats)[0]
+    (report_time, rows), _, report_peak = allocated(timed, reopened.daily_report, 30)
+    return {
+        "entries": size,
+        "ledger_bytes": os.path.getsize(path),
+        "record": {"mean": round(record_time / size * 1000, 4)},
+        "reopen_ms": round(reopen_time * 1000, 2),
+        "replay_ms": round(replay_time * 1000, 2),
+        "rank": stats(rank),
+        "daily_report_ms": round(report_time * 1000, 2),
+        "daily_report_rows": len(rows),
+        "daily_report_peak_bytes": report_peak,
+    }
+
+
+def allocated(fn, *args):
+    # Bytes still allocated after fn returns (what its result keeps alive)
+    # and at the peak while it ran
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = fn(*args)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current - before, peak - before
+
+
+def directory_bytes(path) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def bench_archive(size, directory) -> dict:
+    # Disk and memory for the same history kept three ways: the old single
+    # JSON document, one flat JSON Lines file, and sealed monthly segments
+    words = vocabulary()
+    now = datetime.now()
+    span = timedelta(days=ARCHIVE_MONTHS * 30)
+    legacy_path = os.path.join(directory, "archive_legacy.json")
+    path = os.path.join(directory, "archive.jsonl")
+    entries = []
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(size):
+            entry = history_entry(i, words)
+            entry["timestamp"] = (now - span + span * i / size).isoformat()
+            f.write(json.dumps(entry) + "\n")
+            entries.append(entry)
+    with open(legacy_path, "w", encoding="utf-8") as f:
+        json.dump(entries, f)
+    del entries
+
+    def load_legacy():
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def reads(store):
+        rows = random.sample(range(len(store)), min(len(store), 1000))
+        return {"summary": stats([timed(store.summary, row)[0] for row in rows]),
+                "read_entry": stats([timed(store.__getitem__, row)[0] for row in rows])}
+
+    results = {"entries": size, "months": ARCHIVE_MONTHS}
+    load_time, _ = timed(load_legacy)
+    _, retained, peak = allocated(load_legacy)
+    results["legacy_json"] = {"disk_bytes": os.path.getsize(legacy_path), "load_ms": round(load_time * 1000, 4),
+                              "memory_retained_bytes": retained, "memory_peak_bytes": peak}
+
+    HistoryStore(path, "", seal=False).open().close()  # builds the .idx
+    open_time, store = timed(HistoryStore(path, "", seal=False).open)
+    store.close()
+    store, retained, peak = allocated(HistoryStore(path, "", seal=False).open)
+    results["flat_jsonl"] = dict(disk_bytes=directory_bytes(path) + directory_bytes(f"{path}.idx"),
+                                 open_ms=round(open_time * 1000, 4), memory_retained_bytes=retained,
+                                 memory_peak_bytes=peak, **reads(store))
+    store.close()
+
+    seal_time, store = timed(HistoryStore(path, "").open)
+    store.close()
+    open_time, store = timed(HistoryStore(path, "").open)
+    store.close()
+    store, retained, peak = allocated(HistoryStore(path, "").open)
+    usage = store.disk_usage()
+    results["segmented"] = dict(disk_bytes=usage["active_bytes"] + usage["archive_bytes"], segments=usage["segments"],
+                                seal_ms=round(seal_time * 1000, 4), open_ms=round(open_time * 1000, 4),
+                                memory_retained_bytes=retained, memory_peak_bytes=peak, **reads(store))
+
+    # Export streams the segments out, import streams a file back in; peak
+    # memory should not grow with the history
+    results["export"] = {}
+    for format, extension in (("jsonl", ".jsonl"), ("markdown", ".md"), ("csv", ".csv")):
+        export_path = os.path.join(directory, f"archive_export{extension}")
+        export_time, count = timed(export_history, store, export_path)
+        results["export"][format] = {"entries": count, "bytes": os.path.getsize(export_path),
+                                     "ms": round(export_time * 1000, 4)}
+    _, _, peak = allocated(export_history, store, os.path.join(directory, "archive_export.md"))
+    results["export"]["markdown"]["memory_peak_bytes"] = peak
+    store.close()
+    imported = HistoryStore(os.path.join(directory, "archive_import.jsonl"), "", seal=False).open()
+    import_time, count = timed(import_history, imported, os.path.join(directory, "archive_export.jsonl"))
+    imported.close()
+    os.remove(imported.path)
+    os.remove(imported.index_path)
+    shutil.rmtree(imported.archive_dir, ignore_errors=True)
+    imported = HistoryStore(imported.path, "", seal=False).open()
+    _, _, peak = allocated(import_history, imported, os.path.join(directory, "archive_export.md"))
+    imported.close()
+    results["import"] = {"entries": count, "ms": round(import_time * 1000, 4), "memory_peak_bytes": peak}
+    return results
+
+
+def compare(results, baseline, prefix=""):
+    # Print every timing that moved by more than 10% against a previous run
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict):
+            compare(value, old or {}, f"{name}.")
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            change = (value - old) / old
+            if abs(change) >= 0.10 and key not in ("count", "entries", "concurrency"):
+                print(f"{name}: {old} -> {value} ({change:+.0%})", file=sys.stderr)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run(args) -> dict:
+    results = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "mock_latency": args.latency,
+            "mock_token_delay": args.token_delay,
+            "tracing": args.trace,
+        },
+        "tracing": bench_tracing(),
+        "import_backend": bench_import("backend"),
+        "transcript": bench_transcript(),
+    }
+    tracer.enable(args.trace)
+
+    server = MockServer(latency=args.latency, token_delay=args.token_delay).start()
+    service = ChatService("openai", api_keys={"openai": "sk-benchmark"}, base_urls={"openai": server.url})
+    try:
+        print("chat client...", file=sys.stderr)
+        results["get_client"] = bench_get_client(service, args.iterations * 10)
+        results["send_message"] = bench_send(service, args.iterations)
+        results["stream_message"] = bench_send(service, args.iterations, stream=True)
+        results["throughput"] = bench_throughput(service, args.iterations, args.concurrency)
+        results["coalescing"] = bench_coalescing(service, server, args.iterations)
+        results["connections"] = service.connection_stats()
+        print("model list...", file=sys.stderr)
+        results["get_openai_models"] = bench_models(server.url, max(args.iterations // 10, 10))
+    finally:
+        service.shutdown()
+        server.stop()
+
+    server = MockServer(latency=args.latency, error_rate=args.error_rate, error_status=503).start()
+    service = ChatService("openai", api_keys={"openai": "sk-benchmark"}, base_urls={"openai": server.url})
+    try:
+        print("retries...", file=sys.stderr)
+        results["service_with_errors"] = dict(
+            bench_service_retries(service, args.iterations),
+            error_rate=args.error_rate,
+            errors_injected=server.counts["errors"],
+        )
+    finally:
+        service.shutdown()
+        server.stop()
+
+    print("hedging...", file=sys.stderr)
+    results["hedging"] = {
+        "off": bench_hedging(args.iterations, args.latency, hedge=False),
+        "on": bench_hedging(args.iterations, args.latency, hedge=True),
+    }
+
+    directory = tempfile.mkdtemp(prefix="murmur-bench-")
+    try:
+        results["history"] = {}
+        for size in args.history_sizes:
+            print(f"history {size}...", file=sys.stderr)
+            results["history"][str(size)] = bench_history(size, directory)
+        if args.semantic_size:
+            print(f"semantic cache {args.semantic_size}...", file=sys.stderr)
+            results["semantic_cache"] = bench_semantic_cache(args.semantic_size, directory)
+        if args.archive_size:
+            print(f"history archive {args.archive_size}...", file=sys.stderr)
+            results["history_archive"] = bench_archive(args.archive_size, directory)
+        if args.usage_size:
+            print(f"usage ledger {args.usage_size}...", file=sys.stderr)
+            results["usage_ledger"] = bench_usage_ledger(args.usage_size, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.trace:
+        results["trace"] = tracer.snapshot()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Murmur against a local mock API.")
+    parser.add_argument("--output", help="write results here as JSON (default: stdout)")
+    parser.add_argument("--compare", help="a previous results file to compare against")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.0, help="mock delay before the first byte")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="mock delay between streamed words")
+    parser.add_argument("--error-rate", type=float, default=0.1, help="mock error share for the retry benchmark")
+    parser.add_argument("--history-sizes", type=int, nargs="*", default=list(HISTORY_SIZES))
+    parser.add_argument("--archive-size", type=int, default=ARCHIVE_SIZE,
+                        help="entries in the synthetic history for the archive disk and memory check (0 to skip)")
+    parser.add_argument("--semantic-size", type=int, default=SEMANTIC_SIZE,
+                        help="entries in the semantic cache lookup benchmark (0 to skip)")
+    parser.add_argument("--usage-size", type=int, default=USAGE_SIZE,
+                        help="requests in the usage ledger benchmark (0 to skip)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", action="store_true", help="run with tracing on and include its snapshot")
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    # The backend logs with print(); keep that out of the JSON on stdout
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = run(args)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        results.pop("meta")
+        compare(results, baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,628 @@
+# export.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# Streaming export and import of chat history
+#
+#   python export.py export history.md --since 2025-01 --search "sqlite"
+#   python export.py import conversations.zip
+#
+# Both directions are chains of generators: the store (or the file being
+# imported) yields one entry at a time, the filters pass it on or drop it,
+# and the writer turns it into a few lines of text. Nothing holds more than
+# one entry, except the import's sort: other apps write conversations in
+# whatever order they like, and the store seals entries by month, so imports
+# are sorted in runs of RUN_BYTES that spill to temporary files and are merged
+# back, then go into the store's sealed segments by period (or the active file
+# for this month's). Exports are JSON Lines or Markdown, which read back to
+# the same entries less their row ids (Markdown keeps what its text doesn't
+# show in HTML comments), or CSV, which keeps only CSV_COLUMNS. Imports take
+# those, Murmur's old chat_history.json, and the conversations.json in a
+# ChatGPT or Claude data export (the .zip itself is fine). A JSON document
+# is read with raw_decode a chunk at a time, so a multi-gigabyte array is
+# never in memory at once.
+
+
+import io
+import os
+import re
+import csv
+import sys
+import json
+import heapq
+import zipfile
+import argparse
+import tempfile
+from datetime import datetime
+
+from history import HistoryStore, HISTORY_PATH
+
+
+CHUNK_SIZE = 1 << 20     # characters read at a time from a JSON document
+RUN_BYTES = 16 << 20     # imported entries sorted in memory before spilling to disk
+MAX_RUNS = 64            # spilled runs merged at once, well inside the open file limit
+CSV_COLUMNS = ["timestamp", "prompt", "response", "responses"]
+
+EXTENSIONS = {
+    ".jsonl": "jsonl", ".ndjson": "jsonl", ".md": "markdown", ".markdown": "markdown",
+    ".csv": "csv", ".json": "json", ".zip": "zip",
+}
+
+# Field names other tools use for the same things, first match wins
+PROMPT_KEYS = ("prompt", "question", "input", "query", "user")
+RESPONSE_KEYS = ("response", "answer", "output", "completion", "reply", "assistant")
+TIME_KEYS = ("timestamp", "time", "date", "created_at", "create_time")
+
+HEADING = re.compile(r"^\\*(#{1,3} |<!-- murmur )")  # content lines that would read as our headings or notes
+ESCAPED_HEADING = re.compile(r"^\\+(#{1,3} |<!-- murmur )")
+NOTE = re.compile(r"^<!-- murmur (\{.*\}) -->$")
+ENTRY_FIELDS = ("timestamp", "prompt", "response", "responses", "id")
+RESULT_FIELDS = ("provider", "model", "response")
+
+
+def format_for(path, formats) -> str:
+    format = EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if format not in formats:
+        raise ValueError(f"Can't tell the format of {os.path.basename(path)}; expected one of {', '.join(formats)}")
+    return format
+
+
+# --- Filters ---
+
+def select(entries, since=None, until=None, search=None):
+    # since and until are timestamp prefixes, both inclusive: "2025" or
+    # "2025-03-01". Every word of search must appear somewhere in the entry.
+    words = search.casefold().split() if search else []
+    for entry in entries:
+        timestamp = entry.get("timestamp") or ""
+        if since and timestamp < since:
+            continue
+        if until and (not timestamp or timestamp[:len(until)] > until):
+            continue
+        if words:
+            text = searchable_text(entry)
+            if not all(word in text for word in words):
+                continue
+        yield entry
+
+
+def searchable_text(entry) -> str:
+    parts = [entry.get("prompt") or "", entry.get("response") or ""]
+    parts += [result.get("response") or "" for result in entry.get("responses") or []]
+    return "\n".join(parts).casefold()
+
+
+# --- Export ---
+
+def write_jsonl(entries):
+    for entry in entries:
+        yield json.dumps(entry) + "\n"
+
+
+def write_markdown(entries):
+    # What the headings don't show (latencies, errors, which answer was
+    # used) goes in a "<!-- murmur {...} -->" note under them: hidden when
+    # rendered, and read back by read_markdown
+    yield "# Murmur history\n"
+    for entry in entries:
+        results = entry.get("responses")
+        note = {key: value for key, value in entry.items() if key not in ENTRY_FIELDS}
+        if results and entry.get("response"):
+            best = next((i for i, result in enumerate(results) if result.get("response") == entry["response"]), None)
+            note.update({"best": best} if best is not None else {"response": entry["response"]})
+        yield f"\n## {entry.get('timestamp') or 'undated'}\n{_note(note)}\n### You\n\n{_escape(entry.get('prompt', ''))}\n"
+        if not results:
+            yield f"\n### Murmur\n\n{_escape(entry.get('response', ''))}\n"
+            continue
+        for result in results:
+            text = result.get("response") or (f"[Error: {result['error']}]" if result.get("error") else "")
+            title = f"{result.get('provider', '')} {result.get('model', '')}".strip()
+            note = {key: value for key, value in result.items() if key not in RESULT_FIELDS}
+            yield f"\n### Murmur ({title})\n{_note(note)}\n{_escape(text)}\n"
+
+
+def write_csv(entries):
+    # csv only writes to files, so each row goes through a small buffer
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def row(values):
+        writer.writerow(values)
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    yield row(CSV_COLUMNS)
+    for entry in entries:
+        responses = entry.get("responses")
+        yield row([entry.get("timestamp", ""), entry.get("prompt", ""), entry.get("response", ""),
+                   json.dumps(responses) if responses else ""])
+
+
+WRITERS = {"jsonl": write_jsonl, "markdown": write_markdown, "csv": write_csv}
+
+
+def export_history(store, path, format=None, since=None, until=None, search=None) -> int:
+    # Writes through a temp file and a rename; returns how many entries went out
+    format = format or format_for(path, WRITERS)
+    exported = 0
+
+    def counted(entries):
+        nonlocal exported
+        for entry in entries:
+            exported += 1
+            yield entry
+
+    entries = counted(select(store.iter_entries(since=since, until=until), since, until, search))
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            for text in WRITERS[format](entries):
+                f.write(text)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return exported
+
+
+# --- Import ---
+
+def read_jsonl(f, source="jsonl"):
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            continue
+        yield from entries_from(item, source)
+
+
+def read_json(f, source="json"):
+    # A top-level array is read an element at a time; anything else is one
+    # document, like {"conversations": [...]}, and is parsed whole
+    first = f.read(1)
+    while first and first.isspace():
+        first = f.read(1)
+    if first != "[":
+        try:
+            document = json.loads(first + f.read())
+        except ValueError as e:
+            raise ValueError(f"Not a JSON document - {e}") from e
+        items = document.get("conversations") if isinstance(document, dict) else None
+        for item in items if isinstance(items, list) else [document]:
+            yield from entries_from(item, source)
+        return
+    for item in iter_json_array(f):
+        yield from entries_from(item, source)
+
+
+def iter_json_array(f, chunk_size=CHUNK_SIZE):
+    # f is positioned just after the opening "[". An element that doesn't fit
+    # in what has been read yet fails to decode; the next read is twice the
+    # size, so a huge element costs a few retries, not one per chunk.
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    read_size = chunk_size
+    at_end = False
+    while True:
+        while position < len(buffer) and (buffer[position].isspace() or buffer[position] == ","):
+            position += 1
+        incomplete = position < len(buffer)
+        if incomplete:
+            if buffer[position] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                end = None
+            # A value is only whole once a "," or "]" follows it; a number cut
+            # at the end of the buffer ("3.5e" of "3.5e10") decodes as less
+            if end is not None:
+                after = end
+                while after < len(buffer) and buffer[after].isspace():
+                    after += 1
+                if (after < len(buffer) and buffer[after] in ",]") or (after == len(buffer) and at_end):
+                    yield item
+                    position = end
+                    read_size = chunk_size
+                    continue
+        if at_end:
+            raise ValueError("The JSON array ends early or is not valid")
+        more = f.read(read_size)
+        at_end = not more
+        buffer = buffer[position:] + more
+        position = 0
+        if incomplete:
+            read_size *= 2
+
+
+def read_markdown(f, source="markdown"):
+    # Reads what write_markdown writes: "## <timestamp>" starts an entry,
+    # "### You" and "### Murmur (...)" start its parts, and a note right
+    # under a heading holds the fields it doesn't show
+    entry = None
+    section = None
+    lines = []
+    results = []
+    notes = {}
+    note = None
+
+    def finish():
+        text = "\n".join(lines).strip()
+        lines.clear()
+        if section == "prompt":
+            entry["prompt"] = text
+        elif section is not None:
+            results.append((section, text, note or {}))
+
+    def entry_done():
+        texts = []
+        for _, text, fields in results:
+            if fields.get("error") and text == f"[Error: {fields['error']}]":
+                text = ""  # shown in place of the empty response
+            texts.append(text)
+        best = notes.pop("best", None)
+        response = notes.pop("response", None)
+        if isinstance(best, int) and 0 <= best < len(texts):
+            response = texts[best]
+        entry["response"] = response if response is not None else next((text for text in texts if text), "")
+        if any(title for title, _, _ in results):
+            entry["responses"] = []
+            for (title, _, fields), text in zip(results, texts):
+                provider, _, model = title.partition(" ")
+                entry["responses"].append({"provider": provider, "model": model, "response": text, **fields})
+        for key, value in notes.items():
+            entry.setdefault(key, value)
+        entry.setdefault("imported", source)
+        return entry
+
+    for line in f:
+        line = line.rstrip("\r\n")
+        if line.startswith("## "):
+            if entry is not None:
+                finish()
+                if entry.get("prompt"):
+                    yield entry_done()
+            entry = {"timestamp": _timestamp(line[3:].strip()), "prompt": ""}
+            section = None
+            results = []
+            notes = {}
+            note = None
+        elif entry is None:
+            continue  # the "# Murmur history" title
+        elif line == "### You":
+            finish()
+            section = "prompt"
+        elif line == "### Murmur" or (line.startswith("### Murmur (") and line.endswith(")")):
+            finish()
+            section = line[len("### Murmur ("):-1] if line.endswith(")") else ""
+            note = None
+        elif section is None:
+            notes = _read_note(line) or notes
+        elif section != "prompt" and note is None and not lines and _read_note(line) is not None:
+            note = _read_note(line)
+        elif section is not None:
+            lines.append(_unescape(line))
+    if entry is not None:
+        finish()
+        if entry.get("prompt"):
+            yield entry_done()
+
+
+def read_csv(f, source="csv"):
+    # Murmur's own columns, or any CSV with a prompt-like and a response-like column
+    csv.field_size_limit(2 ** 31 - 1)  # long answers are longer than the 128 KB default
+    for row in csv.DictReader(f):
+        item = {(key or "").strip().lower(): value for key, value in row.items()}
+        # An empty cell means a single answer, in the response column
+        try:
+            responses = json.loads(item.get("responses") or "null")
+        except ValueError:
+            responses = None
+        if isinstance(responses, list):
+            item["responses"] = responses
+        else:
+            item.pop("responses", None)
+        yield from entries_from(item, source)
+
+
+def read_zip(path):
+    # ChatGPT and Claude exports both keep the chats in conversations.json
+    try:
+        archive = zipfile.ZipFile(path)
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"{os.path.basename(path)} is not a readable zip - {e}") from e
+    with archive:
+        names = archive.namelist()
+        name = next((n for n in names if os.path.basename(n) == "conversations.json"), None)
+        name = name or next((n for n in names if os.path.splitext(n)[1].lower() in (".json", ".jsonl")), None)
+        if name is None:
+            raise ValueError(f"No conversations.json in {os.path.basename(path)}")
+        with archive.open(name) as member, io.TextIOWrapper(member, encoding="utf-8-sig") as f:
+            reader = read_jsonl if name.lower().endswith(".jsonl") else read_json
+            yield from reader(f)
+
+
+READERS = {"jsonl": read_jsonl, "json": read_json, "markdown": read_markdown, "csv": read_csv}
+
+
+def read_entries(path, format=None):
+    format = format or format_for(path, list(READERS) + ["zip"])
+    if format == "zip":
+        yield from read_zip(path)
+        return
+    with open(path, "r", encoding="utf-8-sig", newline="" if format == "csv" else None) as f:
+        yield from READERS[format](f)
+
+
+def entries_from(item, source):
+    # One decoded item from any of the readers, as zero or more history entries
+    if not isinstance(item, dict):
+        return
+    if isinstance(item.get("mapping"), dict):
+        yield from pair_messages(chatgpt_messages(item), "chatgpt", item.get("title"))
+    elif isinstance(item.get("chat_messages"), list):
+        yield from pair_messages(claude_messages(item), "claude", item.get("name"))
+    elif isinstance(item.get("messages"), list) and not _first(item, PROMPT_KEYS):
+        messages = ((m.get("role"), _text(m.get("content")), _timestamp(_first(m, TIME_KEYS) or _first(item, TIME_KEYS)))
+                    for m in item["messages"] if isinstance(m, dict))
+        yield from pair_messages(messages, source, item.get("title"))
+    else:
+        prompt = _first(item, PROMPT_KEYS)
+        if not isinstance(prompt, str) or not prompt.strip():
+            return
+        entry = dict(item)
+        entry.pop("id", None)  # written by earlier versions; the store goes by row
+        for key in PROMPT_KEYS + RESPONSE_KEYS + TIME_KEYS:
+            entry.pop(key, None)
+        response = _first(item, RESPONSE_KEYS)
+        entry["prompt"] = prompt
+        entry["response"] = response if isinstance(response, str) else _text(response)
+        entry["timestamp"] = _timestamp(_first(item, TIME_KEYS))
+        if isinstance(entry.get("responses"), list):
+            entry["responses"] = [r for r in entry["responses"] if isinstance(r, dict)]
+        entry.setdefault("imported", source)
+        yield entry
+
+
+def pair_messages(messages, source, title=None):
+    # (role, text, timestamp) in conversation order, as one entry per prompt
+    # with the assistant's replies to it
+    entry = None
+    for role, text, timestamp in messages:
+        if not text:
+            continue
+        if role in ("user", "human"):
+            if entry:
+                yield entry
+            entry = {"prompt": text, "response": "", "timestamp": timestamp, "imported": source}
+            if title:
+                entry["conversation"] = title
+        elif role == "assistant" and entry:
+            entry["response"] = f"{entry['response']}\n\n{text}" if entry["response"] else text
+    if entry:
+        yield entry
+
+
+def chatgpt_messages(conversation):
+    # The mapping is a tree of edits and regenerations; the branch shown in
+    # ChatGPT runs from current_node back up to the root
+    mapping = conversation["mapping"]
+    branch = []
+    node_id = conversation.get("current_node")
+    while node_id in mapping and len(branch) <= len(mapping):
+        node = mapping[node_id]
+        branch.append(node)
+        node_id = node.get("parent")
+    if not branch:
+        branch = list(mapping.values())
+    else:
+        branch.reverse()
+    for node in branch:
+        message = node.get("message") or {}
+        if (message.get("metadata") or {}).get("is_visually_hidden_from_conversation"):
+            continue
+        role = (message.get("author") or {}).get("role")
+        content = message.get("content") or {}
+        text = "\n".join(part for part in content.get("parts") or [] if isinstance(part, str))
+        text = (text or content.get("text") or "").strip()
+        yield role, text, _timestamp(message.get("create_time") or conversation.get("create_time"))
+
+
+def claude_messages(conversation):
+    for message in conversation["chat_messages"]:
+        if not isinstance(message, dict):
+            continue
+        text = message.get("text") or _text(message.get("content"))
+        yield message.get("sender"), (text or "").strip(), _timestamp(message.get("created_at"))
+
+
+def in_time_order(entries, run_bytes=RUN_BYTES):
+    # Entries sorted by timestamp, in runs of about run_bytes that are written
+    # out and merged back; entries with equal timestamps keep their order.
+    # Run lines are "<timestamp>\t<entry>", so merging doesn't parse entries.
+    run = []
+    size = 0
+    runs = []
+    spilled = []  # every temp file made, removed at the end
+
+    def spill(lines):
+        spilled.append(_spill(lines))
+        return spilled[-1]
+
+    try:
+        for entry in entries:
+            line = f"{entry.get('timestamp') or ''}\t{json.dumps(entry)}\n"
+            run.append(line)
+            size += len(line)
+            if size >= run_bytes:
+                runs.append(spill(run))
+                run, size = [], 0
+        if not runs:
+            run.sort(key=_run_time)
+            for line in run:
+                yield _run_entry(line)
+            return
+        runs.append(spill(run))
+        run = []
+        # Very long imports are merged in rounds, MAX_RUNS runs at a time
+        while len(runs) > MAX_RUNS:
+            merged = [spill(_merge_runs(runs[i:i + MAX_RUNS])) for i in range(0, len(runs), MAX_RUNS)]
+            for path in runs:
+                os.remove(path)
+            runs = merged
+        for line in _merge_runs(runs):
+            yield _run_entry(line)
+    finally:
+        for path in spilled:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def import_history(store, path, format=None, since=None, until=None, search=None) -> int:
+    # Adds what path holds to an open store; returns the count
+    return store.commit_import(prepare_import(store, path, format, since, until, search))
+
+
+def prepare_import(store, path, format=None, since=None, until=None, search=None):
+    # The slow part of import_history, for a worker thread: the store's
+    # commit_import() then makes the entries visible
+    return store.prepare_import(in_time_order(select(read_entries(path, format), since, until, search)))
+
+
+def _spill(lines) -> str:
+    # A sorted run in a temp file; a list is sorted first (stably), a merge
+    # is already in order
+    if isinstance(lines, list):
+        lines.sort(key=_run_time)
+    fd, path = tempfile.mkstemp(prefix="murmur-import-", suffix=".run")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    return path
+
+
+def _merge_runs(paths):
+    files = [open(path, "r", encoding="utf-8") for path in paths]
+    try:
+        # heapq.merge takes from earlier runs first on ties, which keeps order
+        yield from heapq.merge(*files, key=_run_time)
+    finally:
+        for f in files:
+            f.close()
+
+
+def _run_time(line) -> str:
+    return line[:line.index("\t")]
+
+
+def _run_entry(line) -> dict:
+    return json.loads(line[line.index("\t") + 1:])
+
+
+def _first(item, keys):
+    for key in keys:
+        if item.get(key) not in (None, ""):
+            return item[key]
+    return None
+
+
+def _text(content) -> str:
+    # Message content as a string, a list of parts, or {"type": "text", "text": ...} blocks
+    if isinstance(content, str):
+        return content.strip()
+    if isinstance(content, dict):
+        return _text(content.get("text") or content.get("parts"))
+    if isinstance(content, list):
+        return "\n".join(filter(None, (_text(part) for part in content)))
+    return ""
+
+
+def _timestamp(value) -> str:
+    # Local time without an offset, as Murmur writes it; "" if unknown
+    if value in (None, ""):
+        return ""
+    try:
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value / 1000 if value > 1e11 else value).isoformat()
+        moment = datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    except (ValueError, OverflowError, OSError):
+        return ""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment.isoformat()
+
+
+def _escape(text) -> str:
+    # A line in a prompt or response that looks like one of our headings gets
+    # a backslash, and one more for each it already has, so it reads back exactly
+    return "\n".join("\\" + line if HEADING.match(line) else line for line in (text or "").split("\n"))
+
+
+def _unescape(line) -> str:
+    return line[1:] if ESCAPED_HEADING.match(line) else line
+
+
+def _note(fields) -> str:
+    # "-->" can only be inside a string here, where it is escaped so the comment doesn't end early
+    if not fields:
+        return ""
+    text = json.dumps(fields, ensure_ascii=False).replace("-->", "--\\u003e")
+    return f"<!-- murmur {text} -->\n"
+
+
+def _read_note(line):
+    # The fields in a note line, or None if it isn't one
+    match = NOTE.match(line)
+    if not match:
+        return None
+    try:
+        fields = json.loads(match.group(1))
+    except ValueError:
+        return None
+    return fields if isinstance(fields, dict) else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export Murmur's chat history, or import other histories into it.")
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("path", help="file to write (export) or read (import)")
+    parser.add_argument("--format", choices=sorted(set(READERS) | set(WRITERS) | {"zip"}),
+                        help="default: from the file extension")
+    parser.add_argument("--since", help="first date to include, like 2025 or 2025-03-01")
+    parser.add_argument("--until", help="last date to include")
+    parser.add_argument("--search", help="only entries containing all of these words")
+    parser.add_argument("--history", default=HISTORY_PATH, help="Murmur's history file")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.action == "export":
+            # Read only: sealing and retention are left to the app
+            store = HistoryStore(args.history, seal=False).open()
+            try:
+                count = export_history(store, args.path, args.format, args.since, args.until, args.search)
+            finally:
+                store.close()
+            print(f"Exported {count} entries to {args.path}", file=sys.stderr)
+        else:
+            # Quit Murmur first: the store has one writer at a time
+            store = HistoryStore(args.history).open()
+            try:
+                count = import_history(store, args.path, args.format, args.since, args.until, args.search)
+            finally:
+                store.close()
+            print(f"Imported {count} entries from {args.path}", file=sys.stderr)
+    except (OSError, ValueError) as e:
+        print(f"{args.action.capitalize()} failed - {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,850 @@
+# history.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# Chat history storage
+
+
+import os
+import re
+import json
+import zlib
+import bisect
+import hashlib
+import heapq
+import sqlite3
+import tempfile
+import itertools
+import threading
+from array import array
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from tracing import tracer
+
+
+HISTORY_DIR = os.path.expanduser("~/Library/Application Support/Murmur")
+HISTORY_PATH = os.path.join(HISTORY_DIR, "chat_history.jsonl")
+LEGACY_HISTORY_PATH = os.path.join(HISTORY_DIR, "chat_history.json")
+SEARCH_INDEX_PATH = os.path.join(HISTORY_DIR, "chat_history.search.sqlite")
+
+PAGE_SIZE = 256        # rows parsed together when the table asks for one
+MAX_CACHED_PAGES = 32  # row summaries kept in memory, in pages
+PREVIEW_LENGTH = 120   # characters of the prompt shown in the table
+
+BLOCK_ENTRIES = 128    # entries per compressed block in a sealed segment
+MAX_CACHED_BLOCKS = 8  # decompressed blocks kept in memory
+ROLLUP_AFTER = 12      # months before monthly segments are merged into one per year
+
+
+class ArchiveSegment:
+    # A sealed, read-only stretch of history: gzip members of BLOCK_ENTRIES
+    # lines each, so one entry costs one block to decompress. The .idx sidecar
+    # holds (byte offset, first row) per block, then (file size, count).
+    # Concatenated members are still one valid .gz file, for zcat and friends.
+    def __init__(self, directory, name, period, count, first="", last="", size=0):
+        self.name = name
+        self.period = period  # "2025-03" while monthly, "2025" once rolled up
+        self.count = count
+        self.first = first    # timestamps of the first and last entries
+        self.last = last
+        self.size = size
+        self.path = os.path.join(directory, f"{name}.jsonl.gz")
+        self.index_path = f"{self.path}.idx"
+        self.start = 0        # store row of the first entry
+        self.offsets = None
+        self.rows = None
+
+    def manifest(self) -> dict:
+        return {"name": self.name, "period": self.period, "count": self.count,
+                "first": self.first, "last": self.last, "size": self.size}
+
+    def load_index(self):
+        if self.offsets is None:
+            blocks = array("Q")
+            with open(self.index_path, "rb") as f:
+                blocks.frombytes(f.read())
+            self.offsets = blocks[0::2]
+            self.rows = blocks[1::2]
+
+    def block_of(self, row) -> int:
+        self.load_index()
+        return bisect.bisect_right(self.rows, row) - 1
+
+    def read_block(self, block) -> list:
+        self.load_index()
+        start, end = self.offsets[block], self.offsets[block + 1]
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start)
+        return zlib.decompress(data, 31).split(b"\n")[:self.rows[block + 1] - self.rows[block]]
+
+    def iter_lines(self):
+        self.load_index()
+        with open(self.path, "rb") as f:
+            for block in range(len(self.offsets) - 1):
+                data = f.read(self.offsets[block + 1] - self.offsets[block])
+                yield from zlib.decompress(data, 31).split(b"\n")[:self.rows[block + 1] - self.rows[block]]
+
+
+class SegmentWriter:
+    # Streams lines into a new sealed segment, a block at a time
+    def __init__(self, directory, name, period):
+        self.segment = ArchiveSegment(directory, name, period, 0)
+        self.file = open(f"{self.segment.path}.tmp", "wb")
+        self.blocks = array("Q")
+        self.pending = []
+
+    def add(self, line, timestamp=""):
+        # line is one entry's JSON, as bytes without the newline
+        self.pending.append(line)
+        if timestamp:
+            self.segment.first = self.segment.first or timestamp
+            self.segment.last = timestamp
+        if len(self.pending) == BLOCK_ENTRIES:
+            self._write_block()
+
+    def add_segment(self, segment):
+        # Copies another segment's blocks without recompressing them
+        segment.load_index()
+        self._write_block()
+        base = self.file.tell()
+        with open(segment.path, "rb") as f:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                self.file.write(chunk)
+        for offset, row in zip(segment.offsets[:-1], segment.rows[:-1]):
+            self.blocks.extend((base + offset, self.segment.count + row))
+        self.segment.count += segment.count
+        self.segment.first = self.segment.first or segment.first
+        self.segment.last = segment.last or self.segment.last
+
+    def finish(self) -> ArchiveSegment:
+        self._write_block()
+        self.segment.size = self.file.tell()
+        self.blocks.extend((self.segment.size, self.segment.count))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        _write_atomic(self.segment.index_path, self.blocks.tobytes())
+        os.replace(f"{self.segment.path}.tmp", self.segment.path)
+        return self.segment
+
+    def _write_block(self):
+        if not self.pending:
+            return
+        # wbits 31: each block is a complete gzip member
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.blocks.extend((self.file.tell(), self.segment.count))
+        self.file.write(compressor.compress(b"\n".join(self.pending) + b"\n") + compressor.flush())
+        self.segment.count += len(self.pending)
+        self.pending = []
+
+
+class HistoryImport:
+    # What prepare_import() wrote and commit_import() makes part of the store:
+    # new sealed segments, the sealed segments they replace, and a spool of
+    # lines for the active file
+    def __init__(self, spool_path):
+        self.spool_path = spool_path
+        self.segments = []
+        self.replaces = []
+        self.count = 0
+
+
+class HistoryStore:
+    # Append-only JSON Lines file, one entry per line. Each send writes one
+    # line, so the cost doesn't grow with the history. A crash can at worst
+    # leave a torn last line, which is cut off the next time the store opens.
+    #
+    # Entries are not held in memory. A sidecar .idx file keeps the byte offset
+    # of every line, rows for the table are parsed a page at a time into a small
+    # LRU cache of summaries, and full entries are read from disk on request.
+    #
+    # The JSON Lines file is only the active segment. When the store opens,
+    # entries from earlier months are sealed into compressed ArchiveSegments
+    # next to it (chat_history.segments/), monthly segments older than
+    # rollup_after months are merged into one per year, and whole segments
+    # past retention_days or beyond max_archive_bytes are deleted. Rows number
+    # the sealed segments first, oldest first, then the active file.
+    #
+    # Imported entries keep their dates, so they can't simply be appended:
+    # those from earlier months are merged into the sealed segment for their
+    # period, or a new one, keeping segments in time order for retention and
+    # rollup. That moves rows, so each import bumps the manifest's epoch.
+    def __init__(self, path=HISTORY_PATH, legacy_path=LEGACY_HISTORY_PATH, retention_days=None,
+                 max_archive_bytes=None, rollup_after=ROLLUP_AFTER, seal=True):
+        self.path = path
+        self.index_path = f"{path}.idx"
+        self.legacy_path = legacy_path
+        self.archive_dir = f"{os.path.splitext(path)[0]}.segments"
+        self.manifest_path = os.path.join(self.archive_dir, "manifest.json")
+        self.retention_days = retention_days
+        self.max_archive_bytes = max_archive_bytes
+        self.rollup_after = rollup_after
+        self.seal = seal
+        self.segments = []
+        self.segment_starts = []
+        self.archived = 0  # rows in sealed segments
+        self.dropped = 0   # rows deleted by retention, ever; keeps row ids stable for the search index
+        self.epoch = 0     # bumped whenever rows move, which they only do on import
+        self.offsets = array("Q")
+        self.size = 0
+        self.pages = OrderedDict()
+        self.blocks = OrderedDict()
+        self._file = None
+        self._index_file = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        with tracer.span("history_open"):
+            return self._open()
+
+    def _open(self):
+        self._migrate_legacy()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if not os.path.exists(self.path):
+            open(self.path, "ab").close()
+        self._repair_tail()
+        manifest = self._load_manifest()
+        self._finish_trim(manifest)
+        if self.seal:
+            self._seal(manifest)
+            self._sort_segments(manifest)
+            self._rollup(manifest)
+            self._apply_retention(manifest)
+            self._remove_orphans(manifest)
+        segments, starts, archived = self._segments_from(manifest)
+        self.size = os.path.getsize(self.path)
+        offsets = self._load_index()
+        # The reader must be ready before any rows appear, since open() may
+        # run on a background thread while the table is already asking
+        self._reader = open(self.path, "rb")
+        self.segments = segments
+        self.segment_starts = starts
+        self.dropped = manifest["dropped"]
+        self.epoch = manifest.get("epoch", 0)
+        self.archived = archived
+        self.offsets = offsets
+        return self
+
+    def __len__(self):
+        return self.archived + len(self.offsets)
+
+    def __getitem__(self, row) -> dict:
+        with self._lock:
+            line = self._read_lines(row, row + 1)[0]
+        try:
+            return json.loads(line)
+        except ValueError:
+            return {"prompt": "[unreadable entry]", "response": "", "timestamp": ""}
+
+    def summary(self, row) -> dict:
+        # Just what the table shows: a one-line prompt preview and HH:MM
+        page_number = row // PAGE_SIZE
+        with self._lock:
+            page = self.pages.get(page_number)
+            if page is None:
+                page = self._read_page(page_number)
+                self.pages[page_number] = page
+                if len(self.pages) > MAX_CACHED_PAGES:
+                    self.pages.popitem(last=False)
+            else:
+                self.pages.move_to_end(page_number)
+        return page[row - page_number * PAGE_SIZE]
+
+    def iter_entries(self, archived=True, since=None, until=None):
+        # since and until are timestamp prefixes ("2025", "2025-03-01"). Sealed
+        # segments whose period falls outside them are skipped unread; entries
+        # are not filtered one by one here.
+        if archived:
+            for segment in list(self.segments):
+                period = segment.period
+                if (since and period < since[:len(period)]) or (until and period > until[:len(period)]):
+                    continue
+                for line in segment.iter_lines():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def disk_usage(self) -> dict:
+        active = sum(os.path.getsize(p) for p in (self.path, self.index_path) if os.path.exists(p))
+        archive = 0
+        if os.path.isdir(self.archive_dir):
+            archive = sum(os.path.getsize(os.path.join(self.archive_dir, name)) for name in os.listdir(self.archive_dir))
+        return {"active_bytes": active, "archive_bytes": archive, "segments": len(self.segments),
+                "archived_entries": self.archived, "active_entries": len(self.offsets)}
+
+    def append(self, entry) -> int:
+        # Returns the new entry's row. Entries are known by row alone: an
+        # import moves rows, so an id stored in the entry would go stale.
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+        with tracer.span("history_append"), self._lock:
+            self._append_lines([line])
+            return len(self) - 1
+
+    def prepare_import(self, entries) -> HistoryImport:
+        # entries come oldest first. Those from before this month are merged
+        # into new sealed segments by period, the rest spooled for the active
+        # file. Slow, so it runs off the main thread; nothing shows until
+        # commit_import(), and discard_import() throws it away instead.
+        current = datetime.now().strftime("%Y-%m")
+        existing = [segment.manifest() for segment in self.segments]
+        names = {entry["name"] for entry in existing}
+        os.makedirs(self.archive_dir, exist_ok=True)
+        fd, spool_path = tempfile.mkstemp(prefix="import-", suffix=".jsonl", dir=self.archive_dir)
+        batch = HistoryImport(spool_path)
+        lines = ((json.dumps(entry).encode("utf-8"), entry.get("timestamp") or "") for entry in entries)
+        try:
+            with os.fdopen(fd, "wb") as spool:
+                for period, group in itertools.groupby(lines, key=lambda line: _import_period(line[1], existing, current)):
+                    if period is None:
+                        for line, _ in group:
+                            spool.write(line + b"\n")
+                            batch.count += 1
+                        continue
+                    merged = [entry for entry in existing if entry["period"] == period]
+                    writer = SegmentWriter(self.archive_dir, _unique_name(period, names), period)
+                    # Entries already sealed come first when the times are equal
+                    sealed = [_dated_lines(ArchiveSegment(self.archive_dir, **entry)) for entry in merged]
+                    for line, timestamp in heapq.merge(*sealed, group, key=lambda line: line[1]):
+                        writer.add(line, timestamp)
+                    segment = writer.finish()
+                    batch.count += segment.count - sum(entry["count"] for entry in merged)
+                    batch.segments.append(segment)
+                    batch.replaces += merged
+        except BaseException:
+            self.discard_import(batch)
+            raise
+        return batch
+
+    def commit_import(self, batch) -> int:
+        # Quick, and the rows change under the table: call it where the table
+        # is read (the main thread in the app). Returns the count imported.
+        with tracer.span("history_import"), self._lock:
+            manifest = self._load_manifest()
+            names = {entry["name"] for entry in manifest["segments"]}
+            if any(entry["name"] not in names for entry in batch.replaces):
+                self.discard_import(batch)
+                raise ValueError("the history changed while importing; import again")
+            replaced = {entry["name"] for entry in batch.replaces}
+            segments = [entry for entry in manifest["segments"] if entry["name"] not in replaced]
+            manifest["segments"] = segments + [segment.manifest() for segment in batch.segments]
+            manifest["segments"].sort(key=lambda entry: entry["period"])
+            manifest["epoch"] = manifest.get("epoch", 0) + 1
+            self._save_manifest(manifest)
+            self._remove_segments(batch.replaces)
+            with open(batch.spool_path, "rb") as spool:
+                self._append_lines(spool)
+            os.remove(batch.spool_path)
+            self.segments, self.segment_starts, self.archived = self._segments_from(manifest)
+            self.epoch = manifest["epoch"]
+            self.pages.clear()
+            self.blocks.clear()
+        return batch.count
+
+    def discard_import(self, batch):
+        for segment in batch.segments:
+            for path in (segment.path, segment.index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        if os.path.exists(batch.spool_path):
+            os.remove(batch.spool_path)
+
+    def close(self):
+        for f in (self._file, self._index_file, self._reader):
+            if f:
+                f.close()
+        self._file = self._index_file = self._reader = None
+        self.blocks.clear()
+
+    def _append_lines(self, lines):
+        # Under the lock; lines are bytes ending in a newline
+        if self._file is None:
+            self._file = open(self.path, "ab")
+            self._index_file = open(self.index_path, "ab")
+        first = len(self)
+        offsets = array("Q")
+        for line in lines:
+            self._file.write(line)
+            offsets.append(self.size)
+            self.size += len(line)
+        self._file.flush()
+        self._index_file.write(offsets.tobytes())
+        self._index_file.flush()
+        self.offsets.extend(offsets)
+        # The last page may be cached short; drop it so the new rows show up
+        self.pages.pop(first // PAGE_SIZE, None)
+
+    def _segments_from(self, manifest):
+        segments = [ArchiveSegment(self.archive_dir, **entry) for entry in manifest["segments"]]
+        starts = []
+        archived = 0
+        for segment in segments:
+            segment.start = archived
+            starts.append(archived)
+            archived += segment.count
+        return segments, starts, archived
+
+    def _read_lines(self, start, end) -> list:
+        # Rows may span sealed segments and the active file
+        lines = []
+        while start < end and start < self.archived:
+            segment = self.segments[bisect.bisect_right(self.segment_starts, start) - 1]
+            stop = min(end, segment.start + segment.count)
+            lines += self._read_archived(segment, start - segment.start, stop - segment.start)
+            start = stop
+        if start < end:
+            lines += self._read_active(start - self.archived, end - self.archived)
+        return lines
+
+    def _read_archived(self, segment, start, end) -> list:
+        lines = []
+        block = segment.block_of(start)
+        while start < end:
+            key = (segment.name, block)
+            data = self.blocks.get(key)
+            if data is None:
+                data = self.blocks[key] = segment.read_block(block)
+                if len(self.blocks) > MAX_CACHED_BLOCKS:
+                    self.blocks.popitem(last=False)
+            else:
+                self.blocks.move_to_end(key)
+            first = segment.rows[block]
+            taken = data[start - first:end - first]
+            lines += [line.decode("utf-8", errors="replace") for line in taken]
+            start += len(taken)
+            block += 1
+        return lines
+
+    def _read_active(self, start, end) -> list:
+        first = self.offsets[start]
+        last = self.offsets[end] if end < len(self.offsets) else self.size
+        self._reader.seek(first)
+        data = self._reader.read(last - first)
+        return [line.decode("utf-8", errors="replace") for line in data.split(b"\n")[:end - start]]
+
+    def _read_page(self, page_number) -> list:
+        start = page_number * PAGE_SIZE
+        end = min(start + PAGE_SIZE, len(self))
+        page = []
+        for line in self._read_lines(start, end):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                entry = {"prompt": "[unreadable entry]"}
+            prompt = " ".join(entry.get("prompt", "")[:PREVIEW_LENGTH].split())
+            timestamp = entry.get("timestamp", "")
+            page.append({"prompt": prompt, "time": timestamp[11:16] if timestamp else ""})
+        return page
+
+    def _load_index(self) -> array:
+        offsets = array("Q")
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            offsets.frombytes(data[:len(data) - len(data) % offsets.itemsize])
+            if offsets and not self._index_matches(offsets):
+                print("History: index is out of date, rebuilding")
+                offsets = array("Q")
+
+        # Index any lines written after the last indexed one (or all of them)
+        start = offsets.pop() if offsets else 0
+        offsets.extend(self._scan_line_starts(start))
+        with open(self.index_path, "wb") as f:
+            f.write(offsets.tobytes())
+        return offsets
+
+    def _index_matches(self, offsets) -> bool:
+        last = offsets[-1]
+        if last >= self.size:
+            return False
+        if last == 0:
+            return True
+        with open(self.path, "rb") as f:
+            f.seek(last - 1)
+            return f.read(1) == b"\n"
+
+    def _scan_line_starts(self, start) -> array:
+        offsets = array("Q")
+        if start >= self.size:
+            return offsets
+        offsets.append(start)
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            pos = start
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                newline = chunk.find(b"\n")
+                while newline != -1:
+                    if pos + newline + 1 < self.size:
+                        offsets.append(pos + newline + 1)
+                    newline = chunk.find(b"\n", newline + 1)
+                pos += len(chunk)
+        return offsets
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"dropped": 0, "segments": [], "trim": None}
+
+    def _save_manifest(self, manifest):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        _write_atomic(self.manifest_path, json.dumps(manifest, indent=1).encode("utf-8"))
+
+    def _seal(self, manifest):
+        # Move entries from before this month out of the active file. The file
+        # is in time order, so they are a prefix of it.
+        current = datetime.now().strftime("%Y-%m")
+        writer = None
+        period = None
+        sealed = 0
+        digest = hashlib.sha256()
+        names = {entry["name"] for entry in manifest["segments"]}
+        new_segments = []
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    timestamp = json.loads(line).get("timestamp") or ""
+                except ValueError:
+                    timestamp = ""
+                # Undated or unreadable entries go with the one before them
+                line_period = timestamp[:7] or period or "0000-00"
+                if line_period >= current:
+                    break
+                if line_period != period:
+                    if writer:
+                        new_segments.append(writer.finish())
+                    os.makedirs(self.archive_dir, exist_ok=True)
+                    writer = SegmentWriter(self.archive_dir, _unique_name(line_period, names), line_period)
+                    period = line_period
+                writer.add(line.rstrip(b"\n"), timestamp)
+                digest.update(line)
+                sealed += len(line)
+        if writer:
+            new_segments.append(writer.finish())
+        if not sealed:
+            return
+        # The manifest names the new segments before the active file is cut;
+        # trim records what to cut, should the cut not happen
+        manifest["segments"] += [segment.manifest() for segment in new_segments]
+        manifest["trim"] = {"bytes": sealed, "sha256": digest.hexdigest()}
+        self._save_manifest(manifest)
+        self._finish_trim(manifest)
+        print(f"History: sealed {sum(s.count for s in new_segments)} entries into {len(new_segments)} segments")
+
+    def _sort_segments(self, manifest):
+        # Segments are kept in period order. Imports before they merged by
+        # period could leave old entries sealed after newer ones; this puts
+        # them back, moving rows, hence the new epoch.
+        entries = manifest["segments"]
+        ordered = sorted(entries, key=lambda entry: entry["period"])
+        if ordered == entries:
+            return
+        manifest["segments"] = ordered
+        manifest["epoch"] = manifest.get("epoch", 0) + 1
+        self._save_manifest(manifest)
+        print("History: put sealed segments back in time order")
+
+    def _remove_orphans(self, manifest):
+        # Segments and spools from an import that never committed
+        if not os.path.isdir(self.archive_dir):
+            return
+        keep = {"manifest.json"}
+        for entry in manifest["segments"]:
+            keep.update((f"{entry['name']}.jsonl.gz", f"{entry['name']}.jsonl.gz.idx"))
+        for name in os.listdir(self.archive_dir):
+            if name not in keep:
+                os.remove(os.path.join(self.archive_dir, name))
+
+    def _finish_trim(self, manifest):
+        trim = manifest.get("trim")
+        if not trim:
+            return
+        digest = hashlib.sha256()
+        with open(self.path, "rb") as f:
+            remaining = trim["bytes"]
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1 << 20))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+            # Only cut if the prefix is still there; a crash may have come after the cut
+            if remaining == 0 and digest.hexdigest() == trim["sha256"]:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "wb") as out:
+                    while True:
+                        chunk = f.read(1 << 20)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                    out.flush()
+                    os.fsync(out.fileno())
+                os.replace(tmp_path, self.path)
+                if os.path.exists(self.index_path):
+                    os.remove(self.index_path)
+        manifest["trim"] = None
+        self._save_manifest(manifest)
+
+    def _rollup(self, manifest):
+        # Runs of monthly segments from the same year, all older than
+        # rollup_after months, become one yearly segment. The compressed
+        # blocks are copied as they are.
+        if not self.rollup_after:
+            return
+        now = datetime.now()
+        months = now.year * 12 + now.month - 1 - self.rollup_after
+        cutoff = f"{months // 12:04d}-{months % 12 + 1:02d}"
+        entries = manifest["segments"]
+        groups = []
+        for i, entry in enumerate(entries):
+            if entry["period"][:7] >= cutoff or (entry["last"] and entry["last"][:7] >= cutoff):
+                continue
+            if groups and groups[-1][-1] == i - 1 and entries[i - 1]["period"][:4] == entry["period"][:4]:
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+        groups = [g for g in groups if len(g) > 1 or len(entries[g[0]]["period"]) > 4]
+        if not groups:
+            return
+        names = {entry["name"] for entry in entries}
+        replaced = {}
+        for group in groups:
+            year = entries[group[0]]["period"][:4]
+            writer = SegmentWriter(self.archive_dir, _unique_name(year, names), year)
+            for i in group:
+                writer.add_segment(ArchiveSegment(self.archive_dir, **entries[i]))
+            replaced[group[0]] = writer.finish().manifest()
+        merged = {i for group in groups for i in group}
+        old = [entries[i] for i in sorted(merged)]
+        manifest["segments"] = [replaced[i] if i in replaced else entry
+                                for i, entry in enumerate(entries) if i in replaced or i not in merged]
+        self._save_manifest(manifest)
+        self._remove_segments(old)
+        print(f"History: rolled {len(old)} monthly segments up into {len(groups)}")
+
+    def _apply_retention(self, manifest):
+        # Whole sealed segments only, oldest first; the active file is never cut
+        entries = manifest["segments"]
+        cutoff = None
+        if self.retention_days:
+            cutoff = (datetime.now() - timedelta(days=self.retention_days)).isoformat()
+        total = sum(entry["size"] for entry in entries)
+        expired = 0
+        while expired < len(entries):
+            entry = entries[expired]
+            too_old = cutoff is not None and entry["last"] and entry["last"] < cutoff
+            too_big = self.max_archive_bytes is not None and total > self.max_archive_bytes
+            if not (too_old or too_big):
+                break
+            total -= entry["size"]
+            expired += 1
+        if not expired:
+            return
+        old = entries[:expired]
+        manifest["segments"] = entries[expired:]
+        manifest["dropped"] += sum(entry["count"] for entry in old)
+        self._save_manifest(manifest)
+        self._remove_segments(old)
+        print(f"History: retention removed {sum(entry['count'] for entry in old)} entries in {len(old)} segments")
+
+    def _remove_segments(self, entries):
+        for entry in entries:
+            segment = ArchiveSegment(self.archive_dir, **entry)
+            for path in (segment.path, segment.index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _write_all(self, path, entries):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _migrate_legacy(self):
+        # One-time move from the old single-document chat_history.json
+        if os.path.exists(self.path) or not os.path.exists(self.legacy_path):
+            return
+        with open(self.legacy_path, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        self._write_all(self.path, entries)
+        os.replace(self.legacy_path, f"{self.legacy_path}.migrated")
+        print(f"History: migrated {len(entries)} entries to {self.path}")
+
+    def _repair_tail(self):
+        with open(self.path, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            # Find the last complete line and drop whatever follows it
+            pos = size
+            while pos > 0:
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step)
+                newline = chunk.rfind(b"\n")
+                if newline != -1:
+                    pos += newline + 1
+                    break
+            f.truncate(pos)
+            print(f"History: dropped a torn entry at byte {pos}")
+
+
+def _unique_name(name, taken) -> str:
+    # Segment file names, given out once; adds taken to the set
+    unique = name
+    for n in range(1, 1000):
+        if unique not in taken:
+            break
+        unique = f"{name}.{n}"
+    taken.add(unique)
+    return unique
+
+
+def _import_period(timestamp, existing, current):
+    # The sealed period an imported entry goes in, or None for the active
+    # file: its month's, or the yearly segment's if that covers the month.
+    # Undated entries go in the active file, as if new; sealed ahead of
+    # everything they would hold up retention for good.
+    month = timestamp[:7]
+    if not month or month >= current:
+        return None
+    for entry in existing:
+        if len(entry["period"]) == 4 and month.startswith(entry["period"]) and month <= entry["last"][:7]:
+            return entry["period"]
+    return month
+
+
+def _dated_lines(segment):
+    # (line, timestamp) for a sealed segment; an undated line takes the
+    # timestamp before it, as it did when it was sealed
+    timestamp = ""
+    for line in segment.iter_lines():
+        try:
+            timestamp = json.loads(line).get("timestamp") or timestamp
+        except ValueError:
+            pass
+        yield line, timestamp
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class HistorySearchIndex:
+    # SQLite FTS5 index over prompts and responses, keyed by history row.
+    # New entries are added one at a time as they are appended; catch_up()
+    # indexes anything written while the index was not running. Row ids count
+    # entries removed by retention too (store.dropped), so they stay stable;
+    # add() and search() take and return store rows. An import moves rows, so
+    # when the store's epoch changes the index is built again.
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS entries USING fts5("
+            "prompt, response, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+        self.base = 0  # the store's dropped count, as of catch_up()
+        self._lock = threading.Lock()
+
+    @property
+    def indexed_through(self) -> int:
+        # Rows below this were indexed by catch_up(); later rows may be indexed too
+        return self._meta("indexed_through")
+
+    def _meta(self, key) -> int:
+        with self._lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def add(self, row, entry):
+        with tracer.span("search_index_add"), self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries(rowid, prompt, response) VALUES (?, ?, ?)",
+                (self.base + row, entry.get("prompt", ""), entry.get("response", "")),
+            )
+
+    def catch_up(self, store, batch_size=1000):
+        self.base = base = store.dropped
+        indexed = self.indexed_through
+        if indexed > base + len(store) or self._meta("epoch") != store.epoch:
+            # The history was rewritten underneath us, or rows moved; start over
+            with self._lock, self.db:
+                self.db.execute("DELETE FROM entries")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('indexed_through', 0)")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('epoch', ?)", (store.epoch,))
+            indexed = 0
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM entries WHERE rowid < ?", (base,))
+        indexed = max(indexed, base)
+        total = base + len(store)
+        for start in range(indexed, total, batch_size):
+            end = min(start + batch_size, total)
+            rows = [(row, store[row - base]) for row in range(start, end)]
+            with self._lock, self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO entries(rowid, prompt, response) VALUES (?, ?, ?)",
+                    [(row, e.get("prompt", ""), e.get("response", "")) for row, e in rows],
+                )
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('indexed_through', ?)", (end,))
+        return total - indexed
+
+    def search(self, query, limit=500) -> list:
+        # Every word must match, the last one (or any ending in *) as a prefix.
+        # Prompt matches rank above response matches.
+        # Single letters are skipped: FTS5 has no prefix index that short
+        words = [w for w in re.findall(r"\w+\*?", query) if len(w.rstrip("*")) > 1]
+        if not words:
+            return []
+        terms = []
+        for i, word in enumerate(words):
+            prefix = word.endswith("*") or i == len(words) - 1
+            terms.append(f'"{word.rstrip("*")}"' + ("*" if prefix else ""))
+        # Very short prefixes match most of the history; scoring all of those is
+        # what gets slow, so they are listed newest first instead
+        order = "rowid DESC" if max(len(w.rstrip("*")) for w in words) < 3 else "bm25(entries, 2.0, 1.0)"
+        with self._lock:
+            rows = self.db.execute(
+                f"SELECT rowid FROM entries WHERE entries MATCH ? ORDER BY {order} LIMIT ?",
+                (" ".join(terms), limit),
+            ).fetchall()
+        return [row - self.base for (row,) in rows if row >= self.base]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
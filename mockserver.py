@@ -0,0 +1,386 @@
+# mockserver.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# Local stand-in for the provider APIs, for benchmarks and offline work
+#
+#   python mockserver.py --port 8765 --latency 0.2 --error-rate 0.05
+#
+# Serves the OpenAI chat completions API, the Anthropic Messages API and the
+# Gemini generateContent API, streamed or not, all under the same base URL,
+# with a configurable delay before the first byte, a delay between streamed
+# tokens, a share of requests that stall for slow_latency seconds first (a
+# latency tail), and a share answered with an error status instead.
+#
+# The OpenAI files and batches endpoints are there too, enough for
+# OpenAIBatchClient: an uploaded input file becomes a batch that completes
+# batch_latency seconds later, with each line answered like a chat
+# completion and error_rate of them sent to the error file instead.
+
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+MOCK_MODELS = ["gpt-4o", "gpt-4o-mini", "gpt-4-turbo", "gpt-3.5-turbo", "o1-mini"]
+MOCK_REPLY = "This is a canned reply from the Murmur mock server."
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    # Headers and body go out as separate writes; with Nagle on, delayed ACKs
+    # would add ~40 ms to every non-streamed reply
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        parts = path.split("/")
+        if len(parts) >= 4 and parts[-3] == "files" and parts[-1] == "content":
+            return self.file_content(parts[-2])
+        if len(parts) >= 3 and parts[-2] == "batches":
+            return self.retrieve_batch(parts[-1])
+        if not path.endswith("/models"):
+            return self.send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+        self.server.count("models")
+        if "x-goog-api-key" in self.headers:
+            return self.send_json(200, {"models": [
+                {"name": f"models/{m}", "supportedGenerationMethods": ["generateContent", "countTokens"]}
+                for m in self.server.models
+            ]})
+        # OpenAI's list shape, with the paging fields Anthropic adds
+        self.send_json(200, {
+            "object": "list",
+            "data": [{"id": m, "object": "model", "type": "model", "created": 0, "owned_by": "mock"} for m in self.server.models],
+            "has_more": False,
+            "first_id": self.server.models[0] if self.server.models else None,
+            "last_id": self.server.models[-1] if self.server.models else None,
+        })
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/files"):
+            return self.upload_file(body)
+        if path.endswith("/batches"):
+            return self.create_batch(json.loads(body or b"{}"))
+        if path.endswith("/chat/completions"):
+            api = "openai"
+        elif path.endswith("/messages"):
+            api = "claude"
+        elif path.endswith(":generateContent") or path.endswith(":streamGenerateContent"):
+            api = "gemini"
+        else:
+            return self.send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+        request = json.loads(body or b"{}")
+        self.server.count("completions")
+        time.sleep(self.server.latency)
+        if self.server.slow_rate and random.random() < self.server.slow_rate:
+            self.server.count("slow")
+            time.sleep(self.server.slow_latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.server.count("errors")
+            return self.send_json(self.server.error_status, {
+                "error": {"message": "injected error", "type": "mock_error"},
+            }, {"retry-after-ms": "50"})
+        if api == "claude":
+            return self.claude(request)
+        if api == "gemini":
+            return self.gemini(request, path.endswith(":streamGenerateContent"))
+        if request.get("stream"):
+            self.stream(request)
+        else:
+            self.send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", ""),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": self.server.reply}, "finish_reason": "stop"}],
+                "usage": self.usage(),
+            })
+
+    def stream(self, request):
+        self.start_stream()
+        for i, word in enumerate(self.words()):
+            self.send_event({
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": request.get("model", ""),
+                "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}],
+            })
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self.send_event({"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": 0,
+                             "model": request.get("model", ""), "choices": [], "usage": self.usage()})
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.end_stream()
+
+    def claude(self, request):
+        usage = self.usage()
+        if not request.get("stream"):
+            return self.send_json(200, {
+                "id": "msg_mock", "type": "message", "role": "assistant", "model": request.get("model", ""),
+                "content": [{"type": "text", "text": self.server.reply}],
+                "stop_reason": "end_turn",
+                "usage": {"input_tokens": usage["prompt_tokens"], "output_tokens": usage["completion_tokens"]},
+            })
+        self.start_stream()
+        self.send_event({"type": "message_start", "message": {
+            "id": "msg_mock", "type": "message", "role": "assistant", "model": request.get("model", ""),
+            "content": [], "usage": {"input_tokens": usage["prompt_tokens"], "output_tokens": 1},
+        }}, "message_start")
+        self.send_event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+                        "content_block_start")
+        self.send_event({"type": "ping"}, "ping")
+        for word in self.words():
+            self.send_event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": word}},
+                            "content_block_delta")
+        self.send_event({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        self.send_event({"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                         "usage": {"output_tokens": usage["completion_tokens"]}}, "message_delta")
+        self.send_event({"type": "message_stop"}, "message_stop")
+        self.end_stream()
+
+    def gemini(self, request, stream):
+        usage = self.usage()
+        metadata = {"promptTokenCount": usage["prompt_tokens"], "candidatesTokenCount": usage["completion_tokens"],
+                    "totalTokenCount": usage["total_tokens"]}
+        if not stream:
+            return self.send_json(200, {
+                "candidates": [{"content": {"role": "model", "parts": [{"text": self.server.reply}]}, "finishReason": "STOP"}],
+                "usageMetadata": metadata,
+            })
+        self.start_stream()
+        words = list(self.words())
+        for i, word in enumerate(words):
+            chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": word}]}}]}
+            if i == len(words) - 1:
+                chunk["candidates"][0]["finishReason"] = "STOP"
+                chunk["usageMetadata"] = metadata
+            self.send_event(chunk)
+        self.end_stream()
+
+    def upload_file(self, body):
+        # The SDK sends multipart/form-data with a purpose field and the file
+        message = BytesParser().parsebytes(
+            f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode("latin-1") + body
+        )
+        fields = {part.get_param("name", header="content-disposition"): part for part in message.get_payload()}
+        if "file" not in fields:
+            return self.send_json(400, {"error": {"message": "file is required", "type": "invalid_request_error"}})
+        data = fields["file"].get_payload(decode=True)
+        purpose = fields["purpose"].get_payload(decode=True).decode("utf-8") if "purpose" in fields else ""
+        self.send_json(200, self.server.add_file(data, fields["file"].get_filename() or "upload", purpose))
+
+    def file_content(self, file_id):
+        data = self.server.files.get(file_id, {}).get("data")
+        if data is None:
+            return self.send_json(404, {"error": {"message": f"No file {file_id}", "type": "invalid_request_error"}})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def create_batch(self, request):
+        source = self.server.files.get(request.get("input_file_id"))
+        if source is None:
+            return self.send_json(400, {"error": {"message": "input_file_id not found", "type": "invalid_request_error"}})
+        self.server.count("batches")
+        # Answered now, published when the batch "completes"
+        output, errors = [], []
+        for line in source["data"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            result = {"id": f"batch_req_{len(output) + len(errors)}", "custom_id": item["custom_id"], "error": None}
+            if self.server.error_rate and random.random() < self.server.error_rate:
+                result["response"] = {"status_code": self.server.error_status, "request_id": "req_mock", "body": {
+                    "error": {"message": "injected error", "type": "mock_error"}}}
+                errors.append(result)
+            else:
+                result["response"] = {"status_code": 200, "request_id": "req_mock", "body": {
+                    "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()),
+                    "model": item["body"].get("model", ""),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": self.server.reply},
+                                 "finish_reason": "stop"}],
+                    "usage": self.usage(),
+                }}
+                output.append(result)
+        self.send_json(200, self.server.add_batch(request, output, errors))
+
+    def retrieve_batch(self, batch_id):
+        batch = self.server.batch(batch_id)
+        if batch is None:
+            return self.send_json(404, {"error": {"message": f"No batch {batch_id}", "type": "invalid_request_error"}})
+        self.send_json(200, batch)
+
+    def words(self):
+        # The reply a word at a time, token_delay apart
+        for i, word in enumerate(self.server.reply.split(" ")):
+            if i:
+                time.sleep(self.server.token_delay)
+            yield word if i == 0 else " " + word
+
+    def start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_rate_limit_headers()
+        self.end_headers()
+
+    def end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_event(self, data, event=None):
+        prefix = f"event: {event}\n".encode("utf-8") if event else b""
+        self.send_chunk(prefix + b"data: " + json.dumps(data).encode("utf-8") + b"\n\n")
+
+    def send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_rate_limit_headers()
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_rate_limit_headers(self):
+        # Generous limits, so the client's rate limiter is exercised but never waits
+        self.send_header("x-ratelimit-limit-requests", "100000")
+        self.send_header("x-ratelimit-remaining-requests", "99999")
+        self.send_header("x-ratelimit-reset-requests", "1ms")
+
+    def usage(self):
+        completion = len(self.server.reply.split(" "))
+        return {"prompt_tokens": 8, "completion_tokens": completion, "total_tokens": 8 + completion}
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, token_delay=0.0, error_rate=0.0, error_status=500,
+                 reply=MOCK_REPLY, models=MOCK_MODELS, slow_rate=0.0, slow_latency=1.0, batch_latency=0.0):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.latency = latency          # seconds before the first byte
+        self.token_delay = token_delay  # seconds between streamed words
+        self.error_rate = error_rate    # share of completions answered with error_status
+        self.error_status = error_status
+        self.slow_rate = slow_rate        # share of completions delayed by slow_latency more
+        self.slow_latency = slow_latency
+        self.batch_latency = batch_latency  # seconds from creating a batch to its completion
+        self.reply = reply
+        self.models = list(models)
+        self.counts = {"models": 0, "completions": 0, "errors": 0, "slow": 0, "batches": 0}
+        self.files = {}    # file id -> {"data", "info"}
+        self.batches = {}  # batch id -> (batch object, output lines, error lines, monotonic time it completes)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/v1"
+
+    def handle_error(self, request, client_address):
+        # Clients hang up mid-stream on purpose (cancels, hedges, timeouts)
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def add_file(self, data, filename, purpose) -> dict:
+        with self._lock:
+            file_id = f"file-mock{len(self.files)}"
+            info = {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                    "filename": filename, "purpose": purpose, "status": "processed"}
+            self.files[file_id] = {"data": data, "info": info}
+        return info
+
+    def add_batch(self, request, output, errors) -> dict:
+        with self._lock:
+            batch_id = f"batch_mock{len(self.batches)}"
+            batch = {
+                "id": batch_id, "object": "batch", "endpoint": request.get("endpoint", ""), "errors": None,
+                "input_file_id": request["input_file_id"], "completion_window": request.get("completion_window", "24h"),
+                "status": "validating", "output_file_id": None, "error_file_id": None,
+                "created_at": int(time.time()), "metadata": request.get("metadata"),
+                "request_counts": {"total": len(output) + len(errors), "completed": 0, "failed": 0},
+            }
+            self.batches[batch_id] = (batch, output, errors, time.monotonic() + self.batch_latency)
+        return dict(batch)
+
+    def batch(self, batch_id):
+        # Moves to in_progress when first polled and to completed once
+        # batch_latency has passed, writing the output and error files then
+        with self._lock:
+            if batch_id not in self.batches:
+                return None
+            batch, output, errors, done_at = self.batches[batch_id]
+            if batch["status"] == "validating":
+                batch["status"] = "in_progress"
+            if batch["status"] == "in_progress" and time.monotonic() >= done_at:
+                for key, lines in (("output_file_id", output), ("error_file_id", errors)):
+                    if lines:
+                        file_id = f"file-mock{len(self.files)}"
+                        data = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+                        self.files[file_id] = {"data": data, "info": {"id": file_id}}
+                        batch[key] = file_id
+                batch["request_counts"] = {"total": len(output) + len(errors), "completed": len(output),
+                                           "failed": len(errors)}
+                batch["status"] = "completed"
+                batch["completed_at"] = int(time.time())
+            return dict(batch)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="mock-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve mock provider APIs on localhost.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the first byte")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds between streamed words")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of completions that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of completions that stall first")
+    parser.add_argument("--slow-latency", type=float, default=1.0, help="seconds a stalled completion waits")
+    parser.add_argument("--batch-latency", type=float, default=0.0, help="seconds a batch takes to complete")
+    args = parser.parse_args(argv)
+
+    server = MockServer(args.port, args.latency, args.token_delay, args.error_rate, args.error_status,
+                        slow_rate=args.slow_rate, slow_latency=args.slow_latency, batch_latency=args.batch_latency)
+    print(f"Mock API at {server.url}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,13 @@
 
 
 import sys
-import json
 import os
+import time
+LAUNCHED = time.perf_counter()  # taken before the heavier imports, for the startup report
 import objc
+import threading
 from datetime import datetime
+from PyObjCTools import AppHelper
 from Cocoa import (
     NSApplication, NSApp, NSObject,
     NSWindow, NSScrollView, NSTextView, NSTextField,
@@ -19,34 +22,59 @@ from Cocoa import (
     NSMenu, NSMenuItem, NSImage, NSImageView, NSBundle, NSSecureTextField,
     NSMakeRect, NSFont, NSApplicationActivationPolicyRegular, NSTableViewSelectionHighlightStyleRegular,
     NSWindowStyleMaskTitled, NSWindowStyleMaskClosable, NSWindowStyleMaskResizable,
-    NSBackingStoreBuffered, NSEventModifierFlagCommand,NSBezelStyleRounded
+    NSBackingStoreBuffered, NSEventModifierFlagCommand,NSBezelStyleRounded,
+    NSAttributedString, NSSearchField, NSEvent, NSEventModifierFlagOption,
+    NSSavePanel, NSOpenPanel, NSModalResponseOK
 )
 
-from backend import ChatService, get_openai_models, get_claude_models, get_gemini_models
-from preferences import SettingsWindow, load_preferences, show_about_panel, get_api_keys
+from backend import (
+    ChatService, ContextBuilder, FanOut, ModelCatalog, ResponseCache, SemanticCache, PROVIDERS, load_sdk,
+    CONTEXT_BUDGET, MODEL_CACHE_TTL, RESPONSE_CACHE_TTL, SEMANTIC_THRESHOLD,
+)
+from history import HistoryStore, HistorySearchIndex, HISTORY_DIR
+from tracing import tracer, StartupTimer
+from usage import UsageLedger, format_report, REPORT_DAYS
+from export import export_history, prepare_import, EXTENSIONS
+from transcript import TranscriptBuffer, MAX_SCROLLBACK, utf16_length
+from preferences import SettingsWindow, show_about_panel, apply_theme
+from settings import settings
 
 print("Murmur: starting")
 
 NSLayoutConstraintPriorityRequired = 1000.0
-HISTORY_PATH = os.path.expanduser("~/Library/Application Support/Murmur/chat_history.json")
+
+STARTUP_REPORT_PATH = os.path.join(HISTORY_DIR, "startup_times.jsonl")
+
+startup = StartupTimer(LAUNCHED)
+startup.mark("imports")
 
 
 class HistoryDataSource(NSObject):
     def initWithHistory_(self, history):
         self = objc.super(HistoryDataSource, self).init()
         self.history = history
+        self.rows = None  # history rows matching the search, or None for all
         return self
 
+    @objc.python_method
+    def set_filter(self, rows):
+        self.rows = rows
+
+    @objc.python_method
+    def history_row(self, row):
+        return self.rows[row] if self.rows is not None else row
+
     def numberOfRowsInTableView_(self, table):
-        return len(self.history)
+        return len(self.rows) if self.rows is not None else len(self.history)
 
     def tableView_objectValueForTableColumn_row_(self, table, column, row):
+        # Rows come from the store's page cache; full entries stay on disk
+        row = self.history_row(row)
         column_id = column.identifier()
         if column_id == "prompt":
-            return self.history[row]["prompt"]
+            return self.history.summary(row)["prompt"]
         elif column_id == "timestamp":
-            iso = self.history[row].get("timestamp", "")
-            return iso[11:16] if iso else ""
+            return self.history.summary(row)["time"]
 
 class MurmurAppDelegate(NSObject):
     def applicationDidFinishLaunching_(self, notification):
@@ -54,28 +82,47 @@ class MurmurAppDelegate(NSObject):
         print("Murmur: creating window...")
         
 
-        prefs = load_preferences()
-        print(prefs)
-        provider = prefs.get("provider", "openai")
-        api_key = prefs.get(f"api_key_{provider}", "")
-        self.chat_service = ChatService(provider, api_key)  
-        
-        #self.model_cache = {}
-
-        prefs = load_preferences()
+        prefs = settings.snapshot()
         provider = prefs.get("provider", "openai")
         api_key = prefs.get(f"api_key_{provider}", "")
-        print(f"Initial provider: {provider}, API key: {api_key[:8]}...")
-        self.chat_service = ChatService(provider, api_key)  
-
-        self.history = []
+        print(f"Initial provider: {provider}")
+        if prefs.get("tracing"):
+            tracer.enable()
+        api_keys = settings.api_keys(PROVIDERS)
+        response_cache = None
+        if prefs.get("response_cache"):
+            response_cache = ResponseCache(ttl=prefs.get("response_cache_ttl", RESPONSE_CACHE_TTL))
+        context = ContextBuilder(budget=prefs.get("context_budget", CONTEXT_BUDGET))
+        # Every provider call is logged with its tokens and timing; the per-model
+        # numbers order and annotate the model dropdown
+        self.usage_ledger = UsageLedger()
+        self.chat_service = ChatService(provider, api_key, dispatch=AppHelper.callAfter, api_keys=api_keys,
+                                        response_cache=response_cache, context=context,
+                                        hedge=prefs.get("hedge_requests", False), usage_ledger=self.usage_ledger)
+        if prefs.get("context_summaries"):
+            context.summarizer = self.chat_service.summarizer()
+        settings.subscribe(self.chat_service.settings_changed)
+        settings.subscribe(self.settings_changed)
+
+        # History is opened and indexed after the window is on screen. Old
+        # months are sealed and compressed as it opens; nothing is deleted
+        # unless a retention limit is set.
+        self.history = HistoryStore(retention_days=prefs.get("history_retention_days"),
+                                    max_archive_bytes=prefs.get("history_max_archive_bytes"))
+        self.history_loaded = False
+        self.unsaved_history = []  # entries finished before the history was open
+        self.search_index = None
+        self.pending_requests = []  # in submission order, until written to history
+        # What the output view shows; edits reach the view once per run loop turn
+        self.transcript = TranscriptBuffer(max_length=prefs.get("scrollback", MAX_SCROLLBACK))
+        self.transcript_update_scheduled = False
 
         
         theme = prefs.get("theme", "system")
-        if theme == "dark":
-            NSApp.setAppearance_(objc.lookUpClass("NSAppearance").appearanceNamed_("NSAppearanceNameDarkAqua"))
-        elif theme == "light":
-            NSApp.setAppearance_(objc.lookUpClass("NSAppearance").appearanceNamed_("NSAppearanceNameAqua"))
+        if theme != "system":
+            apply_theme(theme)
+
+        self.model_catalog = ModelCatalog(ttl=prefs.get("model_cache_ttl", MODEL_CACHE_TTL), dispatch=AppHelper.callAfter)
 
         self.settings_window = SettingsWindow.alloc().init()
 
@@ -99,7 +146,14 @@ class MurmurAppDelegate(NSObject):
         self.left_view = NSView.alloc().initWithFrame_(NSMakeRect(0, 0, 310, 600))
         self.left_view.setTranslatesAutoresizingMaskIntoConstraints_(True)
 
-        scroll_view = NSScrollView.alloc().initWithFrame_(self.left_view.bounds())
+        # --- History Search Field ---
+        self.search_field = NSSearchField.alloc().initWithFrame_(NSMakeRect(6, 572, 298, 22))
+        self.search_field.setAutoresizingMask_(1 << 1 | 1 << 3)
+        self.search_field.setTarget_(self)
+        self.search_field.setAction_("searchChanged:")
+        self.left_view.addSubview_(self.search_field)
+
+        scroll_view = NSScrollView.alloc().initWithFrame_(NSMakeRect(0, 0, 310, 566))
         scroll_view.setAutoresizingMask_(1 << 1 | 1 << 3)
 
         print("Creating history table and panel")
@@ -144,7 +198,7 @@ class MurmurAppDelegate(NSObject):
         self.right_view.addSubview_(self.provider_label)
 
         self.provider_popup = NSPopUpButton.alloc().initWithFrame_(NSMakeRect(92, 546, 150, 26)) #was 100 536 150 28
-        self.provider_popup.addItemsWithTitles_(["OpenAI", "Claude", "Gemini"])
+        self.provider_popup.addItemsWithTitles_([p.title for p in PROVIDERS.values()])
         self.provider_popup.setTarget_(self)
         self.provider_popup.setAction_("providerChanged:")
         self.right_view.addSubview_(self.provider_popup)
@@ -161,7 +215,7 @@ class MurmurAppDelegate(NSObject):
         self.right_view.addSubview_(self.model_label)
 
         self.model_popup = NSPopUpButton.alloc().initWithFrame_(NSMakeRect(312, 546, 180, 26)) #was 420 205 250 26
-        #self.model_popup.addItemsWithTitles_(["gpt-3.5-turbo"])
+        self.model_popup.addItemsWithTitles_([next(iter(PROVIDERS.values())).default_model])
         self.right_view.addSubview_(self.model_popup)
         
         print("Creating Output Window")
@@ -187,74 +241,134 @@ class MurmurAppDelegate(NSObject):
         self.send_button.setAction_("sendClicked:")
         #self.send_button.setAction_("testButtonClicked:") # test
         self.right_view.addSubview_(self.send_button)
+
+        # --- Stop Button ---
+        self.stop_button = NSButton.alloc().initWithFrame_(NSMakeRect(365, 100, 110, 30))
+        self.stop_button.setTitle_("Stop")
+        self.stop_button.setBezelStyle_(NSBezelStyleRounded)
+        self.stop_button.setTarget_(self)
+        self.stop_button.setAction_("stopClicked:")
+        self.stop_button.setEnabled_(False)
+        self.right_view.addSubview_(self.stop_button)
+
+        # --- Compare Button: one prompt to every provider with a key ---
+        self.compare_button = NSButton.alloc().initWithFrame_(NSMakeRect(250, 100, 110, 30))
+        self.compare_button.setTitle_("Compare")
+        self.compare_button.setBezelStyle_(NSBezelStyleRounded)
+        self.compare_button.setTarget_(self)
+        self.compare_button.setAction_("compareClicked:")
+        self.right_view.addSubview_(self.compare_button)
+
+        self.first_wins_checkbox = NSButton.alloc().initWithFrame_(NSMakeRect(10, 105, 200, 20))
+        self.first_wins_checkbox.setButtonType_(3)  # NSButtonTypeSwitch
+        self.first_wins_checkbox.setTitle_("First answer wins")
+        self.right_view.addSubview_(self.first_wins_checkbox)
         self.split_view.addSubview_(self.right_view)
 
         print("Murmur: adding content view...")
         self.window.setContentView_(self.split_view)
         self.window.makeKeyAndOrderFront_(None)
         NSApp.activateIgnoringOtherApps_(True)
+        startup.mark("window")
+
+        # Anything touching the network or the disk waits until the window has drawn
+        AppHelper.callLater(0, self.finish_launching)
 
-        self.providerChanged_(self.provider_popup)  # trigger model update manually
+    @objc.python_method
+    def finish_launching(self):
+        startup.mark("first_paint")
+        self.providerChanged_(self.provider_popup)  # cached models now, a refresh in the background
+        threading.Thread(target=self.open_history, name="murmur-history", daemon=True).start()
 
+    @objc.python_method
+    def open_history(self):
+        # Runs off the main thread; the table is pointed at the store once it is open
         try:
-            #self.provider_popup.selectItemWithTitle_(provider.capitalize())
-            self.load_history()
-            print("Murmur: history loaded")
+            self.history.open()
         except Exception as e:
             print(f"Murmur: failed to load history - {e}")
+            return
+        AppHelper.callAfter(self.load_history)
+        PROVIDERS[self.chat_service.provider].warm_up()  # so the first send doesn't pay for the import
+        load_sdk("tiktoken")
+        prefs = settings.snapshot()
+        if prefs.get("semantic_cache"):
+            # Imports numpy and maps the vectors, so not before first paint
+            self.chat_service.set_semantic_cache(SemanticCache(
+                threshold=prefs.get("semantic_cache_threshold", SEMANTIC_THRESHOLD),
+                ttl=prefs.get("response_cache_ttl", RESPONSE_CACHE_TTL),
+                scope=prefs.get("semantic_cache_scope", "model"),
+            ))
+        self.search_index = HistorySearchIndex()
+        self.search_index.catch_up(self.history)
+
+    @objc.python_method
+    def settings_changed(self, changes):
+        # ChatService picks up keys itself; this handles what the UI shows
+        if "theme" in changes:
+            apply_theme(changes["theme"])
+        if "tracing" in changes:
+            tracer.enable(bool(changes["tracing"]))
+        if f"api_key_{self.chat_service.provider}" in changes:
+            self.providerChanged_(self.provider_popup)
 
-        self.populate_model_dropdown(provider, api_key)
-        
     def populate_model_dropdown(self, provider, api_key):
+        # Show the cached list straight away; the catalog refreshes it in the
+        # background and calls back if the provider returns something new
         print(f"Populating model dropdown for provider: {provider}")
         models = []
-        if provider == "openai":
-            models = get_openai_models(api_key)
-        elif provider == "claude":
-            models = get_claude_models(api_key)
-        elif provider == "gemini":
-            models = get_gemini_models(api_key)
-
-        print("Updating model dropdown with:", models)
-        self.model_popup.removeAllItems()
-        self.model_popup.addItemsWithTitles_(models or ["gpt-3.5-turbo"])
+        if api_key:
+            models = self.model_catalog.get(
+                provider, api_key,
+                on_update=lambda fresh: self.update_model_dropdown(provider, fresh),
+            )
+        self.update_model_dropdown(provider, models)
 
     def providerChanged_(self, sender):
-        selected = sender.titleOfSelectedItem().lower()
+        selected = list(PROVIDERS)[sender.indexOfSelectedItem()]
         self.chat_service.provider = selected
-        api_key = self.chat_service.api_key
-        #self.populate_model_dropdown(selected, api_key)
-
-        print(f"Populating model dropdown for provider: {selected}")
-
-        if selected == "openai" and api_key:
-            print(f"Fetching models using API key: {api_key[:10]}...")
-            models = get_openai_models(api_key)
-            print(f"Found models: {models}")
-            chat_models = [m for m in models if "gpt" in m and not any(x in m for x in ["tts", "image", "embedding", "dall-e", "whisper"])]
-            self.model_popup.removeAllItems()
-            self.model_popup.addItemsWithTitles_(chat_models or ["gpt-3.5-turbo"])
-            print(f"Updating model dropdown with: {chat_models}")
-
-        elif selected == "claude" and api_key:
-            models = get_claude_models(api_key)
-            chat_models = [m for m in models if m.startswith("claude-")]
-            self.model_popup.removeAllItems()
-            self.model_popup.addItemsWithTitles_(chat_models or ["claude-sonnet-4"])
-
-        elif selected == "gemini" and api_key:
-            models = get_gemini_models(api_key)
-            chat_models = [m for m in models if m.startswith("gemini-")]
-            self.model_popup.removeAllItems()
-            self.model_popup.addItemsWithTitles_(chat_models or ["gemini-2.5-flash"])   
-
-    def update_model_dropdown(self, models):
-        self.model_dropdown.removeAllItems()
-        for model in models:
-            self.model_dropdown.addItemWithTitle_(model)
-
-        if models:
-            self.model_dropdown.selectItemAtIndex_(0)
+        api_key = self.chat_service.api_keys.get(selected, "")
+        self.populate_model_dropdown(selected, api_key)
+
+    @objc.python_method
+    def update_model_dropdown(self, provider, models):
+        if provider != self.chat_service.provider:
+            return  # the user has switched provider since this list was requested
+        spec = PROVIDERS[provider]
+        chat_models = [m for m in models if spec.model_filter(m)]
+        # Most used first, each with its recent speed; the item's represented
+        # object is the bare model name
+        chat_models = self.usage_ledger.rank(provider, chat_models)
+        print(f"Updating model dropdown with: {chat_models}")
+
+        current = self.selected_model()
+        self.model_popup.removeAllItems()
+        for model in chat_models or [spec.default_model]:
+            self.model_popup.addItemWithTitle_(self.model_title(provider, model))
+            self.model_popup.lastItem().setRepresentedObject_(model)
+        if current in chat_models:
+            self.model_popup.selectItemAtIndex_(chat_models.index(current))
+
+    @objc.python_method
+    def model_title(self, provider, model):
+        note = self.usage_ledger.annotate(provider, model)
+        return f"{model}  ({note})" if note else model
+
+    @objc.python_method
+    def selected_model(self):
+        item = self.model_popup.selectedItem()
+        if item is None:
+            return ""
+        return str(item.representedObject() or item.title())
+
+    @objc.python_method
+    def refresh_model_title(self, provider, model):
+        # New numbers after a request; the order is left alone until the list is rebuilt
+        if provider != self.chat_service.provider:
+            return
+        index = self.model_popup.indexOfItemWithRepresentedObject_(model)
+        if index >= 0:
+            self.model_popup.itemAtIndex_(index).setTitle_(self.model_title(provider, model))
 
     def testButtonClicked_(self, sender):
         print("Test button click!")
@@ -267,32 +381,185 @@ class MurmurAppDelegate(NSObject):
             return
         self.input_field.setStringValue_("")
 
-        current_provider = str(self.provider_popup.titleOfSelectedItem())
-        current_model = str(self.model_popup.titleOfSelectedItem())
+        current_provider = self.chat_service.provider
+        current_model = self.selected_model()
     
-        print(f"Provider: {current_provider}, Model: {current_model}, Prompt: {prompt}")
+        print(f"Provider: {current_provider}, Model: {current_model}")
+
+        # --- Show the prompt now; the response streams in on a worker thread ---
+        # Holding Option while sending skips the response cache
+        bypass_cache = bool(NSEvent.modifierFlags() & NSEventModifierFlagOption)
+        request = self.chat_service.submit(
+            current_provider, current_model, prompt,
+            on_delta=self.request_delta, on_done=self.request_done, bypass_cache=bypass_cache,
+        )
+        self.append_output(f"\nYou: {prompt}\nMurmur: ")
+        request.segment = self.transcript.open_segment()
+        self.append_output("\n")
+        self.pending_requests.append(request)
+        self.stop_button.setEnabled_(True)
 
-        active_chat_client = self.chat_service.get_client(current_provider)
-        response_text = active_chat_client.send_message(prompt=prompt, model=current_model)
+    @objc.IBAction
+    def compareClicked_(self, sender):
+        prompt = self.input_field.stringValue()
+        if not prompt:
+            return
+        targets = self.compare_targets(
+            self.chat_service.provider,
+            self.selected_model(),
+        )
+        if not targets:
+            return
+        self.input_field.setStringValue_("")
+        print(f"Comparing {targets}")
 
-        # --- Display the new prompy and response in the output ---
-        existing_content = self.output_text.string()
-        new_display_content = f"{existing_content}\nYou: {prompt}\nMurmur: {response_text}\n"
-        self.output_text.setString_(new_display_content)
+        fan_out = self.chat_service.fan_out(
+            prompt, targets,
+            on_delta=self.request_delta,
+            on_result=lambda fan_out, request: self.request_done(request),
+            first_wins=bool(self.first_wins_checkbox.state()),
+        )
+        self.append_output(f"\nYou: {prompt}\n")
+        for request in fan_out.requests:
+            self.append_output(f"Murmur ({PROVIDERS[request.provider].title} {request.model}): ")
+            request.segment = self.transcript.open_segment()
+            self.append_output("\n")
+        self.pending_requests.append(fan_out)
+        self.stop_button.setEnabled_(True)
+
+    @objc.python_method
+    def compare_targets(self, current_provider, current_model):
+        # The selected model for the current provider, and the first cached
+        # chat model for every other provider that has a key
+        targets = []
+        for provider, api_key in self.chat_service.api_keys.items():
+            if not api_key:
+                continue
+            if provider == current_provider:
+                targets.append((provider, current_model))
+                continue
+            spec = PROVIDERS[provider]
+            models = [m for m in self.model_catalog.get(provider, api_key) if spec.model_filter(m)]
+            targets.append((provider, models[0] if models else spec.default_model))
+        return targets
 
-        # --- Save the new chat interaction to history ---
-        self.history.append({
-            "prompt": prompt,
-            "response": response_text,
-            "timestamp": datetime.now().isoformat()
+    @objc.IBAction
+    def stopClicked_(self, sender):
+        self.chat_service.cancel_all()
+
+    @objc.python_method
+    def request_delta(self, request, delta):
+        self.insert_output(request, delta)
+
+    @objc.python_method
+    def request_done(self, request):
+        if request.error:
+            self.insert_output(request, f"[Error: {request.error}]")
+        elif request.cancelled:
+            self.insert_output(request, " [cancelled]")
+        if request.fan_out and request.latency is not None:
+            self.insert_output(request, f"  ({request.latency:.1f} s)")
+        self.transcript.close(request.segment)
+        if not request.coalesced:
+            self.refresh_model_title(request.provider, request.model)
+
+        # --- Save finished requests to history in the order they were sent ---
+        while self.pending_requests and self.pending_requests[0].done():
+            finished = self.pending_requests.pop(0)
+            if isinstance(finished, FanOut):
+                self.record_fan_out(finished)
+            elif finished.response:
+                self.record_history(finished)
+        self.stop_button.setEnabled_(bool(self.pending_requests))
+
+    @objc.python_method
+    def record_history(self, request):
+        entry = {
+            "prompt": request.prompt,
+            "response": request.response,
+            "timestamp": datetime.now().isoformat(),
+            "time_to_first_token": request.stream.time_to_first_token,
+        }
+        if request.cancelled:
+            entry["cancelled"] = True
+        self.add_history_entry(entry)
+        if not request.cancelled:
+            self.chat_service.record_turn(request.prompt, request.response)
+
+    @objc.python_method
+    def record_fan_out(self, fan_out):
+        # All of the answers go into one history entry for the prompt
+        best = fan_out.best
+        if not best or not best.response:
+            return
+        responses = []
+        for request in fan_out.requests:
+            result = {
+                "provider": request.provider,
+                "model": request.model,
+                "response": request.response,
+                "latency": request.latency,
+            }
+            if request.error:
+                result["error"] = str(request.error)
+            if request.cancelled:
+                result["cancelled"] = True
+            responses.append(result)
+        self.add_history_entry({
+            "prompt": fan_out.prompt,
+            "response": best.response,
+            "timestamp": datetime.now().isoformat(),
+            "responses": responses,
         })
-        self.save_history() # Make sure this method is correctly implemented (it appears to be)
-        self.history_data_source = HistoryDataSource.alloc().initWithHistory_(self.history)
-        self.history_table.setDataSource_(self.history_data_source)
-        self.history_table.reloadData()
-        self.history_table.scrollRowToVisible_(len(self.history) - 1) # Scroll to the latest message
+        if best.succeeded:
+            self.chat_service.record_turn(fan_out.prompt, best.response)
+
+    @objc.python_method
+    def add_history_entry(self, entry):
+        if not self.history_loaded:
+            self.unsaved_history.append(entry)
+            return
+        row = self.save_history(entry)
+        if self.search_index:
+            self.search_index.add(row, entry)
+        self.history_table.noteNumberOfRowsChanged()
+        if self.history_data_source.rows is None:
+            self.history_table.scrollRowToVisible_(row) # Scroll to the latest message
+
+    @objc.python_method
+    def append_output(self, text):
+        self.transcript.append(text)
+        self.schedule_transcript_update()
+
+    @objc.python_method
+    def insert_output(self, request, text):
+        # Several responses can stream at once; each grows its own segment
+        self.transcript.insert(request.segment, text)
+        self.schedule_transcript_update()
+
+    @objc.python_method
+    def schedule_transcript_update(self):
+        # Deltas that arrive in the same run loop turn reach the view together
+        if not self.transcript_update_scheduled:
+            self.transcript_update_scheduled = True
+            AppHelper.callAfter(self.update_transcript)
+
+    @objc.python_method
+    def update_transcript(self):
+        self.transcript_update_scheduled = False
+        edits = self.transcript.take_edits()
+        if not edits:
+            return
+        storage = self.output_text.textStorage()
+        attributes = self.output_text.typingAttributes()
+        storage.beginEditing()
+        for edit in edits:
+            attributed = NSAttributedString.alloc().initWithString_attributes_(edit.text, attributes)
+            storage.replaceCharactersInRange_withAttributedString_((edit.location, edit.length), attributed)
+        storage.endEditing()
+        last = edits[-1]
+        self.output_text.scrollRangeToVisible_((last.location + utf16_length(last.text), 0))
 
-    
     def create_main_menu(self):
         main_menu = NSMenu.alloc().init()
         app_menu_item = NSMenuItem.alloc().init()
@@ -320,6 +587,25 @@ class MurmurAppDelegate(NSObject):
         settings_item.setTarget_(self)
         app_menu.addItem_(settings_item)
 
+        # --- Usage Report ---
+        usage_item = NSMenuItem.alloc().initWithTitle_action_keyEquivalent_(
+            "Usage Report", "showUsageReport:", ""
+        )
+        usage_item.setTarget_(self)
+        app_menu.addItem_(usage_item)
+
+        # --- Export / Import History ---
+        export_item = NSMenuItem.alloc().initWithTitle_action_keyEquivalent_(
+            "Export History...", "exportHistory:", ""
+        )
+        export_item.setTarget_(self)
+        app_menu.addItem_(export_item)
+        import_item = NSMenuItem.alloc().initWithTitle_action_keyEquivalent_(
+            "Import History...", "importHistory:", ""
+        )
+        import_item.setTarget_(self)
+        app_menu.addItem_(import_item)
+
         app_menu_item.setSubmenu_(app_menu)
 
         # --- Separator ---
@@ -379,6 +665,84 @@ class MurmurAppDelegate(NSObject):
     def openAbout_(self, sender):
         show_about_panel()
 
+    def showUsageReport_(self, sender):
+        # Requests, tokens, cost and speed per day and model, shown in the
+        # output view; the ledger is read on a worker thread
+        def build():
+            report = format_report(self.usage_ledger.daily_report())
+            AppHelper.callAfter(self.show_usage_report, report)
+        threading.Thread(target=build, name="murmur-usage-report", daemon=True).start()
+
+    def exportHistory_(self, sender):
+        # The format follows the extension (.md, .jsonl or .csv). Whatever is
+        # typed in the history search box narrows the export the same way.
+        if not self.history_loaded:
+            return
+        panel = NSSavePanel.savePanel()
+        panel.setNameFieldStringValue_("Murmur History.md")
+        if panel.runModal() != NSModalResponseOK:
+            return
+        path = str(panel.URL().path())
+        search = str(self.search_field.stringValue()).strip() or None
+
+        def run():
+            try:
+                count = export_history(self.history, path, search=search)
+                message = f"Exported {count} history entries to {os.path.basename(path)}"
+            except (OSError, ValueError) as e:
+                message = f"Export failed - {e}"
+            print(f"Murmur: {message}")
+            AppHelper.callAfter(self.append_output, f"\n[{message}]\n")
+        threading.Thread(target=run, name="murmur-export", daemon=True).start()
+
+    def importHistory_(self, sender):
+        # Murmur exports, the old chat_history.json, or a ChatGPT or Claude
+        # data export; entries keep their dates and go in by period. The file
+        # is read on a worker, the rows change on the main thread.
+        if not self.history_loaded:
+            return
+        panel = NSOpenPanel.openPanel()
+        panel.setAllowedFileTypes_([extension.lstrip(".") for extension in EXTENSIONS])
+        if panel.runModal() != NSModalResponseOK:
+            return
+        path = str(panel.URL().path())
+
+        def run():
+            try:
+                batch = prepare_import(self.history, path)
+            except (OSError, ValueError) as e:
+                message = f"Import failed - {e}"
+                print(f"Murmur: {message}")
+                AppHelper.callAfter(self.append_output, f"\n[{message}]\n")
+                return
+            AppHelper.callAfter(self.history_imported, batch, path)
+        threading.Thread(target=run, name="murmur-import", daemon=True).start()
+
+    @objc.python_method
+    def history_imported(self, batch, path):
+        try:
+            count = self.history.commit_import(batch)
+            message = f"Imported {count} history entries from {os.path.basename(path)}"
+        except (OSError, ValueError) as e:
+            count = 0
+            message = f"Import failed - {e}"
+        print(f"Murmur: {message}")
+        self.history_table.reloadData()
+        self.append_output(f"\n[{message}]\n")
+        if count and self.search_index:
+            # Rows moved, so the index is built again; the search shown is rerun after
+            threading.Thread(target=self.reindex_history, name="murmur-search", daemon=True).start()
+
+    @objc.python_method
+    def reindex_history(self):
+        self.search_index.catch_up(self.history)
+        AppHelper.callAfter(self.searchChanged_, self.search_field)
+
+    @objc.python_method
+    def show_usage_report(self, report):
+        self.transcript.replace_all(f"Usage over the last {REPORT_DAYS} days\n\n{report}\n")
+        self.schedule_transcript_update()
+
     def openSettings_(self, sender):
         main_frame = self.window.frame()
         settings_frame = self.settings_window.frame()
@@ -389,31 +753,60 @@ class MurmurAppDelegate(NSObject):
 
    
 
-    def save_history(self):
-        os.makedirs(os.path.dirname(HISTORY_PATH), exist_ok=True)
-        with open(HISTORY_PATH, "w", encoding="utf-8") as f:
-            json.dump(self.history, f)
+    @objc.python_method
+    def save_history(self, entry):
+        return self.history.append(entry)
 
     def load_history(self):
-        if os.path.exists(HISTORY_PATH):
-            with open(HISTORY_PATH, "r", encoding="utf-8") as f:
-                self.history = json.load(f)
-        else:
-            self.history = []
-
+        # On the main thread, once open_history has the store open
+        self.history_loaded = True
         self.history_data_source = HistoryDataSource.alloc().initWithHistory_(self.history)
         self.history_table.setDataSource_(self.history_data_source)
         self.history_table.reloadData()
+        for entry in self.unsaved_history:
+            self.add_history_entry(entry)
+        self.unsaved_history = []
+        startup.mark("history")
+        startup.report(STARTUP_REPORT_PATH)
+
+    def searchChanged_(self, sender):
+        query = str(sender.stringValue()).strip()
+        if not self.search_index:
+            return  # still opening; the search runs again on the next keystroke
+        self.history_data_source.set_filter(self.search_index.search(query) if query else None)
+        self.history_table.reloadData()
 
     def tableViewSelectionDidChange_(self, notification):
         row = self.history_table.selectedRow()
+        if row < 0:
+            return
+        row = self.history_data_source.history_row(row)
         if 0 <= row < len(self.history):
             item = self.history[row]
-            display = f"You: {item['prompt']}\nMurmur: {item['response']}\n"
-            self.output_text.setString_(display)
+            display = f"You: {item['prompt']}\n"
+            if "responses" in item:
+                for result in item["responses"]:
+                    latency = f"  ({result['latency']:.1f} s)" if result.get("latency") is not None else ""
+                    display += f"Murmur ({PROVIDERS[result['provider']].title if result['provider'] in PROVIDERS else result['provider']} {result['model']}): {result['response']}{latency}\n"
+            else:
+                display += f"Murmur: {item.get('response', '')}\n"
+            # Responses still streaming keep going, just not into this view
+            self.transcript.replace_all(display)
+            self.schedule_transcript_update()
 
     def windowWillClose_(self, notification):
         if notification.object() == self.window:
+            self.chat_service.shutdown()
+            settings.flush()
+            self.history.close()
+            if self.search_index:
+                self.search_index.close()
+            if self.chat_service.semantic_cache is not None:
+                self.chat_service.semantic_cache.close()
+            self.usage_ledger.close()
+            if tracer.enabled:
+                tracer.export(os.path.join(HISTORY_DIR, "trace.json"))
+                tracer.export(os.path.join(HISTORY_DIR, "trace.prom"))
             NSApp.terminate_(self)
 
 if __name__ == "__main__":
@@ -9,7 +9,6 @@
 
 
 import os
-import json
 import objc
 from Cocoa import (
     NSWindow, NSTextField, NSSecureTextField, NSPopUpButton, NSButton, NSMakeRect,
@@ -17,8 +16,8 @@ from Cocoa import (
     NSObject, NSImageView, NSView, NSFont, NSImage, NSApplication, NSBundle
 )
 
+from settings import settings
 
-PREFERENCES_PATH = os.path.expanduser("~/Library/Application Support/Murmur/preferences.json")
 
 NSLayoutConstraintPriorityRequired = 1000.0
 
@@ -29,16 +28,22 @@ Developed by Tim Medley (tim@medley.us)"""
 LOGO_PATH = os.path.expanduser("Resources/logo.png")
 
 def load_preferences():
-    if os.path.exists(PREFERENCES_PATH):
-        with open(PREFERENCES_PATH, "r") as f:
-            return json.load(f)
-    return {}
+    # A copy of the in-memory settings; preferences.json is parsed only once
+    return settings.snapshot()
 
 
 def save_preferences(prefs):
-    os.makedirs(os.path.dirname(PREFERENCES_PATH), exist_ok=True)
-    with open(PREFERENCES_PATH, "w") as f:
-        json.dump(prefs, f)
+    settings.update(prefs)
+
+
+def apply_theme(theme):
+    from Cocoa import NSApp
+    if theme == "dark":
+        NSApp.setAppearance_(objc.lookUpClass("NSAppearance").appearanceNamed_("NSAppearanceNameDarkAqua"))
+    elif theme == "light":
+        NSApp.setAppearance_(objc.lookUpClass("NSAppearance").appearanceNamed_("NSAppearanceNameAqua"))
+    else:
+        NSApp.setAppearance_(None)
 
 
 class SettingsWindow(NSWindow):
@@ -55,7 +60,7 @@ class SettingsWindow(NSWindow):
         self.setTitle_("Settings")
         self.setReleasedWhenClosed_(False)
 
-        prefs = load_preferences()
+        prefs = settings.snapshot()
 
         # theme drop down
         self.dark_mode_label = NSTextField.alloc().initWithFrame_(NSMakeRect(20, 220, 100, 20))
@@ -105,22 +110,12 @@ class SettingsWindow(NSWindow):
         selected_index = self.theme_popup.indexOfSelectedItem()
         theme = {0: "system", 1: "light", 2: "dark"}.get(selected_index, "system")
 
-        prefs = load_preferences()
-        prefs["theme"] = theme
-
+        changes = {"theme": theme}
         for name, field in self.api_fields.items():
-            prefs[f"api_key_{name.lower()}"] = field.stringValue()
-
-        save_preferences(prefs)
+            changes[f"api_key_{name.lower()}"] = str(field.stringValue())
 
-        # Dynamically apply theme
-        from Cocoa import NSApp
-        if theme == "dark":
-            NSApp.setAppearance_(objc.lookUpClass("NSAppearance").appearanceNamed_("NSAppearanceNameDarkAqua"))
-        elif theme == "light":
-            NSApp.setAppearance_(objc.lookUpClass("NSAppearance").appearanceNamed_("NSAppearanceNameAqua"))
-        else:
-            NSApp.setAppearance_(None)
+        # Subscribers (the app delegate, ChatService) apply the theme and keys
+        settings.update(changes)
 
         self.orderOut_(None)
 
@@ -200,9 +195,5 @@ def show_about_panel():
 
 
 def get_api_keys():
-    prefs = load_preferences()
-    return {
-        "openai": prefs.get("openai_api_key", ""),
-        "claude": prefs.get("claude_api_key", ""),
-        "gemini": prefs.get("gemini_api_key", "")
-    }
\ No newline at end of file
+    # The same api_key_<provider> names savePreferences_ writes
+    return settings.api_keys()
@@ -0,0 +1,134 @@
+# settings.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# Settings storage, shared by the app, the settings window and batch.py
+#
+# preferences.json is read once and kept in memory. Changes are written back
+# through a temp file and a rename, FLUSH_DELAY seconds after the last one so
+# a burst of changes is a single write, and listeners are told which keys
+# changed. Nothing here touches Cocoa.
+
+
+import os
+import json
+import atexit
+import threading
+
+
+PREFERENCES_PATH = os.path.expanduser("~/Library/Application Support/Murmur/preferences.json")
+FLUSH_DELAY = 0.5  # seconds
+
+
+class Settings:
+    def __init__(self, path=PREFERENCES_PATH, flush_delay=FLUSH_DELAY):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.listeners = []
+        self._values = None  # parsed on first use
+        self._dirty = False
+        self._timer = None
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()  # one flush at a time, in order
+        atexit.register(self.flush)
+
+    @property
+    def values(self) -> dict:
+        with self._lock:
+            if self._values is None:
+                self._values = self._load()
+            return self._values
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.values)
+
+    def api_keys(self, providers=("openai", "claude", "gemini")) -> dict:
+        # Keys are stored as api_key_<provider>
+        return {name: self.values.get(f"api_key_{name}", "") for name in providers}
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    def update(self, changes):
+        with self._lock:
+            values = self.values
+            changed = {key: value for key, value in changes.items() if values.get(key) != value}
+            if not changed:
+                return {}
+            values.update(changed)
+            self._dirty = True
+            self._schedule_flush()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener(changed)
+            except Exception as e:
+                print(f"Settings: listener failed - {e}")
+        return changed
+
+    def subscribe(self, listener):
+        # listener(changes) is called with {key: new value} after every update,
+        # on the thread that made the change
+        with self._lock:
+            self.listeners.append(listener)
+        return listener
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                values = dict(self._values)
+                self._dirty = False
+            try:
+                self._write(values)
+            except OSError as e:
+                print(f"Settings: could not save {self.path} - {e}")
+                with self._lock:
+                    self._dirty = True
+
+    def _schedule_flush(self):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = threading.Timer(self.flush_delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                values = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"Settings: could not read {self.path} - {e}")
+            return {}
+        return values if isinstance(values, dict) else {}
+
+    def _write(self, values):
+        # The file holds API keys, so it is only readable by the user
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(values, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+settings = Settings()
@@ -0,0 +1,105 @@
+# tests/test_batch_api.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# OpenAIBatchClient and batch.py --batch-api against the mock server's
+# files and batches endpoints
+
+
+import os
+import json
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import batch
+from backend import OpenAIBatchClient, load_sdk
+from mockserver import MockServer
+
+
+@unittest.skipUnless(load_sdk("openai"), "needs the openai package")
+class BatchAPITest(unittest.TestCase):
+    def setUp(self):
+        random.seed(7)
+        self.server = MockServer(error_rate=0.25, batch_latency=0.1).start()
+        self.addCleanup(self.server.stop)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def client(self):
+        client = OpenAIBatchClient("mock-key", base_url=self.server.url, poll_interval=0.02)
+        client.MAX_REQUESTS = 7  # several input files from a small run
+        return client
+
+    def test_run_answers_every_item_with_its_own_prompt(self):
+        items = [(f"item{i}", f"prompt {i} " + "é" * i) for i in range(20)]
+        results = list(self.client().run(iter(items), "gpt-4o-mini", self.directory.name))
+
+        self.assertEqual(self.server.counts["batches"], 3)
+        by_id = {result["batch_item"]: result for result in results}
+        self.assertEqual(sorted(by_id), sorted(item_id for item_id, _ in items))
+        for item_id, prompt in items:
+            # custom_id is "<id>@<offset>": the prompt comes back by seeking the input file
+            self.assertEqual(by_id[item_id]["prompt"], prompt)
+            self.assertEqual(by_id[item_id]["model"], "gpt-4o-mini")
+        failed = [result for result in results if "error" in result]
+        self.assertTrue(failed)
+        self.assertTrue(all(result["error"] == "injected error" and result["response"] == "" for result in failed))
+        answered = [result for result in results if "error" not in result]
+        self.assertTrue(all(result["response"] == self.server.reply for result in answered))
+
+    def test_custom_id_offsets_point_at_their_lines(self):
+        items = [(i, f"prompt {i}") for i in range(10)]
+        for path in self.client().write_input_files(iter(items), "gpt-4o-mini", self.directory.name):
+            with open(path, "rb") as f:
+                data = f.read()
+            for line in data.splitlines():
+                request = json.loads(line)
+                offset = int(request["custom_id"].rsplit("@", 1)[1])
+                self.assertEqual(data[offset:offset + len(line)], line)
+
+    def test_batch_command_resumes_and_retries_failures(self):
+        inputs = os.path.join(self.directory.name, "prompts.jsonl")
+        output = os.path.join(self.directory.name, "results.jsonl")
+        with open(inputs, "w", encoding="utf-8") as f:
+            for i in range(10):
+                f.write(json.dumps({"id": f"p{i}", "prompt": f"question {i}"}) + "\n")
+            f.write("{not json\n")
+        keys = {"OPENAI_API_KEY": "mock-key", "CLAUDE_API_KEY": "-", "GEMINI_API_KEY": "-"}
+        argv = [inputs, output, "--batch-api", "--base-url", self.server.url]
+        with mock.patch.dict(os.environ, keys), mock.patch.object(OpenAIBatchClient, "MAX_REQUESTS", 4), \
+                mock.patch.object(OpenAIBatchClient, "__init__", self.patched_init()):
+            batch.main(argv)
+            batches = self.server.counts["batches"]
+            with open(output, encoding="utf-8") as f:
+                results = [json.loads(line) for line in f]
+            self.assertEqual(len(results), 11)
+            self.assertEqual(batches, 3)
+            self.assertEqual(sum("error" in result for result in results), len(results) - len(batch.completed_ids(output)))
+
+            # The saved state says every batch is collected, so nothing is sent again
+            batch.main(argv)
+            self.assertEqual(self.server.counts["batches"], batches)
+
+            # Without it, only what failed goes out again
+            os.remove(f"{output}.batches.json")
+            batch.main(argv)
+            self.assertGreater(self.server.counts["batches"], batches)
+            with open(output, encoding="utf-8") as f:
+                retried = [json.loads(line) for line in f][len(results):]
+            self.assertEqual({result["id"] for result in retried},
+                             {result["id"] for result in results if "error" in result})
+
+    def patched_init(self):
+        init = OpenAIBatchClient.__init__
+
+        def patched(client, api_key, base_url=None, poll_interval=10.0, max_poll_interval=300.0):
+            init(client, api_key, base_url, poll_interval=0.02)
+        return patched
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+# tests/test_export.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# Exports read back into a fresh HistoryStore
+
+
+import os
+import tempfile
+import unittest
+
+from export import export_history, import_history
+from history import HistoryStore
+
+
+ENTRIES = [
+    {"prompt": "What is 2 + 2?", "response": "4", "timestamp": "2025-03-01T10:00:00"},
+    {"prompt": "Name a colour", "response": "blue", "timestamp": "2025-03-02T10:00:00", "responses": [
+        {"provider": "openai", "model": "gpt-4o", "response": "red", "latency": 1.5},
+        {"provider": "claude", "model": "claude-x", "response": "blue", "latency": 0.7},
+        {"provider": "gemini", "model": "gemini-x", "response": "", "latency": 0.2, "error": "overloaded"},
+    ]},
+]
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def store(self, name):
+        path = os.path.join(self.directory.name, name, "chat_history.jsonl")
+        store = HistoryStore(path, legacy_path=os.path.join(self.directory.name, "none.json")).open()
+        self.addCleanup(store.close)
+        return store
+
+    def round_trip(self, extension) -> list:
+        store = self.store("original")
+        for entry in ENTRIES:
+            store.append(dict(entry))
+        path = os.path.join(self.directory.name, f"export{extension}")
+        self.assertEqual(export_history(store, path), len(ENTRIES))
+        imported = self.store(f"imported{extension}")
+        self.assertEqual(import_history(imported, path), len(ENTRIES))
+        return [imported[row] for row in range(len(imported))]
+
+    def test_csv_keeps_single_answers_as_the_response(self):
+        single, fan_out = self.round_trip(".csv")
+        # The history view shows "responses" when the key is there at all
+        self.assertNotIn("responses", single)
+        self.assertEqual(single["response"], "4")
+        self.assertEqual(fan_out["responses"], ENTRIES[1]["responses"])
+        self.assertEqual(fan_out["response"], "blue")
+
+    def test_markdown_keeps_latencies_errors_and_the_chosen_answer(self):
+        single, fan_out = self.round_trip(".md")
+        self.assertNotIn("responses", single)
+        self.assertEqual(single["response"], "4")
+        self.assertEqual(fan_out["response"], "blue")
+        self.assertEqual(fan_out["responses"], ENTRIES[1]["responses"])
+
+
+if __name__ == "__main__":
+    unittest.main()
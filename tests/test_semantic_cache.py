@@ -0,0 +1,119 @@
+# tests/test_semantic_cache.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# SemanticCache hits, misses, scopes and eviction, with the built-in
+# hashed_embedding so nothing leaves the machine
+
+
+import tempfile
+import unittest
+
+from backend import ChatService, SemanticCache, hashed_embedding, load_sdk
+from mockserver import MockServer
+
+
+@unittest.skipUnless(load_sdk("numpy"), "needs numpy")
+class SemanticCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def cache(self, **options):
+        # Persisted like the app's, in a directory of its own
+        cache = SemanticCache(self.directory.name, embed=hashed_embedding, **options)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_rewording_hits_and_other_questions_miss(self):
+        cache = self.cache()
+        cache.put("openai", "gpt-4o", "What is the capital of France?", "Paris")
+        self.assertEqual(cache.get("openai", "gpt-4o", "what is the capital of france"), "Paris")
+        self.assertEqual(cache.get("openai", "gpt-4o", "So, what is the capital of France?"), "Paris")
+        self.assertIsNone(cache.get("openai", "gpt-4o", "How do I sort a list in Python?"))
+        # Close in wording, different question: below the default threshold
+        self.assertIsNone(cache.get("openai", "gpt-4o", "What is the capital of Spain?"))
+        self.assertEqual(cache.stats["hits"], 2)
+        self.assertEqual(cache.stats["misses"], 2)
+
+    def test_threshold_decides_how_close_is_close_enough(self):
+        cache = self.cache(threshold=0.8)
+        cache.put("openai", "gpt-4o", "What is the capital of France?", "Paris")
+        self.assertEqual(cache.get("openai", "gpt-4o", "What is the capital of Spain?"), "Paris")
+
+    def test_scope_keeps_models_and_conversations_apart(self):
+        cache = self.cache()
+        chat = [{"role": "user", "content": "Let's talk about Rust"}, {"role": "assistant", "content": "Sure"}]
+        cache.put("openai", "gpt-4o", "How do I read a file?", "std::fs::read_to_string", context=chat)
+        self.assertEqual(cache.get("openai", "gpt-4o", "How do I read a file?", context=chat),
+                         "std::fs::read_to_string")
+        self.assertIsNone(cache.get("openai", "gpt-4o", "How do I read a file?"))
+        self.assertIsNone(cache.get("openai", "gpt-4o-mini", "How do I read a file?", context=chat))
+        self.assertIsNone(cache.get("claude", "gpt-4o", "How do I read a file?", context=chat))
+
+    def test_provider_scope_shares_answers_across_models(self):
+        cache = self.cache(scope="provider")
+        cache.put("openai", "gpt-4o", "Name a prime number", "7")
+        self.assertEqual(cache.get("openai", "gpt-4o-mini", "Name a prime number"), "7")
+        self.assertIsNone(cache.get("claude", "claude-x", "Name a prime number"))
+
+    def test_any_scope_shares_answers_across_providers(self):
+        cache = self.cache(scope="any")
+        cache.put("openai", "gpt-4o", "Name a prime number", "7")
+        self.assertEqual(cache.get("claude", "claude-x", "Name a prime number"), "7")
+
+    def test_expired_entries_miss_and_free_their_rows(self):
+        cache = self.cache()
+        cache.put("openai", "gpt-4o", "old question", "old answer", ttl=-1)
+        self.assertIsNone(cache.get("openai", "gpt-4o", "old question"))
+        cache.put("openai", "gpt-4o", "new question", "new answer")
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.count, 1)  # the expired row was reused
+
+    def test_least_recently_used_entry_is_evicted_when_full(self):
+        cache = self.cache(max_entries=3)
+        for i in range(3):
+            cache.put("openai", "gpt-4o", f"question number {i}", f"answer {i}")
+        self.assertEqual(cache.get("openai", "gpt-4o", "question number 0"), "answer 0")
+        cache.put("openai", "gpt-4o", "question number 3", "answer 3")
+        self.assertEqual(cache.stats["evictions"], 1)
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get("openai", "gpt-4o", "question number 1"))
+        self.assertEqual(cache.get("openai", "gpt-4o", "question number 0"), "answer 0")
+
+    def test_scopes_are_dropped_with_their_last_entry(self):
+        cache = self.cache(max_entries=10)
+        for i in range(200):
+            chat = [{"role": "user", "content": f"conversation {i}"}]
+            cache.put("openai", "gpt-4o", f"follow-up {i}", f"answer {i}", context=chat)
+        self.assertEqual(len(cache), 10)
+        self.assertEqual(len(cache.scope_ids), 10)
+        self.assertLess(int(cache.scopes[:cache.count].max()), 10)
+        cache.clear()
+        self.assertEqual(cache.scope_ids, {})
+
+    def test_entries_survive_reopening(self):
+        cache = SemanticCache(self.directory.name, embed=hashed_embedding)
+        cache.put("openai", "gpt-4o", "What is the capital of France?", "Paris")
+        cache.put("openai", "gpt-4o", "expired", "gone", ttl=-1)
+        cache.close()
+        reopened = self.cache()
+        self.assertEqual(reopened.get("openai", "gpt-4o", "What is the capital of France?"), "Paris")
+        self.assertEqual(len(reopened.scope_ids), 1)
+
+    def test_service_answers_from_an_empty_cache_once_filled(self):
+        # An empty cache has len 0; it must still be used
+        server = MockServer().start()
+        self.addCleanup(server.stop)
+        service = ChatService("claude", api_keys={"claude": "key"}, base_urls={"claude": server.url[:-3]},
+                              semantic_cache=self.cache())
+        self.addCleanup(service.shutdown)
+        for prompt in ("What is the capital of France?", "what is the capital of france"):
+            service.submit("claude", "claude-x", prompt).future.result(5)
+        self.assertEqual(server.counts["completions"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
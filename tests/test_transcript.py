@@ -0,0 +1,126 @@
+# tests/test_transcript.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# TranscriptBuffer's edits, replayed on a simulated NSTextStorage
+
+
+import random
+import unittest
+
+from transcript import TranscriptBuffer, utf16_length
+
+
+class TextStorage:
+    # What the view holds: UTF-16 code units, edited by range like
+    # replaceCharactersInRange:withString:
+    def __init__(self):
+        self.units = []
+
+    def apply(self, edits):
+        for edit in edits:
+            self.assert_in_range(edit)
+            self.units[edit.location:edit.location + edit.length] = _units(edit.text)
+
+    def assert_in_range(self, edit):
+        if edit.location < 0 or edit.length < 0 or edit.location + edit.length > len(self.units):
+            raise AssertionError(f"{edit} outside a document of {len(self.units)} units")
+
+    def text(self) -> str:
+        return b"".join(unit.to_bytes(2, "little") for unit in self.units).decode("utf-16-le")
+
+
+def _units(text):
+    data = text.encode("utf-16-le")
+    return [int.from_bytes(data[i:i + 2], "little") for i in range(0, len(data), 2)]
+
+
+# Surrogate pairs and combining marks, where UTF-16 units and str indices differ
+WORDS = ["hello", " ", "\n", "é", "😀", "👩‍💻", "日本語", "é", "𝄞 clef", "You: ", "Murmur: "]
+
+
+class TranscriptBufferTest(unittest.TestCase):
+    def assertInSync(self, buffer, storage):
+        storage.apply(buffer.take_edits())
+        self.assertEqual(storage.text(), buffer.text())
+        self.assertEqual(len(storage.units), buffer.length)
+
+    def test_random_operations_match_the_view(self):
+        for seed in range(200):
+            rng = random.Random(seed)
+            buffer = TranscriptBuffer(max_length=rng.choice([20, 60, 200, 10000]))
+            storage = TextStorage()
+            streaming = []
+            for _ in range(rng.randint(1, 80)):
+                action = rng.random()
+                text = "".join(rng.choice(WORDS) for _ in range(rng.randint(0, 4)))
+                if action < 0.2:
+                    buffer.append(text or "x")
+                elif action < 0.35:
+                    streaming.append(buffer.open_segment(text))
+                elif action < 0.75 and streaming:
+                    # Detached segments (after replace_all or eviction) take writes and drop them
+                    buffer.insert(rng.choice(streaming), text)
+                elif action < 0.9 and streaming:
+                    buffer.close(streaming.pop(rng.randrange(len(streaming))))
+                elif action < 0.95:
+                    buffer.replace_all(text)
+                if rng.random() < 0.3:
+                    with self.subTest(seed=seed):
+                        self.assertInSync(buffer, storage)
+            with self.subTest(seed=seed):
+                self.assertInSync(buffer, storage)
+
+    def test_inserts_to_a_segment_in_the_middle_move_later_segments(self):
+        buffer = TranscriptBuffer()
+        storage = TextStorage()
+        first = buffer.open_segment("A: ")
+        second = buffer.open_segment("B: ")
+        buffer.append("\n")
+        buffer.insert(first, "😀")
+        buffer.insert(second, "two")
+        buffer.insert(first, "one")
+        self.assertInSync(buffer, storage)
+        self.assertEqual(storage.text(), "A: 😀oneB: two\n")
+        self.assertEqual(second.start, utf16_length("A: 😀one"))
+
+    def test_consecutive_inserts_merge_into_one_edit(self):
+        buffer = TranscriptBuffer()
+        segment = buffer.open_segment()
+        for delta in ("Hel", "lo", " 😀", "!"):
+            buffer.insert(segment, delta)
+        edits = buffer.take_edits()
+        self.assertEqual([(e.location, e.length, e.text) for e in edits], [(0, 0, "Hello 😀!")])
+
+    def test_eviction_drops_finished_segments_and_waits_for_open_ones(self):
+        buffer = TranscriptBuffer(max_length=10)
+        storage = TextStorage()
+        streaming = buffer.open_segment("streaming ")
+        buffer.append("0123456789")
+        self.assertEqual(buffer.length, 20)  # the open segment at the front holds eviction up
+        buffer.insert(streaming, "done")
+        buffer.close(streaming)
+        self.assertInSync(buffer, storage)
+        self.assertEqual(storage.text(), "0123456789")
+        self.assertTrue(streaming.detached)
+        buffer.insert(streaming, "late")
+        self.assertInSync(buffer, storage)
+        self.assertEqual(storage.text(), "0123456789")
+
+    def test_replace_all_detaches_streams_still_writing(self):
+        buffer = TranscriptBuffer()
+        storage = TextStorage()
+        streaming = buffer.open_segment("Murmur: ")
+        buffer.insert(streaming, "part")
+        self.assertInSync(buffer, storage)
+        buffer.replace_all("history entry")
+        buffer.insert(streaming, " more")
+        self.assertInSync(buffer, storage)
+        self.assertEqual(storage.text(), "history entry")
+        self.assertEqual(buffer.take_edits(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
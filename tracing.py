@@ -0,0 +1,236 @@
+# tracing.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# Timing spans and counters for the request and history hot paths
+#
+#   with tracer.span("request", "openai", model) as span:
+#       ...
+#       span.mark("first_byte")
+#
+# Off by default (MURMUR_TRACE=1 or tracer.enable() turns it on). While off,
+# span() hands back one shared do-nothing span, so an instrumented call costs
+# an attribute check and a method call. While on, each span keeps the last
+# WINDOW samples per (name, provider, model) for rolling p50/p95/p99. Prompts,
+# responses and keys are never recorded, only timings and token counts.
+
+
+import os
+import json
+import time
+import threading
+from collections import deque
+
+
+WINDOW = 1024  # most recent samples kept per series for percentiles
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Series:
+    __slots__ = ("samples", "count", "total")
+
+    def __init__(self):
+        self.samples = deque(maxlen=WINDOW)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+
+class Span:
+    __slots__ = ("tracer", "name", "provider", "model", "started", "marks", "parent")
+
+    def __init__(self, tracer, name, provider, model):
+        self.tracer = tracer
+        self.name = name
+        self.provider = provider
+        self.model = model
+        self.marks = []
+
+    def __enter__(self):
+        self.parent = getattr(self.tracer._local, "span", None)
+        self.started = time.perf_counter()
+        self.tracer._local.span = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        if getattr(self.tracer._local, "span", None) is self:
+            self.tracer._local.span = self.parent
+        self.tracer.record(self.name, elapsed, self.provider, self.model)
+        for mark, seconds in self.marks:
+            self.tracer.record(mark, seconds, self.provider, self.model)
+        if exc_type is not None:
+            self.tracer.count(f"{self.name}_errors", 1, self.provider, self.model)
+        return False
+
+    def mark(self, name):
+        # Time from the start of the span, recorded as its own series on exit
+        self.marks.append((name, time.perf_counter() - self.started))
+
+
+class NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def mark(self, name):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class Tracer:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.series = {}    # (name, provider, model) -> Series of seconds
+        self.counters = {}  # (name, provider, model) -> total
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def span(self, name, provider="", model=""):
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, provider, model)
+
+    def current(self):
+        # The span opened most recently on this thread, for hooks deeper down
+        # (like the HTTP trace callback) that want to mark it
+        if not self.enabled:
+            return None
+        return getattr(self._local, "span", None)
+
+    def record(self, name, seconds, provider="", model=""):
+        if not self.enabled:
+            return
+        key = (name, provider, model)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = Series()
+            series.add(seconds)
+
+    def count(self, name, value=1, provider="", model=""):
+        if not self.enabled:
+            return
+        key = (name, provider, model)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def usage(self, provider, model, usage):
+        # usage is the response's usage object (or dict), if the provider sent one
+        if not self.enabled or usage is None:
+            return
+        get = usage.get if isinstance(usage, dict) else lambda name: getattr(usage, name, None)
+        for kind in ("prompt_tokens", "completion_tokens"):
+            value = get(kind)
+            if value:
+                self.count(kind, value, provider, model)
+
+    def reset(self):
+        with self._lock:
+            self.series.clear()
+            self.counters.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            series = [(key, list(s.samples), s.count, s.total) for key, s in self.series.items()]
+            counters = dict(self.counters)
+        timings = []
+        for (name, provider, model), samples, count, total in sorted(series):
+            entry = {"name": name, "provider": provider, "model": model, "count": count, "sum": round(total, 6)}
+            ordered = sorted(samples)
+            for q in QUANTILES:
+                entry[f"p{int(q * 100)}"] = round(ordered[min(int(len(ordered) * q), len(ordered) - 1)], 6)
+            timings.append(entry)
+        return {
+            "timings": timings,
+            "counters": [
+                {"name": name, "provider": provider, "model": model, "value": value}
+                for (name, provider, model), value in sorted(counters.items())
+            ],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        # Text exposition format: a summary per span name, a counter per count
+        snapshot = self.snapshot()
+        lines = []
+        seen = set()
+        for entry in snapshot["timings"]:
+            metric = f"murmur_{entry['name']}_seconds"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} summary")
+            labels = f'provider="{_escape(entry["provider"])}",model="{_escape(entry["model"])}"'
+            for q in QUANTILES:
+                lines.append(f'{metric}{{{labels},quantile="{q}"}} {entry[f"p{int(q * 100)}"]}')
+            lines.append(f"{metric}_sum{{{labels}}} {entry['sum']}")
+            lines.append(f"{metric}_count{{{labels}}} {entry['count']}")
+        for entry in snapshot["counters"]:
+            metric = f"murmur_{entry['name']}_total"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            labels = f'provider="{_escape(entry["provider"])}",model="{_escape(entry["model"])}"'
+            lines.append(f"{metric}{{{labels}}} {entry['value']}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        # .prom gets Prometheus text, anything else JSON; written atomically
+        text = self.to_prometheus() if path.endswith(".prom") else self.to_json()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+class StartupTimer:
+    # Milestones from launch to a usable window, printed once and appended to
+    # a JSON Lines file so time-to-interactive can be compared across versions
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.marks = []
+        self.reported = False
+
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter() - self.started))
+
+    def report(self, path=None) -> dict:
+        if self.reported:
+            return {}
+        self.reported = True
+        report = {"timestamp": time.time(), "marks": {name: round(seconds * 1000, 1) for name, seconds in self.marks}}
+        print("Murmur: startup " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in report["marks"].items()))
+        for name, seconds in self.marks:
+            tracer.record(f"startup_{name}", seconds)
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(report) + "\n")
+            except OSError as e:
+                print(f"Murmur: could not write startup report - {e}")
+        return report
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+tracer = Tracer(enabled=os.environ.get("MURMUR_TRACE", "") not in ("", "0"))
@@ -0,0 +1,138 @@
+# transcript.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# The conversation shown in the output view, kept apart from AppKit
+#
+# The transcript is a run of segments: a prompt, a response still streaming,
+# a finished response. Changes are recorded as range edits in UTF-16 units
+# (what NSString and NSTextStorage count in), and the view applies them with
+# replaceCharactersInRange:, so a send costs the size of the change rather
+# than the size of the transcript. Once the buffer passes max_length, whole
+# finished segments are dropped from the front.
+
+
+from collections import deque
+
+
+MAX_SCROLLBACK = 1000000  # UTF-16 units kept in the output view
+
+
+def utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+class Edit:
+    # Replace `length` units at `location` with `text`. Each edit's location
+    # assumes the edits before it have already been applied.
+    __slots__ = ("location", "length", "text")
+
+    def __init__(self, location, length, text):
+        self.location = location
+        self.length = length
+        self.text = text
+
+    def __repr__(self):
+        return f"Edit({self.location}, {self.length}, {self.text!r})"
+
+
+class Segment:
+    __slots__ = ("start", "length", "parts", "open", "detached")
+
+    def __init__(self, start):
+        self.start = start  # in the buffer's running coordinates, see TranscriptBuffer.evicted
+        self.length = 0
+        self.parts = []
+        self.open = True
+        self.detached = False  # cleared out of the buffer; writes to it are dropped
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+
+class TranscriptBuffer:
+    def __init__(self, max_length=MAX_SCROLLBACK):
+        self.max_length = max_length
+        self.segments = deque()
+        self.length = 0   # UTF-16 units in the buffer
+        self.evicted = 0  # units dropped from the front so far; starts are offset by this
+        self.edits = []   # not yet taken by the view
+        self._insert_end = None  # where the last recorded insert ended, for merging
+
+    def append(self, text) -> Segment:
+        # A finished block at the end, like the "You: ..." line
+        segment = self.open_segment(text)
+        segment.open = False
+        self._evict()
+        return segment
+
+    def open_segment(self, text="") -> Segment:
+        # A block at the end that insert() can keep growing while later
+        # blocks are appended after it
+        segment = Segment(self.evicted + self.length)
+        self.segments.append(segment)
+        if text:
+            self.insert(segment, text)
+        return segment
+
+    def insert(self, segment, text):
+        # Add text to the end of a segment, moving the segments after it along
+        if segment.detached or not text:
+            return
+        units = utf16_length(text)
+        location = segment.start - self.evicted + segment.length
+        segment.parts.append(text)
+        segment.length += units
+        self.length += units
+        if self.segments[-1] is not segment:
+            for other in reversed(self.segments):
+                if other is segment:
+                    break
+                other.start += units
+        self._record(Edit(location, 0, text), units)
+
+    def close(self, segment):
+        segment.open = False
+        self._evict()
+
+    def replace_all(self, text=""):
+        # Swap the whole transcript out, e.g. to show a history entry. Streams
+        # still writing to the old segments are detached rather than moved.
+        for segment in self.segments:
+            segment.detached = True
+        self.segments.clear()
+        self._record(Edit(0, self.length, ""))
+        self.evicted += self.length
+        self.length = 0
+        if text:
+            self.append(text)
+
+    def take_edits(self) -> list:
+        edits, self.edits = self.edits, []
+        self._insert_end = None
+        return edits
+
+    def text(self) -> str:
+        return "".join(segment.text for segment in self.segments)
+
+    def _record(self, edit, units=0):
+        # Consecutive inserts at the same spot (a stream's deltas between two
+        # view updates) go out as one edit
+        if edit.length == 0 and self.edits and self._insert_end == edit.location:
+            self.edits[-1].text += edit.text
+        else:
+            self.edits.append(edit)
+        self._insert_end = edit.location + units if edit.length == 0 else None
+
+    def _evict(self):
+        # Drop finished segments from the front; an open one stops eviction
+        # until it finishes
+        while self.length > self.max_length and len(self.segments) > 1 and not self.segments[0].open:
+            segment = self.segments.popleft()
+            segment.detached = True
+            self._record(Edit(0, segment.length, ""))
+            self.length -= segment.length
+            self.evicted += segment.length
@@ -0,0 +1,425 @@
+# usage.py
+#
+# Murmur
+# a universal AI chat app for macOS
+# Tim Medley tim@medley.us
+#
+# What each model costs and how fast it answers
+#
+# Every provider call ChatService makes is appended to usage.jsonl as one short
+# line: time, provider, model, prompt and completion tokens, latency, time to
+# first token, tokens per second and, for failures, the error. Alongside it,
+# each model keeps a few running numbers (moving averages, a use count that
+# fades with time) that cost O(1) to update; those order and annotate the
+# model dropdown. The stats file notes how much of the ledger it covers, so
+# anything recorded after the last save is replayed on open. The daily report
+# streams the ledger, so it holds one row per day and model, not the ledger.
+#
+#   python usage.py --days 7
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from datetime import date, datetime, timedelta
+
+from history import HISTORY_DIR
+
+
+LEDGER_PATH = os.path.join(HISTORY_DIR, "usage.jsonl")
+STATS_PATH = os.path.join(HISTORY_DIR, "usage_stats.json")
+
+SMOOTHING = 0.2             # weight of the newest request in the moving averages
+HALF_LIFE = 7 * 24 * 3600   # seconds for a model's use count to fade by half
+MIN_GENERATING = 0.05       # seconds of streaming below which a reply says nothing about speed
+REPORT_DAYS = 30
+
+# List prices in USD per million tokens, (prefix, input, output). The first
+# matching prefix wins, so longer ones go first. Models not listed are
+# reported without a cost.
+MODEL_PRICES = [
+    ("gpt-4o-mini", 0.15, 0.60),
+    ("gpt-4o", 2.50, 10.00),
+    ("gpt-4.1-nano", 0.10, 0.40),
+    ("gpt-4.1-mini", 0.40, 1.60),
+    ("gpt-4.1", 2.00, 8.00),
+    ("gpt-4-turbo", 10.00, 30.00),
+    ("gpt-4", 30.00, 60.00),
+    ("gpt-3.5", 0.50, 1.50),
+    ("claude-opus-4", 15.00, 75.00),
+    ("claude-sonnet-4", 3.00, 15.00),
+    ("claude-3-7-sonnet", 3.00, 15.00),
+    ("claude-3-5-sonnet", 3.00, 15.00),
+    ("claude-3-5-haiku", 0.80, 4.00),
+    ("claude-3-opus", 15.00, 75.00),
+    ("claude-3-haiku", 0.25, 1.25),
+    ("gemini-2.5-pro", 1.25, 10.00),
+    ("gemini-2.5-flash-lite", 0.10, 0.40),
+    ("gemini-2.5-flash", 0.30, 2.50),
+    ("gemini-2.0-flash-lite", 0.075, 0.30),
+    ("gemini-2.0-flash", 0.10, 0.40),
+    ("gemini-1.5-pro", 1.25, 5.00),
+    ("gemini-1.5-flash", 0.075, 0.30),
+]
+
+
+def model_price(model):
+    for prefix, prompt_price, completion_price in MODEL_PRICES:
+        if model.startswith(prefix):
+            return prompt_price, completion_price
+    return None
+
+
+def request_cost(model, prompt_tokens, completion_tokens):
+    price = model_price(model)
+    if price is None:
+        return None
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1e6
+
+
+class ModelStats:
+    # Running numbers for one (provider, model); rate is completion tokens
+    # per second once the first token has arrived, so it measures generation
+    # speed apart from queueing and connection time
+    __slots__ = ("count", "errors", "prompt_tokens", "completion_tokens",
+                 "latency", "first_token", "rate", "uses", "last_used")
+    COUNTERS = ("count", "errors", "prompt_tokens", "completion_tokens", "uses")
+
+    def __init__(self, values=None):
+        values = values or {}
+        for name in self.__slots__:
+            setattr(self, name, values.get(name, 0 if name in self.COUNTERS else None))
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def add(self, entry):
+        if entry.get("hedge"):
+            # Says nothing about how often the model is chosen, or how fast it is
+            self.prompt_tokens += entry.get("in", 0)
+            self.completion_tokens += entry.get("out", 0)
+            return
+        timestamp = entry["t"]
+        self.uses = self.decayed(timestamp) + 1
+        self.last_used = max(timestamp, self.last_used or timestamp)
+        self.count += 1
+        if entry.get("err"):
+            self.errors += 1
+            return
+        self.prompt_tokens += entry.get("in", 0)
+        self.completion_tokens += entry.get("out", 0)
+        self.latency = _average(self.latency, entry.get("lat"))
+        self.first_token = _average(self.first_token, entry.get("ttft"))
+        self.rate = _average(self.rate, entry.get("tps"))
+
+    def decayed(self, now) -> float:
+        if not self.last_used:
+            return 0.0
+        return self.uses * 0.5 ** (max(now - self.last_used, 0) / HALF_LIFE)
+
+    def score(self, now) -> float:
+        # Recent use, discounted by how often the model fails; the +1/+2
+        # keeps one early failure from sinking a model for good
+        return self.decayed(now) * (self.count - self.errors + 1) / (self.count + 2)
+
+
+class UsageLedger:
+    def __init__(self, path=LEDGER_PATH, stats_path=STATS_PATH):
+        self.path = path
+        self.stats_path = stats_path
+        self._stats = None   # (provider, model) -> ModelStats, loaded on first use
+        self._file = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return self._load()
+
+    def record(self, provider, model, prompt_tokens, completion_tokens, latency, first_token=None, error=None,
+               timestamp=None, hedge=False):
+        # One finished provider call; error is the exception's class name.
+        # hedge marks the losing copy of a hedged request, aborted once the
+        # other answered: billed, but cut short, so left out of the timings.
+        entry = {"t": round(timestamp if timestamp is not None else time.time(), 3), "p": provider, "m": model,
+                 "in": prompt_tokens, "out": completion_tokens, "lat": round(latency, 3)}
+        if hedge:
+            entry["hedge"] = 1
+        elif first_token is not None:
+            entry["ttft"] = round(first_token, 3)
+            generating = latency - first_token
+            if completion_tokens > 1 and generating >= MIN_GENERATING:
+                entry["tps"] = round(completion_tokens / generating, 1)
+        if error:
+            entry["err"] = error
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._add(self._load(), entry)
+            try:
+                if self._file is None:
+                    self._file = self._open_for_append()
+                self._file.write(line)
+                self._file.flush()
+            except OSError as e:
+                print(f"UsageLedger: could not write {self.path} - {e}")
+        return entry
+
+    def model_stats(self, provider, model):
+        with self._lock:
+            return self._load().get((provider, model))
+
+    def rank(self, provider, models, now=None) -> list:
+        # Most used (and least failing) first; sorted() is stable, so models
+        # never used keep the order the provider listed them in
+        now = now if now is not None else time.time()
+        with self._lock:
+            stats = self._load()
+            scores = {model: stats[(provider, model)].score(now) for model in models if (provider, model) in stats}
+        return sorted(models, key=lambda model: -scores.get(model, 0.0))
+
+    def annotate(self, provider, model) -> str:
+        # "85 tok/s · 0.6 s" for the dropdown, or "" before the first answer
+        stats = self.model_stats(provider, model)
+        if stats is None:
+            return ""
+        parts = []
+        if stats.rate:
+            parts.append(f"{stats.rate:.0f} tok/s")
+        wait = stats.first_token if stats.first_token is not None else stats.latency
+        if wait is not None:
+            parts.append(f"{wait:.1f} s")
+        return " · ".join(parts)
+
+    def entries(self, since=None):
+        # Ledger lines as dicts, oldest first, from the timestamp since on.
+        # Lines are appended in time order, so the first one wanted is found
+        # by bisecting on byte offsets rather than parsing everything before it.
+        with self._lock:
+            if self._file:
+                self._file.flush()
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            if since is not None:
+                f.seek(_find(f, since))
+            for line in f:
+                entry = _parse(line)
+                if entry and (since is None or entry["t"] >= since):
+                    yield entry
+
+    def daily_report(self, days=REPORT_DAYS, today=None) -> list:
+        # One row per (day, provider, model) over the last days days, newest
+        # day first; days are local dates
+        today = today or date.today()
+        first_day = today - timedelta(days=days - 1)
+        since = datetime.combine(first_day, datetime.min.time()).timestamp()
+        rows = {}
+        day, day_start, day_end = None, 0, 0
+        for entry in self.entries(since):
+            if not day_start <= entry["t"] < day_end:
+                # Entries come in time order, so this runs about once a day
+                current = datetime.fromtimestamp(entry["t"]).date()
+                day = current.isoformat()
+                day_start = datetime.combine(current, datetime.min.time()).timestamp()
+                day_end = datetime.combine(current + timedelta(days=1), datetime.min.time()).timestamp()
+            key = (day, entry["p"], entry["m"])
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = {"day": day, "provider": entry["p"], "model": entry["m"], "requests": 0,
+                                   "errors": 0, "hedged": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                   "latency": 0.0, "_generating": 0.0, "_rated": 0}
+            row["requests"] += 1
+            if entry.get("err"):
+                row["errors"] += 1
+                continue
+            completion_tokens = entry.get("out", 0)
+            row["prompt_tokens"] += entry.get("in", 0)
+            row["completion_tokens"] += completion_tokens
+            if entry.get("hedge"):
+                row["hedged"] += 1
+                continue
+            row["latency"] += entry.get("lat", 0.0)
+            if entry.get("tps"):
+                row["_generating"] += completion_tokens / entry["tps"]
+                row["_rated"] += completion_tokens
+        report = []
+        # By provider and model within a day; the sort by day keeps that order
+        for key in sorted(sorted(rows), key=lambda key: key[0], reverse=True):
+            row = rows[key]
+            cost = request_cost(row["model"], row["prompt_tokens"], row["completion_tokens"])
+            row["cost"] = round(cost, 6) if cost is not None else None
+            answered = row["requests"] - row["errors"] - row["hedged"]
+            row["latency"] = round(row["latency"] / answered, 3) if answered else None
+            generating, rated = row.pop("_generating"), row.pop("_rated")
+            # Token-weighted, so long answers count for more than short ones
+            row["tokens_per_second"] = round(rated / generating, 1) if generating else None
+            report.append(row)
+        return report
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+            if self._dirty:
+                self._save()
+
+    def _open_for_append(self):
+        # A line cut short by a crash is ended, so it spoils only itself
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        f = open(self.path, "a+b")
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+        f.close()
+        return open(self.path, "a", encoding="utf-8")
+
+    def _load(self) -> dict:
+        if self._stats is not None:
+            return self._stats
+        stats, offset = {}, 0
+        try:
+            with open(self.stats_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            stats = {(item["provider"], item["model"]): ModelStats(item) for item in saved.get("models", [])}
+            offset = saved.get("offset", 0)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"UsageLedger: could not read {self.stats_path} - {e}")
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if offset > size:
+            # The ledger was replaced or cut short; start again from it
+            stats, offset = {}, 0
+        if offset < size:
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    entry = _parse(line)
+                    if entry:
+                        self._add(stats, entry)
+            self._dirty = True
+        self._stats = stats
+        return stats
+
+    def _add(self, stats, entry):
+        key = (entry["p"], entry["m"])
+        model_stats = stats.get(key)
+        if model_stats is None:
+            model_stats = stats[key] = ModelStats()
+        model_stats.add(entry)
+        self._dirty = True
+
+    def _save(self):
+        try:
+            offset = os.path.getsize(self.path)
+        except OSError:
+            offset = 0
+        saved = {"offset": offset, "models": [
+            dict(stats.to_dict(), provider=provider, model=model)
+            for (provider, model), stats in sorted(self._stats.items())
+        ]}
+        try:
+            os.makedirs(os.path.dirname(self.stats_path) or ".", exist_ok=True)
+            tmp_path = f"{self.stats_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(saved, f)
+            os.replace(tmp_path, self.stats_path)
+            self._dirty = False
+        except OSError as e:
+            print(f"UsageLedger: could not save {self.stats_path} - {e}")
+
+
+def format_report(rows) -> str:
+    if not rows:
+        return "No requests recorded."
+    lines = [f"{'Day':<10}  {'Model':<32} {'Reqs':>5} {'Errs':>4} {'Tokens in':>10} {'Tokens out':>10} "
+             f"{'Cost $':>9} {'Tok/s':>6} {'Latency':>7}"]
+    total_cost, unpriced = 0.0, False
+    for row in rows:
+        if row["cost"] is None:
+            unpriced = True
+        else:
+            total_cost += row["cost"]
+        cost = "?" if row["cost"] is None else f"{row['cost']:.4f}"
+        rate = "-" if row["tokens_per_second"] is None else f"{row['tokens_per_second']:.0f}"
+        latency = "-" if row["latency"] is None else f"{row['latency']:.1f} s"
+        model = f"{row['provider']}/{row['model']}"
+        lines.append(f"{row['day']:<10}  {model:<32} {row['requests']:>5} {row['errors']:>4} "
+                     f"{row['prompt_tokens']:>10} {row['completion_tokens']:>10} {cost:>9} {rate:>6} {latency:>7}")
+    lines.append(f"Total cost ${total_cost:.4f}" + (" plus models without a listed price" if unpriced else ""))
+    return "\n".join(lines)
+
+
+def _average(average, value):
+    if value is None:
+        return average
+    if average is None:
+        return value
+    return average + SMOOTHING * (value - average)
+
+
+def _find(f, since) -> int:
+    # Offset of the first line at or after since, in a file of lines in time order
+    def line_start(offset):
+        f.seek(max(offset - 1, 0))
+        if offset:
+            f.readline()  # the rest of the line offset falls in
+        return f.tell()
+
+    def reached(offset):
+        f.seek(line_start(offset))
+        for line in f:
+            entry = _parse(line)
+            if entry:
+                return entry["t"] >= since
+        return True
+
+    low, high = 0, os.fstat(f.fileno()).st_size
+    while low < high:
+        middle = (low + high) // 2
+        if reached(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return line_start(low)
+
+
+def _parse(line):
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None  # a line cut short by a crash
+    if not isinstance(entry, dict) or "t" not in entry or "p" not in entry or "m" not in entry:
+        return None
+    return entry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report Murmur's requests, tokens, cost and throughput by day.")
+    parser.add_argument("--days", type=int, default=REPORT_DAYS)
+    parser.add_argument("--ledger", default=LEDGER_PATH)
+    parser.add_argument("--json", action="store_true", help="print rows as JSON Lines")
+    args = parser.parse_args(argv)
+
+    rows = UsageLedger(args.ledger).daily_report(args.days)
+    if args.json:
+        for row in rows:
+            print(json.dumps(row))
+    else:
+        print(format_report(rows))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())